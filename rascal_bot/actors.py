@@ -0,0 +1,193 @@
+import time
+from array import array
+
+from rules import RULES
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       actors.py
+Author:     @WhitneyOnTheWeb
+
+Per-actor history for spotting fake and spam accounts
+
+- Counts are kept in one array per feature, with a row per actor, so
+  lookups are a dict hit plus an index and saving is a few byte strings
+- Updated as posts are validated, warned, deleted or flagged, with no
+  extra Graph calls
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+POSTS, WARNINGS, DELETIONS, DUPLICATES = \
+    'posts', 'warnings', 'deletions', 'duplicates'
+COUNTS = (POSTS,) + tuple(rule.name for rule in RULES) + \
+    (WARNINGS, DELETIONS, DUPLICATES)
+TIMES = ('first_seen', 'last_seen')     # created time of first / last post
+
+
+'''-------------------------------------
+Class: ActorStats
+
+Array-backed feature store keyed by actor
+
+- A post is only counted once: posts
+  created at or before an actor's last
+  seen post were counted already, so
+  edits and re-reads of warned posts are
+  skipped
+- Actors whose risk crosses the threshold
+  are kept in <flagged> until drained
+
+Input:
+    <threshold>:    risk that marks an actor
+                    as high risk
+    <min_events>:   warnings, deletions and
+                    duplicates needed first
+'''
+class ActorStats(object):
+    version = 0                         # bumped on every change, for BotState
+
+    def __init__(self, threshold=0.5, min_events=3):
+        self.threshold = threshold
+        self.min_events = min_events
+        self.flagged = []               # actors newly high risk
+        self._rows = {}                 # actor_id -> row
+        self._counts = dict((name, array('I')) for name in COUNTS)
+        self._times = dict((name, array('d')) for name in TIMES)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, actor_id):
+        return actor_id in self._rows
+
+    def _row(self, actor_id, now):
+        row = self._rows.get(actor_id)
+        if row is None:
+            row = self._rows[actor_id] = len(self._rows)
+            for column in self._counts.values():
+                column.append(0)
+            for column in self._times.values():
+                column.append(now)
+        return row
+
+    '''-------------------------------------
+    Method: get
+
+    Looks up everything known about an actor
+
+    Return:
+        <dict>: feature -> value, None for an
+                actor that hasn't been seen
+    '''
+    def get(self, actor_id):
+        row = self._rows.get(actor_id)
+        if row is None:
+            return None
+        features = dict((name, column[row])
+                        for name, column in self._counts.items())
+        features.update((name, column[row])
+                        for name, column in self._times.items())
+        return features
+
+    '''-------------------------------------
+    Method: observe
+
+    Counts newly created posts and the rules
+    they broke
+
+    Input:
+        <posts>:    post dicts with actor_id and
+                    created_time
+        <verdicts>: verdict bitmask per post
+    '''
+    def observe(self, posts, verdicts):
+        pairs = sorted(zip(posts, verdicts),
+                       key=lambda pair: pair[0].get('created_time') or 0)
+        for post, verdict in pairs:
+            created = post.get('created_time') or time.time()
+            row = self._row(post['actor_id'], created)
+            if self._counts[POSTS][row] == 0:
+                self._times['first_seen'][row] = created
+            elif created <= self._times['last_seen'][row]:
+                continue
+            self._times['last_seen'][row] = created
+            self._counts[POSTS][row] += 1
+            self.version += 1
+            for rule in RULES:
+                if verdict & rule.flag:
+                    self._counts[rule.name][row] += 1
+
+    '''-------------------------------------
+    Method: record
+
+    Counts a warning, deletion or duplicate
+    against an actor
+    '''
+    def record(self, actor_id, feature, now=None):
+        was_risky = self.is_high_risk(actor_id)
+        row = self._row(actor_id, time.time() if now is None else now)
+        self._counts[feature][row] += 1
+        self.version += 1
+        if not was_risky and self.is_high_risk(actor_id):
+            self.flagged.append(actor_id)
+
+    '''-------------------------------------
+    Method: risk
+
+    Bad events per post, deletions and
+    duplicates count double
+
+    Return:
+        <float>:    0 for a clean actor, can go
+                    past 1
+    '''
+    def risk(self, actor_id):
+        row = self._rows.get(actor_id)
+        if row is None:
+            return 0.0
+        c = self._counts
+        bad = c[WARNINGS][row] + 2 * (c[DELETIONS][row] + c[DUPLICATES][row])
+        return bad / float(c[POSTS][row] + 1)
+
+    def is_high_risk(self, actor_id):
+        row = self._rows.get(actor_id)
+        if row is None:
+            return False
+        c = self._counts
+        events = c[WARNINGS][row] + c[DELETIONS][row] + c[DUPLICATES][row]
+        return events >= self.min_events and \
+            self.risk(actor_id) >= self.threshold
+
+    def drain(self):
+        flagged, self.flagged = self.flagged, []
+        return flagged
+
+    def __getstate__(self):
+        return {'threshold': self.threshold,
+                'min_events': self.min_events,
+                'actors': sorted(self._rows, key=self._rows.get),
+                'counts': dict((name, column.tobytes())
+                               for name, column in self._counts.items()),
+                'times': dict((name, column.tobytes())
+                              for name, column in self._times.items())}
+
+    def __setstate__(self, state):
+        self.__init__(state['threshold'], state['min_events'])
+        self._rows = dict((actor_id, row)
+                          for row, actor_id in enumerate(state['actors']))
+        for name, data in state['counts'].items():
+            if name in self._counts:
+                self._counts[name].frombytes(data)
+        for name, data in state['times'].items():
+            if name in self._times:
+                self._times[name].frombytes(data)
+
+        # Features added since the save start at zero
+        for name, column in self._counts.items():
+            column.extend([0] * (len(self._rows) - len(column)))
+
@@ -0,0 +1,614 @@
+import asyncio
+import contextlib
+import getopt
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import util as u
+from actors import ActorStats
+from cache import PostCache, VerdictCache
+from corpus import CorpusGenerator
+from deadline import DeadlineQueue
+from fakegraph import FakeGraph, FakeGraphClient, FakeGraphServer
+from feed import FeedCursor
+from flood import FloodDetector
+from graph import DeleteExecutor
+from moderator import AsyncModerator
+from ratelimit import AdaptiveRateLimiter, RateLimitedGraph
+from roster import AdminRoster
+from rules import PostRuleSet
+from spam import NearDuplicateIndex
+from store import PickleStore, SQLiteStore
+from TestPosts import bad_posts, good_posts
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       bench.py
+Author:     @WhitneyOnTheWeb
+
+Benchmarks for the rule engine, the moderation loop and the caches
+
+- The load suite runs whole moderation passes over a generated corpus,
+  through a local fake Graph server, at growing sizes until one falls
+  over or runs past load_timeout
+
+- Results are JSON, one entry per measurement with its name, value, unit
+  and parameters, so runs from different commits can be compared
+- Usage: python bench.py [-q] [-s suite,..] [-o results.json]
+                         [-c baseline.json]
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+group_id = '1000'
+bot_id = 99
+repeat = 3                          # runs per timing, the best one is kept
+
+full_sizes = {'posts': 5000, 'cache': (1000, 10000, 50000),
+              'load': (10000, 100000, 1000000)}
+quick_sizes = {'posts': 500, 'cache': (1000,), 'load': (1000,)}
+
+load_latency = 0.002                # seconds the fake Graph adds per request
+load_rate = None                    # its requests per second, None = unlimited
+load_max_rate = 500                 # Graph calls per second the limiter allows
+load_edit_rate = 0.05               # share of posts edited between passes
+load_delete_rate = 0.01             # share of posts deleted between passes
+load_repost_rate = 0.02             # share of posts that copy a recent one
+load_timeout = 1800                 # seconds a size can take before stopping
+
+
+'''-------------------------------------
+Method: result
+
+One measurement
+
+Input:
+    <name>:     dotted benchmark name
+    <value>:    number measured, None if it
+                couldn't be
+    <unit>:     eg. "posts/s", "s", "bytes"
+    <params>:   what it was measured with
+'''
+def result(name, value, unit, **params):
+    return OrderedDict([('name', name), ('value', value), ('unit', unit),
+                        ('params', params)])
+
+
+'''-------------------------------------
+Method: best_time
+
+Runs <func> <repeat> times and keeps the
+fastest, calling <setup> untimed before
+each run
+
+Return:
+    <float>:    seconds for the fastest run
+'''
+def best_time(func, setup=None, runs=repeat):
+    best = None
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+'''-------------------------------------
+Method: corpus
+
+Stream rows made from the TestPosts
+samples, <count> of them from 20 actors,
+one every <spacing> seconds
+
+Return:
+    <list>: post dicts, oldest first
+'''
+def corpus(count, start=None, spacing=60):
+    if start is None:
+        start = time.time() - count * spacing
+    samples = good_posts + bad_posts
+    posts = []
+    for i in range(count):
+        created = start + i * spacing
+        posts.append({'post_id': '%s_%d' % (group_id, i),
+                      'message': samples[i % len(samples)] + ' #%d' % i,
+                      'actor_id': str(100 + i % 20),
+                      'created_time': created, 'updated_time': created})
+    return posts
+
+
+'''-------------------------------------
+Method: bench_validators
+
+Posts per second through each rule
+engine entry point
+'''
+def bench_validators(sizes):
+    posts = corpus(sizes['posts'])
+    messages = [post['message'] for post in posts]
+    rules = PostRuleSet()
+    n = len(messages)
+
+    validators = OrderedDict([
+        ('get_tags', lambda m: rules.get_tags(m)),
+        ('validate_tags', lambda m: rules.validate_tags(rules.get_tags(m))),
+        ('has_price', rules.has_price),
+        ('has_exempt_tag', rules.has_exempt_tag),
+        ('violations', rules.violations),
+        ('verdict', rules.verdict),
+    ])
+    results = []
+    for name, validator in validators.items():
+        seconds = best_time(lambda: [validator(m) for m in messages])
+        results.append(result('validators.' + name, n / seconds, 'posts/s',
+                              posts=n))
+
+    seconds = best_time(lambda: rules.validate_batch(posts))
+    results.append(result('validators.validate_batch', n / seconds,
+                          'posts/s', posts=n))
+
+    memo = VerdictCache()
+    rules.validate_batch(posts, memo=memo)
+    seconds = best_time(lambda: rules.validate_batch(posts, memo=memo))
+    results.append(result('validators.validate_batch_memo', n / seconds,
+                          'posts/s', posts=n))
+    return results
+
+
+'''-------------------------------------
+Method: bench_moderation
+
+Posts per second through an async
+moderation pass against a FakeGraph,
+warnings, deletes and screens included
+'''
+def bench_moderation(sizes):
+    n = sizes['posts']
+    now = time.time()
+    state = {}
+
+    def setup():
+        graph = FakeGraph(corpus(n), admin_ids=[1], bot_id=bot_id)
+        state['graph'] = graph
+        state['moderator'] = AsyncModerator(
+            graph, PostRuleSet(), AdminRoster(), bot_id, {}, PostCache(),
+            DeleteExecutor(graph), u.max_in_flight, 1, now,
+            memo=VerdictCache(), spam_index=NearDuplicateIndex(),
+            actors=ActorStats(), flood=FloodDetector())
+
+    def run():
+        asyncio.run(state['moderator'].run(group_id, FeedCursor(0)))
+        state['moderator'].deletes.run()
+
+    seconds = best_time(run, setup)
+    return [result('moderation.async_run', n / seconds, 'posts/s', posts=n,
+                   graph_calls=sum(state['graph'].calls.values()))]
+
+
+'''-------------------------------------
+Method: bench_sub_group
+
+Posts per second through a one-shot
+sub_group run against a FakeGraph. Needs
+rascal.py's own imports, it's reported as
+skipped without them
+'''
+def bench_sub_group(sizes):
+    n = sizes['posts']
+    try:
+        import rascal
+    except ImportError as e:
+        return [result('sub_group.run', None, 'posts/s', posts=n,
+                       skipped=str(e))]
+
+    graph = FakeGraph(corpus(n), admin_ids=[1], bot_id=bot_id)
+    with tempfile.TemporaryDirectory() as tmp, \
+            sub_group_runner(rascal, graph, tmp) as run_once:
+        start = time.perf_counter()
+        run_once()
+        seconds = time.perf_counter() - start
+    return [result('sub_group.run', n / seconds, 'posts/s', posts=n,
+                   graph_calls=sum(graph.calls.values()))]
+
+
+'''-------------------------------------
+Method: sub_group_runner
+
+Sets rascal up to run sub_group against
+<graph>, keeping everything inside <tmp>
+and not messaging anyone
+
+Yield:
+    <function>: runs sub_group once, state
+                carries over between calls
+'''
+@contextlib.contextmanager
+def sub_group_runner(rascal, graph, tmp):
+    props = {'sublets_oauth_access_token': 'token',
+             'access_token_expiration': time.time() + 30 * 86400,
+             'sublets_api_id': 'app', 'sublets_secret_key': 'secret',
+             'ignored_post_ids': [], 'ignore_source_ids': [],
+             'group_id': group_id, 'bot_id': bot_id, 'admin_ids': []}
+    saved = (u.store, u.journal_path, rascal.message_admins,
+             rascal.admin_roster)
+    try:
+        u.store = PickleStore(tmp)
+        u.journal_path = os.path.join(tmp, 'journal')
+        rascal.message_admins = lambda *args: None
+        rascal.admin_roster = None
+
+        state = rascal.BotState()
+        state.track(u.prop_file, lambda: props, lambda data: None)
+        state.graph = graph
+        state.graph_token = props['sublets_oauth_access_token']
+        yield lambda: rascal.sub_group(state=state)
+        state.journal.close()
+    finally:
+        u.store, u.journal_path, rascal.message_admins, \
+            rascal.admin_roster = saved
+
+
+'''-------------------------------------
+Method: moderator_runner
+
+Stands in for sub_group_runner when rascal
+can't be imported, running AsyncModerator
+passes with sub_group's caches and screens
+
+Yield:
+    <function>: runs one pass, state carries
+                over between calls
+'''
+@contextlib.contextmanager
+def moderator_runner(graph):
+    warned, valid, cursor = {}, PostCache(), FeedCursor(0)
+    caches = {'memo': VerdictCache(), 'spam_index': NearDuplicateIndex(),
+              'actors': ActorStats(), 'flood': FloodDetector()}
+
+    def run_once():
+        deletes = DeleteExecutor(graph, u.delete_workers, u.delete_retries)
+        moderator = AsyncModerator(
+            graph, PostRuleSet(), AdminRoster(), bot_id, warned, valid,
+            deletes, u.max_in_flight, u.validate_workers, **caches)
+        asyncio.run(moderator.run(group_id, cursor))
+        deletes.run()
+    yield run_once
+
+
+'''-------------------------------------
+Method: bench_load
+
+Moderation passes over generated corpora
+served by a FakeGraphServer, through the
+HTTP session and rate limiter
+
+- Each size gets a first pass over every
+  post, then edits and deletes, then a
+  second pass to pick those up
+- Drives sub_group when rascal imports,
+  AsyncModerator passes when it doesn't
+- Sizes stop at the first one that fails
+  or takes over load_timeout, the failure
+  is kept as a result with no value
+- Peak RSS is for the whole process, so
+  it only tells sizes apart as they grow
+'''
+def bench_load(sizes):
+    try:
+        import rascal
+        driver = 'sub_group'
+    except ImportError:
+        rascal = None
+        driver = 'async_moderator'
+
+    results = []
+    for n in sizes['load']:
+        params = {'posts': n, 'driver': driver, 'latency': load_latency,
+                  'rate': load_rate}
+        generator = CorpusGenerator(
+            seed=n, actors=max(500, n // 200), repost_rate=load_repost_rate,
+            spacing=min(30.0, 0.9 * u.feed_lookback / n))
+        graph = FakeGraph(generator.posts(n), admin_ids=[1], bot_id=bot_id)
+        server = FakeGraphServer(graph, latency=load_latency,
+                                 rate=load_rate).start()
+        client = RateLimitedGraph(FakeGraphClient(server.url),
+                                  AdaptiveRateLimiter(
+                                      load_max_rate, u.graph_burst,
+                                      u.graph_min_rate, load_max_rate,
+                                      u.graph_target_usage, u.graph_retries))
+        u.log('Load testing ' + str(n) + ' posts through ' + driver,
+              u.Color.BOLD)
+        try:
+            with tempfile.TemporaryDirectory() as tmp, \
+                    (sub_group_runner(rascal, client, tmp) if rascal else
+                     moderator_runner(client)) as run_once:
+                start = time.perf_counter()
+                run_once()
+                first = time.perf_counter() - start
+
+                edited, deleted = generator.churn(
+                    graph, load_edit_rate, load_delete_rate)
+                start = time.perf_counter()
+                run_once()
+                second = time.perf_counter() - start
+        except Exception as e:
+            results.append(result('load.first_pass', None, 'posts/s',
+                                  failed=repr(e), **params))
+            break
+        finally:
+            server.stop()
+
+        results.extend([
+            result('load.first_pass', n / first, 'posts/s', **params),
+            result('load.churn_pass', second, 's', edited=len(edited),
+                   deleted=len(deleted), **params),
+            result('load.graph_requests', server.requests, 'requests',
+                   **params),
+            result('load.throttled', server.throttled, 'requests', **params),
+            result('load.peak_rss', resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024, 'bytes', **params)])
+        if first + second > load_timeout:
+            u.log('Stopping load tests, ' + str(n) + ' posts took ' +
+                  str(int(first + second)) + 's', u.Color.BOLD)
+            break
+    return results
+
+
+'''-------------------------------------
+Method: cache_objects
+
+The caches sub_group saves, each holding
+<size> posts
+
+Return:
+    <dict>: name -> (cache, default it's
+            loaded with)
+'''
+def cache_objects(size):
+    now = time.time()
+    valid = PostCache(max_size=size)
+    verdicts = VerdictCache(max_size=size)
+    warned = {}
+    for i in range(size):
+        post_id = '%s_%d' % (group_id, i)
+        valid.add(post_id, now)
+        verdicts.put(post_id, 'message %d' % i, i % 8, now)
+        warned[post_id] = now - i
+    return OrderedDict([('valid', (valid, PostCache(max_size=size))),
+                        ('warned', (warned, {})),
+                        ('verdicts', (verdicts, None))])
+
+
+'''-------------------------------------
+Method: bench_cache
+
+Save and load time for each store backend
+against cache size. "save" writes a cache
+under a new name, "resave" writes it again
+unchanged
+'''
+def bench_cache(sizes):
+    results = []
+    names = ('bench_%d' % i for i in itertools.count())
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = OrderedDict([
+            ('pickle', PickleStore(tmp)),
+            ('sqlite', SQLiteStore(os.path.join(tmp, 'bench.db')))])
+        for size in sizes['cache']:
+            for kind, (obj, default) in cache_objects(size).items():
+                for backend, store in stores.items():
+                    state = {}
+                    timings = OrderedDict([
+                        ('save', best_time(
+                            lambda: store.save(state['name'], obj),
+                            lambda: state.update(name=next(names)))),
+                        ('resave', best_time(
+                            lambda: store.save(state['name'], obj))),
+                        ('load', best_time(
+                            lambda: store.load(state['name'], default)))])
+                    for action, seconds in timings.items():
+                        results.append(result(
+                            'cache.' + action + '.' + backend, seconds, 's',
+                            cache=kind, size=size))
+        for store in stores.values():
+            store.close()
+    return results
+
+
+'''-------------------------------------
+Method: bench_memory
+
+Bytes of memory and of pickle per post
+for each in-memory structure
+'''
+def bench_memory(sizes):
+    n = max(sizes['cache'])
+    posts = corpus(min(n, sizes['posts']))
+    builders = OrderedDict([
+        ('valid', lambda: cache_objects(n)['valid'][0]),
+        ('warned', lambda: cache_objects(n)['warned'][0]),
+        ('verdicts', lambda: cache_objects(n)['verdicts'][0]),
+        ('deadlines', lambda: DeadlineQueue.from_warned(
+            cache_objects(n)['warned'][0], u.time_limit)),
+        ('spam_index', lambda: spam_index(posts)),
+        ('actors', lambda: actor_stats(n)),
+    ])
+    sizes_of = {'spam_index': len(posts)}
+
+    results = []
+    for name, build in builders.items():
+        count = sizes_of.get(name, n)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        obj = build()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results.append(result('memory.' + name, (after - before) / count,
+                              'bytes/post', posts=count))
+        results.append(result('memory.pickled.' + name,
+                              len(pickle.dumps(obj, 2)) / float(count),
+                              'bytes/post', posts=count))
+        del obj
+    return results
+
+
+def spam_index(posts):
+    index = NearDuplicateIndex(max_size=len(posts))
+    index.check(posts)
+    return index
+
+
+def actor_stats(count):
+    stats = ActorStats()
+    stats.observe([{'actor_id': str(i), 'created_time': i}
+                   for i in range(count)], [0] * count)
+    return stats
+
+
+'''-------------------------------------
+Suites
+======
+'''
+suites = OrderedDict([
+    ('validators', bench_validators),
+    ('moderation', bench_moderation),
+    ('sub_group', bench_sub_group),
+    ('cache', bench_cache),
+    ('memory', bench_memory),
+    ('load', bench_load),
+])
+
+
+'''-------------------------------------
+Method: run
+
+Runs benchmark suites
+
+Input:
+    <names>:    suites to run, all if None
+    <quick>:    small sizes, for a smoke test
+    <sizes>:    overrides the preset sizes
+Return:
+    <dict>:     "meta" about the run and a list
+                of "results"
+'''
+def run(names=None, quick=False, sizes=None):
+    if sizes is None:
+        sizes = quick_sizes if quick else full_sizes
+    results = []
+    for name in names or suites:
+        u.log('Running ' + name + ' benchmarks', u.Color.BOLD)
+        results.extend(suites[name](sizes))
+    return OrderedDict([('meta', meta(sizes)), ('results', results)])
+
+
+def meta(sizes):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('commit', commit), ('time', int(time.time())),
+                        ('python', platform.python_version()),
+                        ('platform', platform.platform()),
+                        ('sizes', sizes)])
+
+
+'''-------------------------------------
+Method: compare
+
+Lines up two runs' results
+
+Input:
+    <baseline>: earlier run's output
+    <current>:  this run's output
+Return:
+    <list>:     (name, params, old, new, change)
+                for results in both, change is
+                new / old - 1
+'''
+def compare(baseline, current):
+    def key(entry):
+        return entry['name'], json.dumps(entry['params'], sort_keys=True)
+
+    old = dict((key(entry), entry['value']) for entry in baseline['results'])
+    rows = []
+    for entry in current['results']:
+        before = old.get(key(entry))
+        if before is None or entry['value'] is None:
+            continue
+        change = entry['value'] / before - 1 if before else None
+        rows.append((entry['name'], entry['params'], before, entry['value'],
+                     change))
+    return rows
+
+
+def usage():
+    sys.exit('Usage: bench.py [-q] [-s suite,..] [-o results.json] '
+             '[-c baseline.json]\nSuites: ' + ', '.join(suites))
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'qs:o:c:',
+                                   ['quick', 'suites=', 'output=',
+                                    'compare='])
+    except getopt.GetoptError:
+        usage()
+
+    quick = False
+    names = None
+    output = None
+    baseline = None
+    for opt, arg in opts:
+        if opt in ('-q', '--quick'):
+            quick = True
+        elif opt in ('-s', '--suites'):
+            names = arg.split(',')
+            if any(name not in suites for name in names):
+                usage()
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt in ('-c', '--compare'):
+            baseline = arg
+
+    # Progress logs go to stderr, stdout stays JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(names, quick)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    # The comparison goes to stderr, stdout stays JSON
+    if baseline:
+        with open(baseline) as f:
+            rows = compare(json.load(f), report)
+        for name, params, before, after, change in rows:
+            sys.stderr.write('%-32s %-40s %12.4g %12.4g %+7.1f%%\n' % (
+                name, json.dumps(params, sort_keys=True)[:40], before,
+                after, 100 * change if change is not None else 0))
@@ -0,0 +1,278 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       cache.py
+Author:     @WhitneyOnTheWeb
+
+Cache types for post state that RASCAL keeps between runs
+
+- Saved and loaded through util.save_cache / util.load_cache
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+default_size = 20000                # most post IDs held by a PostCache
+default_ttl = 2592000               # 60 * 60 * 24 * 30 (s --> 30 days)
+
+
+'''-------------------------------------
+Method: message_digest
+
+Hashes a post's text for VerdictCache.
+Python's hash() is salted per process, so
+it can't be kept between runs
+
+Input:
+    <message>:  post message, None for none
+Return:
+    <str>:      hex digest of the text
+'''
+def message_digest(message):
+    return hashlib.sha1((message or '').encode('utf-8')).hexdigest()
+
+
+'''-------------------------------------
+Class: PostCache
+
+Bounded set of post IDs with hash lookups
+
+- Entries expire <ttl> seconds after they
+  were last seen (added or looked up)
+- Least recently seen entries are evicted
+  once the cache holds <max_size> IDs
+- Only live entries are pickled
+
+Input:
+    <max_size>: most IDs to hold
+    <ttl>:      seconds an unseen ID is kept
+'''
+class PostCache(object):
+    def __init__(self, max_size=default_size, ttl=default_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()   # post_id -> last seen, in the order
+                                        # added, which isn't always by time
+
+    '''-------------------------------------
+    Method: from_list
+
+    Builds a cache from a legacy list of IDs,
+    as saved by older versions of RASCAL
+    '''
+    @classmethod
+    def from_list(cls, post_ids, **kwargs):
+        cache = cls(**kwargs)
+        cache.update(post_ids)
+        return cache
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def items(self):
+        return list(self._entries.items())
+
+    '''-------------------------------------
+    Method: __contains__
+
+    Looks up a post ID, refreshing it if it's
+    live and dropping it if it has expired
+    '''
+    def __contains__(self, post_id):
+        seen = self._entries.get(post_id)
+        if seen is None:
+            return False
+        now = time.time()
+        if now - seen > self.ttl:
+            del self._entries[post_id]
+            return False
+        self._entries[post_id] = now
+        self._entries.move_to_end(post_id)
+        return True
+
+    '''-------------------------------------
+    Method: add
+
+    Adds or refreshes a post ID, evicting the
+    least recently seen IDs past max_size
+
+    Input:
+        <post_id>:  ID to cache
+        <now>:      time seen, defaults to now
+    '''
+    def add(self, post_id, now=None):
+        self._entries[post_id] = time.time() if now is None else now
+        self._entries.move_to_end(post_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update(self, post_ids, now=None):
+        for post_id in post_ids:
+            self.add(post_id, now)
+
+    def discard(self, post_id):
+        self._entries.pop(post_id, None)
+
+    '''-------------------------------------
+    Method: prune
+
+    Drops every expired entry. Entries can be
+    added with an older time than the last,
+    eg. replayed from the journal, so every
+    one is checked
+
+    Return:
+        <int>:  number of entries dropped
+    '''
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+        expired = [post_id for post_id, seen in self._entries.items()
+                   if now - seen > self.ttl]
+        for post_id in expired:
+            del self._entries[post_id]
+        return len(expired)
+
+    def __getstate__(self):
+        self.prune()
+        return {'max_size': self.max_size,
+                'ttl': self.ttl,
+                'entries': list(self._entries.items())}
+
+    def __setstate__(self, state):
+        self.max_size = state['max_size']
+        self.ttl = state['ttl']
+        self._entries = OrderedDict(state['entries'])
+        self.prune()
+
+
+'''-------------------------------------
+Class: VerdictCache
+
+Last verdict for each post, keyed by post
+ID and a digest of its text
+
+- A post whose text is unchanged reuses its
+  verdict instead of being revalidated
+- An edited post's digest won't match, so
+  it misses and gets validated again
+- Everything is dropped when the rules it
+  was checked against change
+- Expiry and eviction work like PostCache
+
+Input:
+    <max_size>: most posts to hold
+    <ttl>:      seconds an unseen post is kept
+'''
+class VerdictCache(object):
+    version = 0                         # bumped on every change, for BotState
+
+    def __init__(self, max_size=default_size, ttl=default_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.rules = None               # PostRuleSet.fingerprint checked with
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # post_id -> (digest, verdict, seen)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, post_id):
+        return post_id in self._entries
+
+    '''-------------------------------------
+    Method: check_rules
+
+    Empties the cache if it was filled under
+    a different rule set
+    '''
+    def check_rules(self, fingerprint):
+        if self.rules != fingerprint:
+            self._entries.clear()
+            self.rules = fingerprint
+            self.version += 1
+
+    '''-------------------------------------
+    Method: get
+
+    Looks up a post's verdict for its current
+    text, refreshing it on a hit
+
+    Input:
+        <post_id>:  ID of the post
+        <message>:  post's current text
+    Return:
+        <int>:      cached verdict, None if the
+                    post is new, edited or expired
+    '''
+    def get(self, post_id, message, now=None):
+        entry = self._entries.get(post_id)
+        if now is None:
+            now = time.time()
+        if entry is None or entry[0] != message_digest(message) or \
+                now - entry[2] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[post_id] = (entry[0], entry[1], now)
+        self._entries.move_to_end(post_id)
+        self.version += 1
+        return entry[1]
+
+    '''-------------------------------------
+    Method: put
+
+    Stores a post's verdict for its text,
+    replacing the one for any older version
+    '''
+    def put(self, post_id, message, verdict, now=None):
+        self._entries[post_id] = (message_digest(message), verdict,
+                                  time.time() if now is None else now)
+        self._entries.move_to_end(post_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self.version += 1
+
+    def discard(self, post_id):
+        if self._entries.pop(post_id, None) is not None:
+            self.version += 1
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+        dropped = 0
+        while self._entries:
+            post_id, entry = next(iter(self._entries.items()))
+            if now - entry[2] <= self.ttl:
+                break
+            del self._entries[post_id]
+            dropped += 1
+        if dropped:
+            self.version += 1
+        return dropped
+
+    def __getstate__(self):
+        self.prune()
+        return {'max_size': self.max_size,
+                'ttl': self.ttl,
+                'rules': self.rules,
+                'entries': list(self._entries.items())}
+
+    def __setstate__(self, state):
+        self.max_size = state['max_size']
+        self.ttl = state['ttl']
+        self.rules = state['rules']
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict(state['entries'])
+        self.prune()
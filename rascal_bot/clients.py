@@ -0,0 +1,150 @@
+import threading
+
+import facepy
+import requests
+from requests.adapters import HTTPAdapter
+
+import util as u
+from ratelimit import get_limiter, limit_graph, usage_headers
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       clients.py
+Author:     @WhitneyOnTheWeb
+
+Graph API client factory over one pooled HTTP session
+
+- Every client made here shares one requests.Session per process, so
+  connections to Graph are kept alive and reused across clients,
+  threads and runs instead of paying for a new TLS handshake each time
+- Pool size and timeouts come from the util.http_* settings
+- Clients come back wrapped in the shared rate limiter, which reads
+  Graph's usage headers off every response the session gets
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+shared_session = None               # session shared by every client
+_session_lock = threading.Lock()
+
+
+'''-------------------------------------
+Method: get_session
+
+Returns the process-wide session, set up
+on first use with a keep-alive pool of
+util.http_pool_size connections per host,
+and a hook that reports usage headers to
+the rate limiter
+'''
+def get_session():
+    global shared_session
+    with _session_lock:
+        if shared_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=u.http_pool_hosts,
+                                  pool_maxsize=u.http_pool_size,
+                                  max_retries=u.http_retries)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.hooks['response'].append(observe_response)
+            shared_session = session
+    return shared_session
+
+
+'''-------------------------------------
+Method: observe_response
+
+Session response hook, passes Graph's
+usage headers to the shared limiter
+'''
+def observe_response(response, *args, **kwargs):
+    if any(name in response.headers for name in usage_headers):
+        get_limiter().observe_usage(response.headers)
+    return response
+
+
+'''-------------------------------------
+Method: graph_client
+
+Makes a Graph API client on the shared
+session
+
+- With util.graph_url set, eg. from
+  RASCAL_GRAPH_URL, it talks to a local
+  FakeGraphServer instead, for load tests
+
+Input:
+    <auth_token>:   OAuth access token
+    <sdk>:          client module, facepy or
+                    facebook, facepy if None
+Return:
+    <RateLimitedGraph>: client for the token
+'''
+def graph_client(auth_token, sdk=None):
+    timeout = (u.http_connect_timeout, u.http_read_timeout)
+    session = get_session()
+
+    if u.graph_url:
+        from fakegraph import FakeGraphClient
+        return limit_graph(FakeGraphClient(u.graph_url, session, timeout))
+
+    if sdk is None or sdk is facepy:
+        graph = facepy.GraphAPI(auth_token, timeout=timeout)
+        graph.session = session
+    else:
+        try:
+            graph = sdk.GraphAPI(auth_token, timeout=timeout, session=session)
+        except TypeError:
+            # Older facebook SDKs don't take a session
+            graph = sdk.GraphAPI(auth_token, timeout=timeout)
+            graph.session = session
+    return limit_graph(graph)
+
+
+'''-------------------------------------
+Method: connection_stats
+
+Reads request and connection counts off
+the shared session's pools, to check that
+connections are being reused
+
+Return:
+    <dict>: requests, connections opened,
+            requests on a reused connection,
+            and live pools
+'''
+def connection_stats():
+    stats = {'requests': 0, 'connections': 0, 'reused': 0, 'pools': 0}
+    if shared_session is None:
+        return stats
+
+    seen = set()
+    for adapter in shared_session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['pools'] += 1
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    stats['reused'] = max(0, stats['requests'] - stats['connections'])
+    return stats
+
+
+'''-------------------------------------
+Method: log_connection_stats
+
+Logs connection reuse for the run so far
+'''
+def log_connection_stats():
+    stats = connection_stats()
+    u.log('--HTTP requests: ' + str(stats['requests']) + ', connections: ' +
+          str(stats['connections']) + ', reused: ' + str(stats['reused']),
+          u.Color.BOLD)
@@ -0,0 +1,205 @@
+import random
+import re
+import time
+from collections import deque
+
+from rules import PostRuleSet, group_tags, price_pattern
+from TestPosts import bad_posts, good_posts
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       corpus.py
+Author:     @WhitneyOnTheWeb
+
+Synthetic group posts for load testing
+
+- Posts are put together from the lines of the TestPosts samples, with
+  fresh numbers and a tag drawn from a configurable mix, so no two read
+  quite the same
+- Rule violations, reposts, edits and deletes happen at configurable
+  rates, and every post can be checked against the rate it was made at
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+unknown_tags = ('sale', 'misc', 'found', 'question')   # not in group_tags
+number_pattern = re.compile(r'\d+')
+bullet_pattern = re.compile(r'^[-*\s]+')
+
+
+'''-------------------------------------
+Method: sample_lines
+
+Splits the TestPosts samples into lines,
+without their tag lines or bullets, to
+build posts from
+
+Return:
+    <list>: distinct lines, in sample order
+'''
+def sample_lines():
+    lines = []
+    for post in good_posts + bad_posts:
+        for line in post.strip().split('\n')[1:]:
+            line = bullet_pattern.sub('', line).strip()
+            if len(line) > 8 and line not in lines:
+                lines.append(line)
+    return lines
+
+
+'''-------------------------------------
+Class: CorpusGenerator
+
+Makes stream rows for a fake group
+
+Input:
+    <seed>:             random seed, the same
+                        seed makes the same posts
+    <actors>:           people posting
+    <tag_mix>:          tag -> weight, defaults to
+                        every post tag evenly
+    <violation_rate>:   share of posts breaking a
+                        rule
+    <rule_mix>:         rule name -> weight, which
+                        rule a bad post breaks
+    <repost_rate>:      share of posts copying a
+                        recent post
+    <start>:            first post's created_time
+    <spacing>:          seconds between posts
+    <group_id>:         ID the post IDs start with
+'''
+class CorpusGenerator(object):
+    def __init__(self, seed=0, actors=500, tag_mix=None, violation_rate=0.3,
+                 rule_mix=None, repost_rate=0.0, start=None, spacing=30,
+                 group_id='1000'):
+        self.rng = random.Random(seed)
+        self.actors = actors
+        self.tag_mix = tag_mix or dict((tag, 1) for tag in group_tags)
+        self.violation_rate = violation_rate
+        self.rule_mix = rule_mix or {'price': 1, 'tag': 1, 'length': 1}
+        self.repost_rate = repost_rate
+        self.start = start
+        self.spacing = spacing
+        self.group_id = group_id
+        self.count = 0
+        self.lines = sample_lines()
+        self.rules = PostRuleSet()
+        self._price = re.compile(price_pattern, re.IGNORECASE)
+        self._recent = deque(maxlen=100)    # messages a repost can copy
+
+    def _pick(self, weights):
+        return self.rng.choices(list(weights), list(weights.values()))[0]
+
+    def _numbers(self, line):
+        return number_pattern.sub(
+            lambda m: str(self.rng.randint(1, 10 ** len(m.group(0)))), line)
+
+    '''-------------------------------------
+    Method: message
+
+    Puts one post's text together
+
+    Input:
+        <broken>:   name of the rule to break,
+                    None for a valid post
+    '''
+    def message(self, broken=None):
+        if broken == 'tag':
+            first = self.rng.choice(['[%s]' % self.rng.choice(unknown_tags),
+                                     ''])
+        else:
+            tag = self._pick(self.tag_mix)
+            while broken == 'length' and tag in self.rules.exempt_tags:
+                tag = self._pick(self.tag_mix)
+            first = '[%s]' % tag
+
+        count = self.rng.randint(1, 2) if broken == 'length' else \
+            self.rng.randint(4, 9)
+        lines = [self._numbers(line)
+                 for line in self.rng.sample(self.lines, count)]
+        if broken == 'length':
+            lines.insert(0, '$%d per month' % self.rng.randint(300, 1500))
+        elif broken != 'price':
+            lines.append('$%d per month' % self.rng.randint(300, 1500))
+
+        text = first + '\n-' + '\n-'.join(lines)
+        if broken == 'length':
+            return re.sub('craigslist', 'listing',
+                          text[:self.rules.min_length - 1], flags=re.I)
+        while len(text) < self.rules.min_length:
+            text += '\n-' + self._numbers(self.rng.choice(self.lines))
+        if broken == 'price':
+            text = self._price.sub('', text)
+            while len(text) < self.rules.min_length:
+                text += '\n-' + self._price.sub(
+                    '', self._numbers(self.rng.choice(self.lines)))
+        return text
+
+    '''-------------------------------------
+    Method: posts
+
+    Makes <count> stream rows, lazily, so
+    large corpora needn't sit in memory
+
+    Yield:
+        <dict>: post_id, message, actor_id,
+                created_time, updated_time
+    '''
+    def posts(self, count):
+        start = self.start
+        if start is None:
+            start = time.time() - count * self.spacing
+        for _ in range(count):
+            if self._recent and self.rng.random() < self.repost_rate:
+                message = self.rng.choice(self._recent)
+            elif self.rng.random() < self.violation_rate:
+                message = self.message(self._pick(self.rule_mix))
+            else:
+                message = self.message()
+            self._recent.append(message)
+
+            created = int(start + self.count * self.spacing)
+            post = {'post_id': '%s_%d' % (self.group_id, self.count),
+                    'message': message,
+                    'actor_id': str(100000 + self.rng.randrange(self.actors)),
+                    'created_time': created, 'updated_time': created}
+            self.count += 1
+            yield post
+
+    '''-------------------------------------
+    Method: churn
+
+    Edits and deletes some of a FakeGraph's
+    posts, like members would between runs
+
+    Input:
+        <graph>:        FakeGraph to change
+        <edit_rate>:    share of posts edited
+        <delete_rate>:  share of posts deleted
+        <now>:          updated_time for edits
+    Return:
+        <tuple>:        (edited, deleted) post IDs
+    '''
+    def churn(self, graph, edit_rate=0.05, delete_rate=0.01, now=None):
+        if now is None:
+            now = time.time()
+        post_ids = list(graph.posts)
+        edited = self.rng.sample(post_ids, int(len(post_ids) * edit_rate))
+        for post_id in edited:
+            post = dict(graph.posts[post_id])
+            broken = self._pick(self.rule_mix) \
+                if self.rng.random() < self.violation_rate else None
+            post['message'] = self.message(broken)
+            post['updated_time'] = now
+            graph.add_post(post)
+
+        edited_set = set(edited)
+        deleted = self.rng.sample([p for p in post_ids if p not in edited_set],
+                                  int(len(post_ids) * delete_rate))
+        for post_id in deleted:
+            graph.delete_object(post_id)
+        return edited, deleted
@@ -0,0 +1,113 @@
+import heapq
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       deadline.py
+Author:     @WhitneyOnTheWeb
+
+Grace period deadlines for warned posts
+
+- Warned posts sit in a min-heap keyed by when their grace period ends,
+  so each run only looks at the posts that are due instead of every
+  warned post
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Class: DeadlineQueue
+
+Min-heap of (deadline, post_id)
+
+- Removing or moving a post leaves its
+  old heap entry behind, it's skipped on
+  the way out and swept once stale entries
+  outnumber live ones
+- due() reads without popping, so a post
+  stays due until it's removed, eg. when a
+  delete fails and has to be retried
+
+Input:
+    <grace>:    seconds from warning to deadline
+'''
+class DeadlineQueue(object):
+    def __init__(self, grace):
+        self.grace = grace
+        self._heap = []
+        self._deadlines = {}        # post_id -> live deadline
+
+    '''-------------------------------------
+    Method: from_warned
+
+    Builds the queue from a dict of post_id
+    -> time warned in one heapify
+    '''
+    @classmethod
+    def from_warned(cls, warned, grace):
+        queue = cls(grace)
+        for post_id, warned_at in warned.items():
+            queue._deadlines[post_id] = warned_at + grace
+        queue._heap = [(deadline, post_id) for post_id, deadline
+                       in queue._deadlines.items()]
+        heapq.heapify(queue._heap)
+        return queue
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, post_id):
+        return post_id in self._deadlines
+
+    def deadline(self, post_id):
+        return self._deadlines.get(post_id)
+
+    def push(self, post_id, warned_at):
+        deadline = warned_at + self.grace
+        if self._deadlines.get(post_id) == deadline:
+            return
+        self._deadlines[post_id] = deadline
+        heapq.heappush(self._heap, (deadline, post_id))
+        self._sweep()
+
+    def discard(self, post_id):
+        if self._deadlines.pop(post_id, None) is not None:
+            self._sweep()
+
+    '''-------------------------------------
+    Method: due
+
+    Finds every post whose deadline has
+    passed, walking only the part of the
+    heap at or before <now>
+
+    Return:
+        <list>: post IDs, earliest deadline
+                first
+    '''
+    def due(self, now):
+        found = []
+        stack = [0] if self._heap else []
+        while stack:
+            i = stack.pop()
+            deadline, post_id = self._heap[i]
+            if deadline > now:
+                continue            # so is everything under it
+            if self._deadlines.get(post_id) == deadline:
+                found.append((deadline, post_id))
+            stack.extend(c for c in (2 * i + 1, 2 * i + 2)
+                         if c < len(self._heap))
+        return [post_id for _, post_id in sorted(found)]
+
+    def next_deadline(self):
+        while self._heap:
+            deadline, post_id = self._heap[0]
+            if self._deadlines.get(post_id) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def _sweep(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._heap = [(deadline, post_id) for post_id, deadline
+                          in self._deadlines.items()]
+            heapq.heapify(self._heap)
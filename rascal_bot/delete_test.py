@@ -5,6 +5,8 @@ import sys
 import time
 import facepy
 
+from clients import graph_client
+
 __author__ = 'Henri Sweers'
 
 
@@ -23,7 +25,7 @@ def load_properties():
             return obj
     else:
         if os.path.isfile(prop_file):
-            with open(prop_file, 'r+') as login_prop_file:
+            with open(prop_file, 'rb') as login_prop_file:
                 data = pickle.load(login_prop_file)
                 return data
         else:
@@ -45,7 +47,7 @@ def test():
     # ID of the FB group
     group_id = saved_props['group_id']
 
-    graph = facepy.GraphAPI(sublets_oauth_access_token)
+    graph = graph_client(sublets_oauth_access_token)
 
     obj = graph.post(group_id + "/feed", message="test")
     postid = obj['id']
@@ -53,18 +55,18 @@ def test():
     try:
         graph.delete(postid)
     except Exception as e:
-        print 'ERROR: ' + e.message
-        print type(e)
-        print 'Failed to delete with GraphAPI'
+        print('ERROR: ' + str(e))
+        print(type(e))
+        print('Failed to delete with GraphAPI')
         return False
 
-    print "Confirming deletion..."
+    print("Confirming deletion...")
     time.sleep(2)
     try:
-        print graph.get(str(postid))
+        print(graph.get(str(postid)))
         return False
     except:
-        print "Deletion confirmed ✓"
+        print("Deletion confirmed ✓")
         return True
 
 
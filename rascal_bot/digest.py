@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       digest.py
+Author:     @WhitneyOnTheWeb
+
+Outbound admin notifications, coalesced into digests
+
+- Events are collected during a run and sent as one message per admin,
+  instead of one message per admin per event
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Class: NotificationDigest
+
+Queue of admin notifications, keyed by the
+post URL they're about. A newer event for
+the same post replaces the older one
+
+Input:
+    <interval>: seconds between digests while
+                a run is going, None to only
+                send at the end of the run
+'''
+class NotificationDigest(object):
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.events = OrderedDict()     # url -> message
+        self.last_drain = time.time()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, message, url):
+        self.events.pop(url, None)
+        self.events[url] = message
+
+    '''-------------------------------------
+    Method: is_due
+
+    Checks if the interval has passed with
+    events waiting to go out
+    '''
+    def is_due(self, now=None):
+        if self.interval is None or not self.events:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.last_drain >= self.interval
+
+    '''-------------------------------------
+    Method: drain
+
+    Renders the digest and empties the queue
+
+    Return:
+        <str>:  digest message, or None if
+                nothing is queued
+    '''
+    def drain(self, now=None):
+        self.last_drain = time.time() if now is None else now
+        if not self.events:
+            return None
+
+        count = len(self.events)
+        lines = ["RASCAL needs a hand with " + str(count) +
+                 (" posts:" if count > 1 else " post:")]
+        for url, message in self.events.items():
+            lines.append("- " + message + ": " + url)
+        self.events.clear()
+        return "\n".join(lines)
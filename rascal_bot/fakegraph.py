@@ -0,0 +1,540 @@
+import bisect
+import getopt
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       fakegraph.py
+Author:     @WhitneyOnTheWeb
+
+In-memory stand-in for the Graph API, for benchmarks and tests
+
+- Answers the FQL the runners send (stream, comment, group_member) and
+  the object calls for comments, deletes and lookups, facebook SDK style
+- Counts every call, so a run's API usage can be checked
+- FakeGraphServer serves one over local HTTP, with added latency and
+  throttling, and FakeGraphClient talks to it, so load tests go through
+  real requests, the shared session and the rate limiter
+- Usage: python fakegraph.py [-p port] [-n posts] [-l latency]
+                             [-r rate] [-s seed]
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+ids_pattern = re.compile(r'IN \(([^)]*)\)')
+since_pattern = re.compile(r'updated_time>=([\d.]+)')
+before_pattern = re.compile(r'created_time<([\d.]+)')
+limit_pattern = re.compile(r'LIMIT (\d+)(?: OFFSET (\d+))?')
+version_pattern = re.compile(r'^/?v\d+(?:\.\d+)?(?=/|$)')
+
+
+class FakeGraphError(Exception):
+    def __init__(self, message, code=100):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+'''-------------------------------------
+Class: FakeGraph
+
+One group's posts, comments and members
+
+- Posts are indexed by updated_time and
+  comments by post, so paging the stream
+  and looking up comments stay cheap at a
+  million posts
+
+Input:
+    <posts>:        stream rows, post_id,
+                    message, actor_id,
+                    created_time, updated_time
+    <admin_ids>:    admin user IDs
+    <member_ids>:   other member user IDs
+    <bot_id>:       user ID comments are from
+'''
+class FakeGraph(object):
+    def __init__(self, posts=(), admin_ids=(), member_ids=(), bot_id=0):
+        self.posts = OrderedDict()
+        self.comments = OrderedDict()   # comment ID -> comment row
+        self.admin_ids = list(admin_ids)
+        self.member_ids = list(member_ids)
+        self.bot_id = bot_id
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._updated = []              # sorted (updated_time, post_id)
+        self._post_comments = {}        # post_id -> comment IDs
+        for post in posts:
+            self._put_post(post)
+
+    '''-------------------------------------
+    Method: fql
+
+    Runs one query, or a dict of named
+    queries as a multi-query
+    '''
+    def fql(self, query):
+        if isinstance(query, dict):
+            return [{'name': name, 'fql_result_set': self.fql(q)}
+                    for name, q in query.items()]
+
+        with self._lock:
+            if ' FROM stream ' in query:
+                self.calls['stream'] += 1
+                return self._stream(query)
+            if ' FROM comment ' in query:
+                self.calls['comment'] += 1
+                return [dict(self.comments[comment_id])
+                        for post_id in self._ids_in(query)
+                        for comment_id in self._post_comments.get(post_id, ())]
+            if ' FROM group_member ' in query:
+                self.calls['group_member'] += 1
+                return self._members(query)
+        raise FakeGraphError('Unsupported query: ' + query)
+
+    def _stream(self, query):
+        if ' IN (' in query:
+            return [dict(self.posts[post_id])
+                    for post_id in self._ids_in(query)
+                    if post_id in self.posts]
+
+        # Old posts, oldest first
+        before = before_pattern.search(query)
+        if before is not None:
+            rows = sorted((p for p in self.posts.values()
+                           if p['created_time'] < float(before.group(1))),
+                          key=lambda p: p['created_time'])
+            return [dict(p) for p in self._page(query, rows)]
+
+        since = float(since_pattern.search(query).group(1))
+        first = bisect.bisect_left(self._updated, (since,))
+        match = limit_pattern.search(query)
+        if match is None:
+            keys = self._updated[first:]
+        else:
+            limit, offset = int(match.group(1)), int(match.group(2) or 0)
+            keys = self._updated[first + offset:first + offset + limit]
+        return [dict(self.posts[post_id]) for _, post_id in keys]
+
+    def _members(self, query):
+        if 'administrator' in query:
+            return [{'uid': uid} for uid in self.admin_ids
+                    if str(uid) != str(self.bot_id)]
+        rows = self.admin_ids + self.member_ids
+        return [{'uid': uid} for uid in self._page(query, rows)]
+
+    def _ids_in(self, query):
+        return [i.strip().strip('"')
+                for i in ids_pattern.search(query).group(1).split(',')]
+
+    def _page(self, query, rows):
+        match = limit_pattern.search(query)
+        if match is None:
+            return rows
+        limit, offset = int(match.group(1)), int(match.group(2) or 0)
+        return rows[offset:offset + limit]
+
+    def _put_post(self, post):
+        post_id = post['post_id']
+        if post_id in self.posts:
+            self._unindex(post_id)
+        self.posts[post_id] = dict(post)
+        bisect.insort(self._updated, (post['updated_time'], post_id))
+
+    def _unindex(self, post_id):
+        key = (self.posts[post_id]['updated_time'], post_id)
+        i = bisect.bisect_left(self._updated, key)
+        if i < len(self._updated) and self._updated[i] == key:
+            del self._updated[i]
+
+    '''-------------------------------------
+    Method: add_post
+
+    Adds a post, or replaces it, eg. to
+    play back an edit
+    '''
+    def add_post(self, post):
+        with self._lock:
+            self._put_post(post)
+
+    def put_object(self, parent_object, connection_name, **data):
+        with self._lock:
+            self.calls['put_object'] += 1
+            if parent_object not in self.posts:
+                raise FakeGraphError('Unknown object ' + str(parent_object))
+            comment_id = '%s_c%d' % (parent_object, next(self._ids))
+            self.comments[comment_id] = {
+                'post_id': parent_object, 'fromid': self.bot_id,
+                'id': comment_id, 'time': int(time.time()),
+                'text': data.get('message', '')}
+            self._post_comments.setdefault(parent_object, []).append(
+                comment_id)
+            return {'id': comment_id}
+
+    def delete_object(self, id):
+        with self._lock:
+            self.calls['delete_object'] += 1
+            if id in self.posts:
+                self._unindex(id)
+                del self.posts[id]
+                for comment_id in self._post_comments.pop(id, ()):
+                    del self.comments[comment_id]
+                return True
+            comment = self.comments.pop(id, None)
+            if comment is not None:
+                self._post_comments[comment['post_id']].remove(id)
+                return True
+        raise FakeGraphError('Unknown object ' + str(id))
+
+    def get_object(self, id, **args):
+        with self._lock:
+            self.calls['get_object'] += 1
+            if id in self.posts:
+                return dict(self.posts[id])
+            if id in self.comments:
+                return dict(self.comments[id])
+        raise FakeGraphError('Unknown object ' + str(id))
+
+
+'''-------------------------------------
+Class: FakeGraphServer
+
+Serves a FakeGraph over local HTTP, the
+way Graph would
+
+- GET /fql?q= runs FQL, a JSON object of
+  named queries as a multi-query
+- POST /<id>/comments, DELETE /<id> and
+  GET /<id> are the object calls, POST /
+  with batch= runs a batch of them
+- Every request waits <latency> seconds,
+  plus up to <jitter> more
+- With a <rate>, requests draw from a
+  token bucket of <burst>, running dry
+  answers with a code 4 throttling error,
+  and every answer reports usage in an
+  X-App-Usage header
+
+Input:
+    <graph>:    FakeGraph to serve
+    <address>:  (host, port), port 0 picks
+                a free one
+    <latency>:  seconds added per request
+    <jitter>:   most extra random latency
+    <rate>:     requests per second allowed,
+                None for no throttling
+    <burst>:    requests allowed back to back
+'''
+class FakeGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, graph, address=('127.0.0.1', 0), latency=0, jitter=0,
+                 rate=None, burst=None, seed=0):
+        ThreadingHTTPServer.__init__(self, address, FakeGraphHandler)
+        self.graph = graph
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.requests = 0
+        self.throttled = 0
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._rng = random.Random(seed)
+        self._bucket_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def delay(self):
+        with self._bucket_lock:
+            wait = self.latency + self._rng.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    '''-------------------------------------
+    Method: admit
+
+    Takes <cost> tokens for a request
+
+    Return:
+        <float>:    usage % to report, None if
+                    the request is throttled
+    '''
+    def admit(self, cost=1):
+        with self._bucket_lock:
+            self.requests += 1
+            if self.rate is None:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                self.throttled += 1
+                return None
+            # A batch bigger than the bucket runs it into debt
+            self._tokens -= cost
+            return min(100, round(100 * (1 - self._tokens / self.burst)))
+
+    '''-------------------------------------
+    Method: dispatch
+
+    Runs one Graph call against the graph
+
+    Input:
+        <method>:   HTTP method
+        <path>:     request path, with or
+                    without a version prefix
+        <params>:   query and form parameters
+    Return:
+        <object>:   JSON-able response body
+    '''
+    def dispatch(self, method, path, params):
+        path = version_pattern.sub('', path).strip('/')
+        parts = path.split('/') if path else []
+        graph = self.graph
+
+        if method == 'GET' and parts == ['fql']:
+            query = params.get('q', '')
+            if query.lstrip().startswith('{'):
+                query = json.loads(query)
+            return {'data': graph.fql(query)}
+        if method == 'POST' and len(parts) == 2 and parts[1] == 'comments':
+            return graph.put_object(parts[0], 'comments', **params)
+        if method == 'DELETE' and len(parts) == 1:
+            return {'success': graph.delete_object(parts[0])}
+        if method == 'GET' and len(parts) == 1:
+            return graph.get_object(parts[0])
+        raise FakeGraphError('Unsupported request: %s /%s' % (method, path))
+
+    '''-------------------------------------
+    Method: run_batch
+
+    Runs each request of a Graph batch
+
+    Return:
+        <list>: Graph style batch responses,
+                code, headers and JSON body
+    '''
+    def run_batch(self, requests):
+        responses = []
+        for request in requests:
+            split = urlsplit('/' + request.get('relative_url', '').lstrip('/'))
+            params = dict(parse_qsl(split.query))
+            params.update(parse_qsl(request.get('body', '')))
+            try:
+                body = self.dispatch(request.get('method', 'GET').upper(),
+                                     split.path, params)
+                code = 200
+            except FakeGraphError as e:
+                body, code = error_body(e), 400
+            responses.append({'code': code, 'headers': [],
+                              'body': json.dumps(body)})
+        return responses
+
+
+def error_body(error):
+    return {'error': {'message': str(error), 'type': 'OAuthException',
+                      'code': error.code}}
+
+
+'''-------------------------------------
+Class: FakeGraphHandler
+
+Request handler for FakeGraphServer,
+keeps connections alive like Graph does
+'''
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        split = urlsplit(self.path)
+        params = dict(parse_qsl(split.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode('utf-8')))
+
+        server = self.server
+        server.delay()
+        batch = None
+        if method == 'POST' and split.path.strip('/') == '' and \
+                'batch' in params:
+            batch = json.loads(params['batch'])
+
+        usage = server.admit(len(batch) if batch else 1)
+        if usage is None:
+            self._reply(400, error_body(FakeGraphError(
+                '(#4) Application request limit reached', code=4)), 100)
+            return
+
+        try:
+            if batch is not None:
+                body = server.run_batch(batch)
+            else:
+                body = server.dispatch(method, split.path, params)
+            self._reply(200, body, usage)
+        except FakeGraphError as e:
+            self._reply(400, error_body(e), usage)
+        except (KeyError, ValueError, AttributeError) as e:
+            self._reply(400, error_body(FakeGraphError(repr(e))), usage)
+
+    def _reply(self, status, body, usage):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-App-Usage', json.dumps(
+            {'call_count': usage, 'total_time': 0, 'total_cputime': 0}))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+'''-------------------------------------
+Class: FakeGraphClient
+
+Graph client for a FakeGraphServer, with
+the facebook SDK's method names, over the
+shared HTTP session
+
+- Errors are raised as FakeGraphError with
+  Graph's error code, so throttling and
+  retries are handled like the real thing
+- Like the real clients, responses come
+  back without their headers. The shared
+  session's hook reads usage off them
+
+Input:
+    <url>:      server URL
+    <session>:  requests session, the shared
+                one if None
+    <timeout>:  (connect, read) seconds
+'''
+class FakeGraphClient(object):
+    def __init__(self, url, session=None, timeout=None):
+        if session is None:
+            from clients import get_session
+            session = get_session()
+        self.url = url.rstrip('/')
+        self.session = session
+        self.timeout = timeout
+
+    def request(self, method, path, params=None, data=None):
+        response = self.session.request(method, self.url + '/' + path,
+                                        params=params, data=data,
+                                        timeout=self.timeout)
+        body = response.json()
+        if isinstance(body, dict) and 'error' in body:
+            error = body['error']
+            raise FakeGraphError(error.get('message'), error.get('code', 100))
+        return body
+
+    def fql(self, query):
+        if isinstance(query, dict):
+            query = json.dumps(query)
+        return self.request('GET', 'fql', params={'q': query})
+
+    def put_object(self, parent_object, connection_name, **data):
+        return self.request('POST', '%s/%s' % (parent_object,
+                                               connection_name), data=data)
+
+    def delete_object(self, id):
+        return self.request('DELETE', str(id))
+
+    def get_object(self, id, **args):
+        return self.request('GET', str(id), params=args or None)
+
+    '''-------------------------------------
+    Method: batch
+
+    Sends a Graph batch request
+
+    Yield:
+        <object>:   each request's parsed body,
+                    or a FakeGraphError
+    '''
+    def batch(self, requests):
+        responses = self.request('POST', '', data={
+            'batch': json.dumps(list(requests))})
+        for response in responses:
+            body = json.loads(response['body'])
+            if isinstance(body, dict) and 'error' in body:
+                yield FakeGraphError(body['error'].get('message'),
+                                     body['error'].get('code', 100))
+            else:
+                yield body
+
+
+def usage():
+    sys.exit('Usage: fakegraph.py [-p port] [-n posts] [-l latency] '
+             '[-r rate] [-s seed]')
+
+
+if __name__ == "__main__":
+    from corpus import CorpusGenerator
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'p:n:l:r:s:',
+                                   ['port=', 'posts=', 'latency=', 'rate=',
+                                    'seed='])
+    except getopt.GetoptError:
+        usage()
+
+    port, count, latency, rate, seed = 8080, 10000, 0, None, 0
+    for opt, arg in opts:
+        if opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-n', '--posts'):
+            count = int(arg)
+        elif opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+
+    graph = FakeGraph(CorpusGenerator(seed).posts(count), admin_ids=[1])
+    server = FakeGraphServer(graph, ('127.0.0.1', port), latency, rate=rate)
+    print('Serving %d posts at %s' % (count, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,5 +1,13 @@
 import sleekxmpp
 import logging
+import threading
+
+import util as u
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 logging.basicConfig(level=logging.FATAL)
 
@@ -43,3 +51,139 @@ class SendMsgBot(sleekxmpp.ClientXMPP):
         # Using wait=True ensures that the send queue will be
         # emptied before ending the session.
         self.disconnect(wait=True)
+
+
+class SessionBot(sleekxmpp.ClientXMPP):
+
+    """
+    A SleekXMPP bot that stays logged in and sends every message
+    queued on it, so many messages share one connection.
+    """
+
+    def __init__(self, jid, outbox=None, on_disconnect=None):
+
+        sleekxmpp.ClientXMPP.__init__(self, jid, 'ignore')
+
+        # Messages waiting for the session to start, as
+        # (recipient, message) pairs. The queue can outlive
+        # the bot, so nothing's lost if it never connects
+        self.outbox = outbox if outbox is not None else queue.Queue()
+        self.ready = threading.Event()
+        self.closing = False
+        self.on_disconnect = on_disconnect
+
+        self.add_event_handler("session_start", self.start, threaded=True)
+        self.add_event_handler("disconnected", self.disconnected)
+
+    def start(self, event):
+
+        # The roster isn't needed to send chat messages,
+        # so only presence goes out before the outbox
+        self.send_presence()
+        self.ready.set()
+        self.flush()
+
+    def disconnected(self, event):
+        self.ready.clear()
+
+        # SleekXMPP reconnects by itself unless it was told
+        # to stop, anything else is handed back to the session
+        if self.closing or (self.auto_reconnect and not self.stop.is_set()):
+            return
+        if self.on_disconnect is not None:
+            self.on_disconnect(self)
+
+    def queue_message(self, recipient, message):
+        self.outbox.put((recipient, message))
+        if self.ready.is_set():
+            self.flush()
+
+    def flush(self):
+
+        # send_message only hands off to SleekXMPP's send
+        # queue, so this never waits on the network
+        while True:
+            try:
+                recipient, message = self.outbox.get_nowait()
+            except queue.Empty:
+                return
+            self.send_message(mto=recipient, mbody=message, mtype='chat')
+
+
+class MessageSession(object):
+
+    """
+    Long-lived Facebook chat session around a SessionBot. Connects
+    on the first message, processes in the background, and sends
+    everything queued before close() logs out. Messages that
+    couldn't be sent stay queued for the next connection.
+    """
+
+    def __init__(self, bot_id, api_key, access_token,
+                 server=('chat.facebook.com', 5222)):
+        self.jid = str(bot_id) + '@chat.facebook.com'
+        self.api_key = api_key
+        self.access_token = access_token
+        self.server = server
+        self.outbox = queue.Queue()
+        self.bot = None
+
+    def connect(self):
+        if self.bot is not None:
+            return True
+
+        bot = SessionBot(self.jid, self.outbox, self.reconnect)
+        bot.credentials['api_key'] = self.api_key
+        bot.credentials['access_token'] = self.access_token
+        # One attempt, a failed connect keeps the messages queued
+        # instead of blocking the run on retries
+        if not bot.connect(self.server, reattempt=False):
+            return False
+
+        # Don't block, the moderation loop keeps running
+        bot.process(block=False)
+        self.bot = bot
+        return True
+
+    def reconnect(self, bot):
+        if bot is not self.bot:
+            return
+        self.bot = None
+        u.log('--Chat disconnected, reconnecting', u.Color.RED)
+        if not self.connect():
+            u.log('--Chat reconnect failed, messages kept queued',
+                  u.Color.RED)
+
+    def send(self, recipient, message):
+        if not self.connect():
+            return False
+        self.bot.queue_message(recipient, message)
+        return True
+
+    def close(self, timeout=30):
+        if self.bot is None and self.outbox.empty():
+            return True
+
+        # Messages kept from an earlier session get another go
+        if not self.connect():
+            self.log_unsent()
+            return False
+
+        # Wait for the session to start so the outbox gets sent,
+        # then let disconnect empty the send queue
+        bot, self.bot = self.bot, None
+        bot.closing = True
+        if not bot.ready.wait(timeout):
+            bot.abort()
+            self.log_unsent()
+            return False
+        bot.flush()
+        bot.disconnect(wait=True)
+        return True
+
+    def log_unsent(self):
+        unsent = list(self.outbox.queue)
+        u.log('--Chat session never started, keeping ' + str(len(unsent)) +
+              ' messages for the next one', u.Color.RED)
+        for recipient, message in unsent:
+            u.log('----To ' + str(recipient) + ': ' + message, u.Color.RED)
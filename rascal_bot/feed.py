@@ -0,0 +1,125 @@
+import util as u
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       feed.py
+Author:     @WhitneyOnTheWeb
+
+Incremental reads of a group's feed
+
+- A FeedCursor keeps the high-water mark of the last run, so each run
+  only pulls posts that were created or edited since then
+- Pages through the whole delta instead of a fixed 50 post window
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+stream_fields = 'post_id, message, actor_id, created_time, updated_time'
+page_size = 50                      # posts per FQL page
+ids_per_query = 50                  # post IDs per "IN (...)" lookup
+
+
+'''-------------------------------------
+Class: FeedCursor
+
+High-water mark on post updated_time.
+Posts are "new" when they were updated
+after the mark, or at the mark but not
+read yet. updated_time is bumped on both
+creation and edits
+
+Input:
+    <since>:    unix time to start reading from
+'''
+class FeedCursor(object):
+    def __init__(self, since=0):
+        self.since = int(since)
+        self.seen = set()           # post IDs already read at <since>
+
+    def is_new(self, post):
+        updated = int(post['updated_time'])
+        return updated > self.since or \
+            (updated == self.since and post['post_id'] not in self.seen)
+
+    '''-------------------------------------
+    Method: advance
+
+    Moves the mark up to a post that has
+    been handed out
+    '''
+    def advance(self, post):
+        updated = int(post['updated_time'])
+        if updated > self.since:
+            self.since = updated
+            self.seen = set()
+        self.seen.add(post['post_id'])
+
+
+'''-------------------------------------
+Method: iter_group_posts
+
+Pages through every post in the group feed
+that's new to the cursor, oldest first,
+advancing the cursor as posts are yielded
+
+Input:
+    <graph>:        Graph API client
+    <group_id>:     ID of the FB group
+    <cursor>:       FeedCursor to read from
+    <max_pages>:    optional cap on pages read
+Yields:
+    <dict>:         stream rows with stream_fields
+'''
+def iter_group_posts(graph, group_id, cursor, max_pages=None):
+    offset = 0
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        query = "SELECT " + stream_fields + " FROM stream WHERE " + \
+                "source_id=" + str(group_id) + \
+                " AND updated_time>=" + str(cursor.since) + \
+                " ORDER BY updated_time ASC" + \
+                " LIMIT " + str(page_size) + " OFFSET " + str(offset)
+        rows = u.fql_rows(graph.fql(query=query))
+        pages += 1
+
+        since = cursor.since
+        for post in rows:
+            if cursor.is_new(post):
+                cursor.advance(post)
+                yield post
+
+        if len(rows) < page_size:
+            return
+
+        # Posts sharing the mark's timestamp sort first, so step past
+        # them until the mark moves on
+        offset = offset + page_size if cursor.since == since else 0
+
+
+'''-------------------------------------
+Method: fetch_posts
+
+Looks up specific posts by ID, eg. warned
+posts that didn't change since last run
+
+Input:
+    <graph>:        Graph API client
+    <post_ids>:     IDs of posts to fetch
+Return:
+    <list>:         stream rows for the posts
+                    that still exist
+'''
+def fetch_posts(graph, post_ids):
+    post_ids = list(post_ids)
+    posts = []
+    for i in range(0, len(post_ids), ids_per_query):
+        ids = ', '.join('"' + str(post_id) + '"'
+                        for post_id in post_ids[i:i + ids_per_query])
+        query = "SELECT " + stream_fields + " FROM stream WHERE " + \
+                "post_id IN (" + ids + ")"
+        posts.extend(u.fql_rows(graph.fql(query=query)))
+    return posts
@@ -0,0 +1,173 @@
+import time
+from array import array
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       flood.py
+Author:     @WhitneyOnTheWeb
+
+Per-actor flood detection
+
+- Each actor's last few post times sit in a fixed-size ring buffer, so
+  checking a post is one comparison against the oldest slot
+- Posts past the limit are screened out before validation, so a spam
+  wave doesn't cost a validation, comment lookup and warning per copy
+- Screened posts are held, not dropped: once the window has passed they
+  are read again and validated like any other post
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Class: FloodDetector
+
+Flags actors posting more than <limit>
+posts within <window> seconds
+
+- A ring holds an actor's last <limit>
+  post times, the slot about to be written
+  is the oldest, so a post floods when that
+  one is still inside the window
+- Post times come from created_time, a
+  post no newer than the actor's newest one
+  was counted already and is let through,
+  as are posts older than the window, eg.
+  warned posts read again
+- Posts over the limit are held until
+  their window has passed. The feed has
+  moved past them by then, so the runners
+  read the ones <due> back in, and they're
+  let through
+- Actors that haven't posted for a window
+  can't be flooding, they're dropped when
+  pickled
+
+Input:
+    <limit>:    posts allowed per window
+    <window>:   seconds the limit applies to
+'''
+class FloodDetector(object):
+    version = 0                     # bumped on every change, for BotState
+
+    def __init__(self, limit=5, window=600):
+        self.limit = limit
+        self.window = window
+        self.flagged = []           # actors that flooded, not yet drained
+        self.held = {}              # post_id -> time it's let through
+        self._rings = {}            # actor_id -> [times, next slot, newest]
+
+    def __len__(self):
+        return len(self._rings)
+
+    '''-------------------------------------
+    Method: hit
+
+    Counts one post against an actor
+
+    Input:
+        <actor_id>: who posted
+        <at>:       when it was created
+    Return:
+        <bool>:     True if it's over the limit
+    '''
+    def hit(self, actor_id, at):
+        ring = self._rings.get(actor_id)
+        if ring is None:
+            ring = self._rings[actor_id] = \
+                [array('d', [float('-inf')] * self.limit), 0, float('-inf')]
+        times, slot, newest = ring
+        if at <= newest:
+            return False
+
+        flooding = at - times[slot] < self.window
+        times[slot] = at
+        ring[1] = (slot + 1) % self.limit
+        ring[2] = at
+        self.version += 1
+        return flooding
+
+    '''-------------------------------------
+    Method: screen
+
+    Splits off the posts that are over their
+    actor's limit, or still held
+
+    Input:
+        <posts>:    post dicts with actor_id and
+                    created_time
+    Return:
+        <tuple>:    (kept, flooded) post lists,
+                    both in the order given
+    '''
+    def screen(self, posts, now=None):
+        if now is None:
+            now = time.time()
+        flooded_ids = set()
+        for post in sorted(posts, key=lambda p: p.get('created_time') or 0):
+            post_id = post['post_id']
+            actor_id = post['actor_id']
+            if post_id in self.held:
+                if now < self.held[post_id]:
+                    flooded_ids.add(post_id)
+                else:
+                    del self.held[post_id]
+                    self.version += 1
+                continue
+
+            at = post.get('created_time')
+            if at is None:
+                at = now
+            if now - at >= self.window:
+                continue
+            if self.hit(actor_id, at):
+                flooded_ids.add(post_id)
+                self.held[post_id] = at + self.window
+                self.version += 1
+                if actor_id not in self.flagged:
+                    self.flagged.append(actor_id)
+
+        kept = [post for post in posts if post['post_id'] not in flooded_ids]
+        flooded = [post for post in posts if post['post_id'] in flooded_ids]
+        return kept, flooded
+
+    '''-------------------------------------
+    Method: due
+
+    Held posts whose window has passed, to
+    be read back in and validated
+    '''
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return [post_id for post_id, at in self.held.items() if at <= now]
+
+    def release(self, post_id):
+        if self.held.pop(post_id, None) is not None:
+            self.version += 1
+
+    def drain(self):
+        flagged, self.flagged = self.flagged, []
+        return flagged
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+        idle = [actor_id for actor_id, ring in self._rings.items()
+                if now - ring[2] >= self.window]
+        for actor_id in idle:
+            del self._rings[actor_id]
+        if idle:
+            self.version += 1
+        return len(idle)
+
+    def __getstate__(self):
+        self.prune()
+        return {'limit': self.limit,
+                'window': self.window,
+                'held': self.held,
+                'rings': self._rings}
+
+    def __setstate__(self, state):
+        self.__init__(state['limit'], state['window'])
+        self.held = state.get('held', {})
+        self._rings = state['rings']
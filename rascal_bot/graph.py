@@ -0,0 +1,384 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from facepy.exceptions import HTTPError
+
+import util as u
+from ratelimit import is_throttled
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       graph.py
+Author:     @WhitneyOnTheWeb
+
+Batching helpers layered over the Graph API client
+
+- Lookups that used to be one round trip per post are collected for the
+  whole run, sent together, and split back out per post
+- Deletes from every path go through one executor that batches them,
+  sends batches in parallel and retries transient failures
+- Deleted posts are confirmed gone later in the run, or the next one,
+  instead of sleeping on each delete
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+comment_fields = 'post_id, fromid, id, time'
+ids_per_query = 50                  # post IDs per "IN (...)" query
+batch_size = 50                     # most requests Graph takes per batch
+
+# Graph error codes worth retrying: unknown, service. Throttling is
+# retried by the rate limiter, with its own backoff
+transient_codes = (1, 2)
+
+
+'''-------------------------------------
+Class: CommentBatch
+
+Collects comment lookups for many posts and
+fetches them in a single FQL request
+
+- Up to ids_per_query posts go in one
+  query, larger batches are sent as one
+  FQL multi-query
+- Results are split back out per post
+
+Input:
+    <graph>:    Graph API client
+'''
+class CommentBatch(object):
+    def __init__(self, graph):
+        self.graph = graph
+        self.post_ids = []
+        self._queued = set()
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def add(self, post_id):
+        if post_id not in self._queued:
+            self._queued.add(post_id)
+            self.post_ids.append(post_id)
+
+    '''-------------------------------------
+    Method: fetch
+
+    Sends every queued lookup and empties
+    the batch
+
+    Return:
+        <dict>: post_id -> list of comment rows
+                with comment_fields, every queued
+                post gets an entry
+    '''
+    def fetch(self):
+        post_ids, self.post_ids = self.post_ids, []
+        self._queued = set()
+        comments = dict((post_id, []) for post_id in post_ids)
+        if not post_ids:
+            return comments
+
+        queries = {}
+        for i in range(0, len(post_ids), ids_per_query):
+            ids = ', '.join('"' + str(post_id) + '"'
+                            for post_id in post_ids[i:i + ids_per_query])
+            queries['q' + str(len(queries))] = \
+                "SELECT " + comment_fields + " FROM comment" + \
+                " WHERE post_id IN (" + ids + ")"
+
+        if len(queries) == 1:
+            rows = u.fql_rows(self.graph.fql(query=queries['q0']))
+        else:
+            rows = [row for result in
+                    u.fql_rows(self.graph.fql(query=queries))
+                    for row in result['fql_result_set']]
+
+        # Demultiplex back to the post each comment belongs to
+        for row in rows:
+            comments.setdefault(row['post_id'], []).append(row)
+        return comments
+
+
+'''-------------------------------------
+Method: post_comment
+
+Comments on a post with either client,
+facebook SDK or facepy
+
+Input:
+    <graph>:    Graph API client
+    <post_id>:  post to comment on
+    <message>:  comment text
+'''
+def post_comment(graph, post_id, message):
+    if hasattr(graph, 'put_object'):
+        return graph.put_object(post_id, "comments", message=message)
+    return graph.post(str(post_id) + "/comments", message=message)
+
+
+'''-------------------------------------
+Method: is_transient
+
+Checks if a failed Graph call is worth
+retrying: connection errors, and errors
+the API flags as transient
+
+Input:
+    <error>:    exception from a Graph call
+Return:
+    <bool>:     True if the call can be retried
+'''
+def is_transient(error):
+    if isinstance(error, (HTTPError, IOError)):
+        return True
+    if getattr(error, 'is_transient', False):
+        return True
+    return getattr(error, 'code', None) in transient_codes
+
+
+class DeleteError(Exception):
+    pass
+
+
+'''-------------------------------------
+Class: DeleteReport
+
+Per-ID outcome of a DeleteExecutor run
+
+- <deleted>:    IDs the API confirmed deleting
+- <failed>:     ID -> exception for the rest
+'''
+class DeleteReport(object):
+    def __init__(self):
+        self.deleted = []
+        self.failed = {}
+
+    def __len__(self):
+        return len(self.deleted) + len(self.failed)
+
+    def ok(self, object_id):
+        return object_id not in self.failed
+
+
+'''-------------------------------------
+Class: DeleteExecutor
+
+Single queue for every post and comment
+delete in a run
+
+- Deletes go out in Graph batch requests
+  of up to batch_size, with <workers>
+  batches in flight at once
+- Transient failures are retried with
+  exponential backoff, up to <retries>
+  more times. Throttling is left to the
+  rate limiter
+
+Input:
+    <graph>:    Graph API client
+    <workers>:  batches sent in parallel
+    <retries>:  retries for transient errors
+    <backoff>:  seconds before the first retry
+'''
+class DeleteExecutor(object):
+    def __init__(self, graph, workers=4, retries=2, backoff=1):
+        self.graph = graph
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = []
+        self._queued = set()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, object_id):
+        if object_id not in self._queued:
+            self._queued.add(object_id)
+            self.queue.append(object_id)
+
+    '''-------------------------------------
+    Method: run
+
+    Sends every queued delete and empties
+    the queue
+
+    Return:
+        <DeleteReport>: outcome for each ID
+    '''
+    def run(self):
+        pending, self.queue = self.queue, []
+        self._queued = set()
+        report = DeleteReport()
+
+        attempt = 0
+        while pending:
+            chunks = [pending[i:i + batch_size]
+                      for i in range(0, len(pending), batch_size)]
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                outcomes = list(pool.map(self._delete_chunk, chunks))
+
+            pending = []
+            for outcome in outcomes:
+                for object_id, error in outcome:
+                    if error is None:
+                        report.deleted.append(object_id)
+                    elif attempt < self.retries and is_transient(error):
+                        pending.append(object_id)
+                    else:
+                        report.failed[object_id] = error
+
+            if pending:
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+        return report
+
+    '''-------------------------------------
+    Method: _delete_chunk
+
+    Deletes one chunk of IDs, through a Graph
+    batch request when the client has them
+
+    Return:
+        <list>: (ID, exception or None) pairs
+    '''
+    def _delete_chunk(self, object_ids):
+        if not hasattr(self.graph, 'batch'):
+            return [(object_id, self._delete_one(object_id))
+                    for object_id in object_ids]
+
+        requests = [{'method': 'DELETE', 'relative_url': str(object_id)}
+                    for object_id in object_ids]
+        try:
+            responses = list(self.graph.batch(requests))
+        except Exception as e:
+            return [(object_id, e) for object_id in object_ids]
+
+        outcome = []
+        for i, object_id in enumerate(object_ids):
+            response = responses[i] if i < len(responses) else None
+            if isinstance(response, Exception):
+                outcome.append((object_id, response))
+            elif response is False or response is None:
+                outcome.append((object_id, DeleteError(
+                    'Could not delete "%s"' % object_id)))
+            else:
+                outcome.append((object_id, None))
+        return outcome
+
+    def _delete_one(self, object_id):
+        try:
+            if hasattr(self.graph, 'delete_object'):
+                self.graph.delete_object(id=object_id)
+            else:
+                self.graph.delete(object_id)
+        except Exception as e:
+            return e
+        return None
+
+
+'''-------------------------------------
+Class: VerificationQueue
+
+Posts waiting for confirmation that a
+delete went through. Pickled between runs,
+so anything not due yet carries over
+
+- Posts are due <delay> seconds after
+  they were deleted
+- Due posts are looked up in parallel
+- A post still there, or that couldn't be
+  looked up, after <max_checks> lookups is
+  reported as a failure
+
+Input:
+    <delay>:        seconds to let a delete
+                    propagate before checking
+    <max_checks>:   lookups before giving up
+    <workers>:      lookups sent in parallel
+'''
+class VerificationQueue(object):
+    GONE, EXISTS, UNKNOWN = range(3)
+    version = 0                         # bumped on every change, for BotState
+
+    def __init__(self, delay=3, max_checks=3, workers=4):
+        self.delay = delay
+        self.max_checks = max_checks
+        self.workers = workers
+        self.pending = OrderedDict()    # post_id -> [deleted at, checks]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, post_id, now=None):
+        self.pending[post_id] = [time.time() if now is None else now, 0]
+        self.version += 1
+
+    '''-------------------------------------
+    Method: due_by
+
+    Return:
+        <float>:    time every queued post is
+                    due by, None if it's empty
+    '''
+    def due_by(self):
+        if not self.pending:
+            return None
+        return max(deleted for deleted, _ in self.pending.values()) + \
+            self.delay
+
+    '''-------------------------------------
+    Method: check
+
+    Looks up every post that's due
+
+    Input:
+        <graph>:    Graph API client
+        <now>:      defaults to current time
+    Return:
+        <tuple>:    (confirmed, failed) lists of
+                    post IDs, both dropped from
+                    the queue
+    '''
+    def check(self, graph, now=None):
+        if now is None:
+            now = time.time()
+        due = [post_id for post_id, (deleted, _) in self.pending.items()
+               if now - deleted >= self.delay]
+        if not due:
+            return [], []
+        self.version += 1
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            states = list(pool.map(lambda post_id: self._lookup(graph, post_id),
+                                   due))
+
+        confirmed, failed = [], []
+        for post_id, state in zip(due, states):
+            if state == self.GONE:
+                confirmed.append(post_id)
+                del self.pending[post_id]
+            else:
+                self.pending[post_id][1] += 1
+                if self.pending[post_id][1] >= self.max_checks:
+                    failed.append(post_id)
+                    del self.pending[post_id]
+        return confirmed, failed
+
+    def _lookup(self, graph, post_id):
+        try:
+            if hasattr(graph, 'get_object'):
+                graph.get_object(id=post_id)
+            else:
+                graph.get(str(post_id))
+        except Exception as e:
+            # Other errors mean the post can't be read
+            if is_transient(e) or is_throttled(e):
+                return self.UNKNOWN
+            return self.GONE
+        return self.EXISTS
@@ -0,0 +1,307 @@
+import json
+import os
+import threading
+import time
+
+import util as u
+from cache import PostCache
+from deadline import DeadlineQueue
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       journal.py
+Author:     @WhitneyOnTheWeb
+
+Append-only journal of moderation events
+
+- Warned and valid post state is a snapshot plus the journal written
+  since, so each action costs one appended line instead of re-saving
+  whole caches
+- Compaction folds the journal into a new snapshot in the store, with
+  warned and valid posts saved as the store's per-post rows
+- The journal doubles as an audit trail of what the bot did, and a run
+  that crashes loses nothing it already journaled
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+WARNED, VALIDATED, DELETED, UNWARNED = \
+    'warned', 'validated', 'deleted', 'unwarned'
+EVENTS = (WARNED, VALIDATED, DELETED, UNWARNED)
+
+
+'''-------------------------------------
+Class: Snapshot
+
+Compacted state, everything up to and
+including journal event <seq>. Only the
+sequence number is saved under the
+snapshot's name, the posts are saved as
+their own caches
+'''
+class Snapshot(object):
+    def __init__(self, seq, warned=None, valid=None):
+        self.seq = seq
+        self.warned = warned        # post_id -> time warned
+        self.valid = valid          # (post_id, last seen) pairs
+
+
+'''-------------------------------------
+Method: load_snapshot
+
+Reads a snapshot back from the store
+
+Input:
+    <name>:         store name for snapshots
+    <valid_size>:   most valid post IDs kept
+    <valid_ttl>:    seconds valid IDs are kept
+Return:
+    <Snapshot>:     None if there isn't one
+'''
+def load_snapshot(name, valid_size=20000, valid_ttl=2592000):
+    snapshot = u.load_cache(name, None)
+    if snapshot is None or snapshot.warned is not None:
+        return snapshot             # none yet, or one with its posts inline
+    snapshot.warned = u.load_cache(name + '_warned', {})
+    snapshot.valid = u.load_cache(name + '_valid',
+                                  PostCache(valid_size, valid_ttl)).items()
+    return snapshot
+
+
+'''-------------------------------------
+Class: WarnedPosts
+
+post_id -> time warned, journaling every
+change made to it and keeping the grace
+period deadlines in step
+'''
+class WarnedPosts(dict):
+    def __init__(self, journal, *args):
+        dict.__init__(self, *args)
+        self.journal = journal
+        self.deadlines = None       # DeadlineQueue, set once loaded
+
+    def __setitem__(self, post_id, warned_at):
+        dict.__setitem__(self, post_id, warned_at)
+        if self.deadlines is not None:
+            self.deadlines.push(post_id, warned_at)
+        self.journal.append(WARNED, post_id, warned_at)
+
+    def __delitem__(self, post_id):
+        dict.__delitem__(self, post_id)
+        if self.deadlines is not None:
+            self.deadlines.discard(post_id)
+        self.journal.append(UNWARNED, post_id)
+
+    def pop(self, post_id, *default):
+        if post_id not in self:
+            return dict.pop(self, post_id, *default)
+        warned_at = dict.__getitem__(self, post_id)
+        del self[post_id]
+        return warned_at
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+'''-------------------------------------
+Class: ValidPosts
+
+PostCache that journals the posts added
+to it. Lookups that only refresh an entry
+aren't journaled, they're saved with the
+next snapshot
+'''
+class ValidPosts(PostCache):
+    def __init__(self, journal, max_size, ttl):
+        PostCache.__init__(self, max_size, ttl)
+        self.journal = journal
+
+    def add(self, post_id, now=None):
+        if now is None:
+            now = time.time()
+        PostCache.add(self, post_id, now)
+        if self.journal is not None:
+            self.journal.append(VALIDATED, post_id, now)
+
+
+'''-------------------------------------
+Class: ModerationJournal
+
+Snapshot + journal backed warned and valid
+post state
+
+- Journal lines are JSON with a sequence
+  number, the snapshot remembers the last
+  one it includes, so replay after a crash
+  mid-compaction never applies one twice
+- A torn last line from a crash mid-write
+  is skipped
+- Warned posts' grace period deadlines are
+  rebuilt from the loaded state
+
+Input:
+    <path>:             journal file
+    <snapshot_name>:    store name for snapshots
+    <compact_every>:    events between compactions
+    <valid_size>:       most valid post IDs kept
+    <valid_ttl>:        seconds valid IDs are kept
+    <grace>:            seconds warned posts get
+'''
+class ModerationJournal(object):
+    def __init__(self, path, snapshot_name, compact_every=1000,
+                 valid_size=20000, valid_ttl=2592000, grace=86400):
+        self.grace = grace
+        self.path = path
+        self.snapshot_name = snapshot_name
+        self.compact_every = compact_every
+        self.seq = 0
+        self.pending = 0            # events since the last compaction
+        self.warned = WarnedPosts(self)
+        self.valid = ValidPosts(self, valid_size, valid_ttl)
+        self._file = None
+        self._replaying = False
+        self._lock = threading.Lock()
+
+    '''-------------------------------------
+    Method: load
+
+    Reads the last snapshot, replays the
+    journal on top and opens it for appends
+
+    Input:
+        <legacy>:   function returning (warned
+                    dict, valid PostCache) to start
+                    from when there's no snapshot
+    '''
+    def load(self, legacy=None):
+        snapshot = load_snapshot(self.snapshot_name, self.valid.max_size,
+                                 self.valid.ttl)
+        self._replaying = True
+        try:
+            if snapshot is not None:
+                self.seq = snapshot.seq
+                dict.update(self.warned, snapshot.warned)
+                for post_id, seen in snapshot.valid:
+                    self.valid.add(post_id, seen)
+            elif legacy is not None:
+                warned, valid = legacy()
+                dict.update(self.warned, warned)
+                for post_id, seen in valid.items():
+                    self.valid.add(post_id, seen)
+            self._replay()
+        finally:
+            self._replaying = False
+        self.warned.deadlines = DeadlineQueue.from_warned(self.warned,
+                                                          self.grace)
+        self._file = open(self.path, 'a')
+        return self
+
+    @property
+    def deadlines(self):
+        return self.warned.deadlines
+
+    def _replay(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue        # torn write
+                if event['seq'] <= self.seq:
+                    continue
+                self.apply(event)
+                self.seq = event['seq']
+                self.pending += 1
+
+    '''-------------------------------------
+    Method: apply
+
+    Applies one event to the in-memory state
+    '''
+    def apply(self, event):
+        post_id = event['post_id']
+        if event['event'] == WARNED:
+            dict.__setitem__(self.warned, post_id, event['at'])
+        elif event['event'] == VALIDATED:
+            self.valid.add(post_id, event['at'])
+        elif event['event'] in (DELETED, UNWARNED):
+            dict.pop(self.warned, post_id, None)
+
+    '''-------------------------------------
+    Method: append
+
+    Writes one event to the journal
+
+    Input:
+        <event>:    one of EVENTS
+        <post_id>:  post it's about
+        <at>:       event's own timestamp, eg.
+                    when the post was warned
+    '''
+    def append(self, event, post_id, at=None):
+        if self._replaying:
+            return
+        with self._lock:
+            self.seq += 1
+            self.pending += 1
+            line = json.dumps({'seq': self.seq, 'time': time.time(),
+                               'event': event, 'post_id': post_id,
+                               'at': at})
+            if self._file is not None:
+                self._file.write(line + '\n')
+                self._file.flush()
+
+    '''-------------------------------------
+    Method: deleted
+
+    Records a post as deleted, dropping it
+    from the warned posts
+    '''
+    def deleted(self, post_id):
+        if post_id in self.warned:
+            dict.pop(self.warned, post_id)
+        if self.deadlines is not None:
+            self.deadlines.discard(post_id)
+        self.append(DELETED, post_id)
+
+    def should_compact(self):
+        return self.pending >= self.compact_every
+
+    '''-------------------------------------
+    Method: compact
+
+    Saves a snapshot of the current state,
+    then starts the journal over
+
+    - The posts go first, as a dict and a
+      PostCache, so SQLiteStore only writes
+      the rows that changed
+    - The sequence number goes last. A crash
+      before it replays events the saved
+      posts already have, which ends up in
+      the same state
+    '''
+    def compact(self):
+        with self._lock:
+            valid = PostCache(self.valid.max_size, self.valid.ttl)
+            for post_id, seen in self.valid.items():
+                valid.add(post_id, seen)
+            u.save_cache(self.snapshot_name + '_warned', dict(self.warned))
+            u.save_cache(self.snapshot_name + '_valid', valid)
+            u.save_cache(self.snapshot_name, Snapshot(self.seq))
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, 'w')
+            self.pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,294 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import util as u
+from feed import fetch_posts, ids_per_query, iter_group_posts
+from graph import CommentBatch, post_comment
+from actors import WARNINGS
+from rules import rules_for, warning_comment
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       moderator.py
+Author:     @WhitneyOnTheWeb
+
+Async moderation pass over a group's feed
+
+- One event loop per run fetches, validates and acts on posts
+  concurrently, instead of one Graph round trip after another
+- Graph calls are blocking, so they run on a thread pool, with a cap on
+  how many are in flight at once
+- Per-post decisions are the same as the sync loop in rascal.sub_group
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Class: AsyncModerator
+
+Runs the warn / grace period / delete /
+un-warn pass for one run
+
+- Deletes are only submitted to <deletes>,
+  the caller runs them with the rest
+- <already_warned> and <valid_posts> are
+  updated in place
+
+Input:
+    <graph>:            Graph API client
+    <rule_set>:         PostRuleSet to validate with
+    <roster>:           AdminRoster, admins are skipped
+    <bot_id>:           bot's user ID
+    <already_warned>:   post_id -> time warned
+    <valid_posts>:      PostCache of valid posts
+    <deletes>:          DeleteExecutor for the run
+    <max_in_flight>:    Graph calls running at once
+    <workers>:          processes for validation
+    <now>:              run time, defaults to now
+    <ignored_post_ids>:     posts to skip
+    <ignore_source_ids>:    actors to skip
+    <memo>:             VerdictCache, unchanged
+                        posts reuse their verdict
+    <spam_index>:       NearDuplicateIndex every
+                        non-admin post is checked in
+    <actors>:           ActorStats to count posts
+                        and warnings in, deletes
+                        are counted once they
+                        go through
+    <flood>:            FloodDetector, posts over
+                        the limit are held until
+                        their window has passed
+'''
+class AsyncModerator(object):
+    def __init__(self, graph, rule_set, roster, bot_id, already_warned,
+                 valid_posts, deletes, max_in_flight=8,
+                 workers=1, now=None, ignored_post_ids=(),
+                 ignore_source_ids=(), memo=None, spam_index=None,
+                 actors=None, flood=None):
+        self.graph = graph
+        self.rule_set = rule_set
+        self.roster = roster
+        self.bot_id = int(bot_id)
+        self.already_warned = already_warned
+        self.valid_posts = valid_posts
+        self.deletes = deletes
+        self.max_in_flight = max_in_flight
+        self.workers = workers
+        self.now = time.time() if now is None else now
+        self.ignored_post_ids = ignored_post_ids
+        self.ignore_source_ids = ignore_source_ids
+        self.memo = memo
+        self.spam_index = spam_index
+        self.actors = actors
+        self.flood = flood
+
+        self.processed_posts = []
+        self.to_remove = {}         # post_id -> actor_id, being deleted
+        self._pool = None
+        self._limit = None
+
+    '''-------------------------------------
+    Method: call
+
+    Runs a blocking Graph call on the pool,
+    waiting for a slot if max_in_flight
+    calls are already out
+    '''
+    async def call(self, func, *args, **kwargs):
+        async with self._limit:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._pool, functools.partial(func, *args, **kwargs))
+
+    '''-------------------------------------
+    Method: run
+
+    Fetches the posts new to <cursor>, plus
+    warned posts that didn't change, then
+    validates and acts on all of them
+
+    Input:
+        <group_id>: ID of the FB group
+        <cursor>:   FeedCursor, advanced in place
+        <post_ids>: posts to read instead of the
+                    feed, eg. from webhooks
+        <due_ids>:  warned posts to check, all
+                    of them if None
+    Return:
+        <tuple>:    (processed_posts, to_remove),
+                    the IDs read this run and the
+                    posts submitted for deletion,
+                    mapped to who posted them
+    '''
+    async def run(self, group_id, cursor, post_ids=None, due_ids=None):
+        self._limit = asyncio.Semaphore(self.max_in_flight)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            self._pool = pool
+            group_posts = await self.fetch(group_id, cursor, post_ids,
+                                           due_ids)
+            pending_posts = self.pending(group_posts)
+
+            # Validation is CPU bound, it doesn't count against Graph calls
+            loop = asyncio.get_running_loop()
+            verdicts = await loop.run_in_executor(
+                pool, self.rule_set.validate_batch, pending_posts,
+                self.workers, self.memo)
+            if self.actors is not None:
+                self.actors.observe(pending_posts, verdicts)
+
+            # One comment lookup for every post being warned or un-warned
+            batch = CommentBatch(self.graph)
+            for post, verdict in zip(pending_posts, verdicts):
+                warned = post['post_id'] in self.already_warned
+                if bool(rules_for(verdict)) != warned:
+                    batch.add(post['post_id'])
+            comments = await self.call(batch.fetch)
+
+            await asyncio.gather(*[
+                self.handle(post, verdict, comments.get(post['post_id'], []))
+                for post, verdict in zip(pending_posts, verdicts)])
+        self._pool = None
+        return self.processed_posts, self.to_remove
+
+    '''-------------------------------------
+    Method: fetch
+
+    Reads the feed delta, the warned posts
+    and the held flood posts that are due at
+    the same time, the delta wins for posts
+    that show up in both
+    '''
+    async def fetch(self, group_id, cursor, post_ids=None, due_ids=None):
+        if post_ids is None:
+            changed = self.call(lambda: list(iter_group_posts(
+                self.graph, group_id, cursor)))
+        else:
+            changed = self.call(fetch_posts, self.graph, post_ids)
+
+        warned = list(self.already_warned if due_ids is None else due_ids)
+        held = self.flood.due(self.now) if self.flood is not None else []
+        warned.extend(set(held).difference(warned))
+        chunks = [warned[i:i + ids_per_query]
+                  for i in range(0, len(warned), ids_per_query)]
+        results = await asyncio.gather(
+            changed,
+            *[self.call(fetch_posts, self.graph, chunk) for chunk in chunks])
+
+        group_posts = results[0]
+        u.log('--New or edited posts: ' + str(len(group_posts)), u.Color.BOLD)
+        fetched_ids = set(post['post_id'] for post in group_posts)
+        for posts in results[1:]:
+            group_posts.extend(post for post in posts
+                               if post['post_id'] not in fetched_ids)
+
+        # Held posts that didn't come back are gone
+        fetched_ids = set(post['post_id'] for post in group_posts)
+        for post_id in held:
+            if post_id not in fetched_ids:
+                self.flood.release(post_id)
+        return group_posts
+
+    '''-------------------------------------
+    Method: pending
+
+    Records every post as processed, screens
+    out floods, checks non-admin posts for
+    duplicates and returns the ones that need
+    validating
+    '''
+    def pending(self, group_posts):
+        screened_posts = []
+        for post in group_posts:
+            post_id = post['post_id']
+            actor_id = post['actor_id']
+            self.processed_posts.append(post_id)
+
+            # Ignore mods and certain posts
+            if post_id in self.ignored_post_ids or \
+                    actor_id in self.ignore_source_ids or \
+                    self.roster.is_admin(actor_id):
+                continue
+            screened_posts.append(post)
+
+        if self.flood is not None:
+            screened_posts, flooded_posts = self.flood.screen(screened_posts,
+                                                              self.now)
+            for post in flooded_posts:
+                u.log('--Flood: ' + str(post['post_id']), u.Color.RED)
+                if u.flood_delete:
+                    self.flood.release(post['post_id'])
+                    self.deletes.submit(post['post_id'])
+                    self.to_remove[post['post_id']] = post['actor_id']
+
+        if self.spam_index is not None:
+            self.spam_index.check(screened_posts, self.now)
+        return [post for post in screened_posts
+                if post['post_id'] not in self.valid_posts]
+
+    '''-------------------------------------
+    Method: handle
+
+    Acts on one post, logging anything that
+    goes wrong so it doesn't take the rest of
+    the run down with it
+
+    Input:
+        <comments>: the post's comment rows, only
+                    looked up for posts being
+                    warned or un-warned
+    '''
+    async def handle(self, post, verdict, comments=()):
+        try:
+            await self.act(post, verdict, comments)
+        except Exception as e:
+            u.log('--Failed: ' + str(post['post_id']) + ' - ' + str(e) +
+                  ' - ' + str(type(e)), u.Color.RED)
+
+    '''-------------------------------------
+    Method: act
+
+    Acts on one post's verdict: warn it, wait
+    out or enforce its grace period, or cache
+    it as valid and take back any warning
+    '''
+    async def act(self, post, verdict, comments):
+        post_id = post['post_id']
+        actor_id = post['actor_id']
+        violations = rules_for(verdict)
+
+        # Valid post, high risk actors get rechecked
+        if not violations:
+            if self.actors is None or \
+                    not self.actors.is_high_risk(actor_id):
+                self.valid_posts.add(post_id)
+            if post_id in self.already_warned:
+                for comment in comments:
+                    if int(comment['fromid']) == self.bot_id:
+                        self.deletes.submit(comment['id'])
+                del self.already_warned[post_id]
+                u.log('--Warning removed: ' + str(post_id), u.Color.GREEN)
+            return
+
+        # Already warned, delete once the grace period is up
+        if post_id in self.already_warned:
+            if u.time_limit < self.now - self.already_warned[post_id]:
+                u.log('--Delete: ' + str(post_id), u.Color.RED)
+                self.deletes.submit(post_id)
+                self.to_remove[post_id] = actor_id
+            return
+
+        # Make sure we haven't warned them before
+        for comment in comments:
+            if int(comment['fromid']) == self.bot_id:
+                u.log('--Previously warned: ' + str(post_id))
+                self.already_warned[post_id] = comment['time']
+                return
+
+        await self.call(post_comment, self.graph, post_id,
+                        warning_comment(violations))
+        self.already_warned[post_id] = self.now
+        u.log('--WARNED: ' + str(post_id), u.Color.RED)
+        if self.actors is not None:
+            self.actors.record(actor_id, WARNINGS, self.now)
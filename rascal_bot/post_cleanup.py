@@ -12,6 +12,13 @@ import time
 import facepy
 
 import util as u
+from cache import PostCache
+from clients import graph_client, log_connection_stats
+from feed import FeedCursor, fetch_posts, iter_group_posts
+from graph import DeleteExecutor, is_transient
+from ratelimit import is_throttled
+from roster import AdminRoster
+from rules import PostRuleSet, rules_for
 
 '''----------------------------------------------------------------------------
 Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
@@ -37,6 +44,9 @@ Global Variables
 time_limit = 86400                  # 60 * 60 * 24 (s --> h)
 warned_db = 'fb_subs_cache'         # warned posts cache
 valid_db = 'fb_subs_valid_cache'    # valid posts cache
+cursor_db = 'fb_cleanup_cursor'     # feed high-water mark
+retry_db = 'fb_cleanup_retry'       # posts whose deletes failed
+roster_db = 'fb_cleanup_roster'     # admin roster, bot included
 
 tag_delimiters = ('*', '-')         # leading symbols for post tags
 post_tags = u.load_list('post_tags.txt')
@@ -44,40 +54,45 @@ post_tags = u.load_list('post_tags.txt')
 bot_delimiters = ('!', '#')         # leading symbols for bot tags
 bot_tags = u.load_list('bot_tags.txt')
 
+post_rules = PostRuleSet(post_tags)  # compiled once at load time
+
 # Booleans
 dry_run = False                     # disable deletion dry-run
 extend_key = False                  # is extended key
 
+admin_roster = None                 # loaded once per process
+
 
 # Manually update API token
 def update_token(token):
-    log("Updating token", Color.BLUE)
-    graph = facepy.GraphAPI(token)
+    u.log("Updating token", u.Color.BLUE)
+    graph = graph_client(token)
     try:
         graph.get('me/posts')
-        props_dict = load_properties()
+        props_dict = u.load_properties()
         props_dict['sublets_oauth_access_token'] = token
         props_dict['access_token_expiration'] = time.time() + 7200  # 2 hours buffer
-        save_properties(props_dict)
-        log("Token updated, you should now extend it", Color.BLUE)
+        u.save_properties(props_dict)
+        u.log("Token updated, you should now extend it", u.Color.BLUE)
     except Exception as e:
-        log("API error - " + e.message, Color.RED)
+        u.log("API error - " + str(e), u.Color.RED)
 
 
 # Set a property by name
 def update_prop(prop_name, value):
     if prop_name in ("sublets_oauth_access_token", "access_token_expiration"):
-        log("Please use -u or -e to update or extend tokens", Color.RED)
+        u.log("Please use -u or -e to update or extend tokens", u.Color.RED)
         return
-    log("Setting \"" + prop_name + "\" to \"" + value + "\"", Color.BLUE)
-    props_dict = load_properties()
+    u.log("Setting \"" + prop_name + "\" to \"" + value + "\"", u.Color.BLUE)
+    props_dict = u.load_properties()
     if prop_name not in props_dict.keys():
-        input_response = raw_input("This key doesn't exist, do you want to add it? Y/N")
+        input_response = input("This key doesn't exist, do you want to add "
+                               "it? Y/N")
         if input_response.lower() != "y":
             return
     props_dict[prop_name] = value
-    save_properties(props_dict)
-    log("Done setting \"" + prop_name + "\"", Color.BLUE)
+    u.save_properties(props_dict)
+    u.log("Done setting \"" + prop_name + "\"", u.Color.BLUE)
 
 
 # Method for checking tag validity
@@ -89,7 +104,7 @@ def get_tags_old(message_text):
     split = message_text.strip().split(" ")
 
     # Check that they're on the first line
-    if not p.match(split[0]) and split[0] not in allowed_leading_characters:
+    if not p.match(split[0]) and split[0] not in tag_delimiters:
         return None
 
     tags_list = [l.lower()[1:-1] for l in split for m in (p.search(l),) if m]
@@ -101,68 +116,33 @@ def get_tags_old(message_text):
 
 # Method for checking tag validity
 def get_tags(message_text):
-    p = re.compile(
-        r"^(-|\*| )*(([\(\[\{])(.+)([\)\]\}]))+(:)?(\s|$)",
-        re.IGNORECASE)
-
-    # Insert space between two consecutive tags
-    message_text = re.sub(r"([\)\]\}])([\(\[\{])", r"\1 \2", message_text)
-    firstline_split = message_text.split("\n")[0].strip().split()
-
-    # Check that they're on the first line
-    if not p.match(firstline_split[0]) and firstline_split[0] not in allowed_leading_characters:
-        return None
-
-    tags_list = [re.sub(r"^(-|\*| )*", "", full_tag.lower())[1:(-2 if full_tag[-1] == ":" else -1)] for full_tag in
-                 firstline_split for matched in (p.search(full_tag),) if matched]
-
-    # Should really learn how to do python's builtin logging...
-    # log('--Tags: ' + ', '.join(tags_list), Color.BLUE)
-
-    if len(tags_list) > 0 and set(tags_list).issubset(allowed_tags):
-        return tags_list
-    else:
-        return None
+    return post_rules.get_tags(message_text)
 
 
 # Can't have "rooming" AND "offering". These people are usually just misusing the rooming tag
 def validate_tags(tags):
-    if not tags:
-        return False
-    elif "rooming" in tags and "offering" in tags:
-        return False
-    else:
-        return True
+    return post_rules.validate_tags(tags)
 
 
 # Method for checking if pricing reference is there
 def check_price_validity(message_text):
-    p = re.compile(
-        "(\$)|((\d)+( )?((per)|(/)|(a))( )?(/)?((month)|(mon)|(mo))(\s)?)",
-        re.IGNORECASE)
-
-    if re.search(p, message_text) is not None:
-        return True
-    else:
-        return False
+    return post_rules.has_price(message_text)
 
 
 # Checking if there's a parking tag
 def check_for_parking_tag(message_text):
-    p = re.compile(
-        "^(-|\*| )*([\(\[\{])(parking)([\)\]\}])(:)?(\s|$)",
-        re.IGNORECASE)
+    return post_rules.has_exempt_tag(message_text)
 
-    if re.search(p, message_text):
-        return True
-    else:
-        return False
+
+# Validate a batch of post dicts, returns one verdict bitmask per post
+def validate_batch(posts, workers=1):
+    return post_rules.validate_batch(posts, workers)
 
 
 # Method for extending access token
 def extend_access_token(saved_props, token, sublets_api_id,
                         sublets_secret_key):
-    log("Extending access token", Color.BOLD)
+    u.log("Extending access token", u.Color.BOLD)
     access_token, expires_at = facepy.get_extended_access_token(
         token,
         sublets_api_id,
@@ -170,59 +150,66 @@ def extend_access_token(saved_props, token, sublets_api_id,
     )
     new_token = access_token
     unixtime = time.mktime(expires_at.timetuple())
-    print time.mktime(expires_at.timetuple())
+    print(unixtime)
     saved_props['sublets_oauth_access_token'] = new_token
     saved_props['access_token_expiration'] = unixtime
-    log("Token extended", Color.BOLD)
+    u.log("Token extended", u.Color.BOLD)
 
 
-# Method for retrieving user ID's of admins in group, ignoring bot ID
-def retrieve_admin_ids(group_id, auth_token):
-    # Retrieve the uids via FQL query
-    graph = facepy.GraphAPI(auth_token)
-    admins_query = \
-        "SELECT uid FROM group_member WHERE gid=" + group_id + " AND" + \
-        " administrator"
-    admins = graph.fql(query=admins_query)
+# Loads the admin roster once per process, refreshing it only when stale
+def load_admin_roster(group_id, auth_token, graph=None):
+    global admin_roster
+    if admin_roster is None:
+        admin_roster = AdminRoster(u.roster_ttl, u.member_ttl)
+        admin_roster = u.load_cache(roster_db, admin_roster)
 
-    # Parse out the uids from the response
-    admins_list = [admin['uid'] for admin in admins]
+    if admin_roster.is_stale():
+        # Retrieve the uids via FQL query
+        if graph is None:
+            graph = graph_client(auth_token)
 
-    # Update the admin_ids in our properties
-    saved_props = load_properties()
-    saved_props['admin_ids'] = admins_list
-    save_properties(saved_props)
+        # Update the admin_ids in our properties, only if they changed
+        if admin_roster.refresh(graph, group_id):
+            saved_props = u.load_properties()
+            saved_props['admin_ids'] = sorted(admin_roster.admin_ids)
+            u.save_properties(saved_props)
+        u.save_cache(roster_db, admin_roster)
 
-    return admins_list
+    return admin_roster
+
+
+# Method for retrieving user ID's of admins in group
+def retrieve_admin_ids(group_id, auth_token):
+    return sorted(load_admin_roster(group_id, auth_token).admin_ids)
 
 
 # Delete posts older than 30 days old
-def delete_old_posts(graph, group_id, admin_ids):
+def delete_old_posts(graph, group_id, admin_ids, deletes):
     old_date = int(time.time()) - 2592000  # 30 days in seconds
     old_query = "SELECT post_id, message, actor_id FROM stream WHERE " + \
                 "source_id=" + group_id + " AND created_time<" + str(old_date) + \
                 " LIMIT 300"
-    log("Getting posts older than:")
-    log("\t" + datetime.datetime.fromtimestamp(old_date)
-        .strftime('%Y-%m-%d %H:%M:%S'))
+    u.log("Getting posts older than:")
+    u.log("\t" + datetime.datetime.fromtimestamp(old_date)
+          .strftime('%Y-%m-%d %H:%M:%S'))
     posts = graph.fql(query=old_query)
     deleted_posts_count = 0
-    for post in posts["data"]:
+    for post in u.fql_rows(posts):
         post_id = post['post_id']
         actor_id = post['actor_id']
         if int(actor_id) in admin_ids:
-            # log('\n--Ignored post: ' + post_id, Color.BLUE)
+            # u.log('\n--Ignored post: ' + post_id, u.Color.BLUE)
             continue
-        print post_id
-        graph.delete(post_id)
+        print(post_id)
+        deletes.submit(post_id)
         deleted_posts_count += 1
-    log("Deleted " + str(deleted_posts_count) + " old posts", Color.RED)
+    u.log("Queued " + str(deleted_posts_count) + " old posts", u.Color.RED)
 
 
 # Main runner method
 def sub_group():
     # Load the properties
-    saved_props = load_properties()
+    saved_props = u.load_properties()
 
     # Access token
     sublets_oauth_access_token = saved_props['sublets_oauth_access_token']
@@ -239,19 +226,12 @@ def sub_group():
     # ID of the FB group
     group_id = saved_props['group_id']
 
-    # IDs of admins (unused right now, might remove later)
-    admin_ids = saved_props['admin_ids']
-
-    # FQL query for the group
-    group_query = "SELECT post_id, message, actor_id FROM stream WHERE " + \
-                  "source_id=" + group_id + " LIMIT 50"
-
     # Get current time
     now_time = time.time()
 
     # For logging purposes
-    log("CURRENT CST TIMESTAMP: " + datetime.datetime.fromtimestamp(
-        now_time - 21600).strftime('%Y-%m-%d %H:%M:%S'), Color.UNDERLINE)
+    u.log("CURRENT CST TIMESTAMP: " + datetime.datetime.fromtimestamp(
+          now_time - 21600).strftime('%Y-%m-%d %H:%M:%S'), u.Color.UNDERLINE)
 
     # Make sure the access token is still valid
     if access_token_expiration < now_time:
@@ -259,9 +239,10 @@ def sub_group():
 
     # Warn if the token's expiring soon
     if access_token_expiration - now_time < 604800:
-        log("Warning - access token expires in less than a week", Color.RED)
-        log("-- Expires on " + datetime.datetime.fromtimestamp(
-            access_token_expiration).strftime('%Y-%m-%d %H:%M:%S'))
+        u.log("Warning - access token expires in less than a week",
+              u.Color.RED)
+        u.log("-- Expires on " + datetime.datetime.fromtimestamp(
+              access_token_expiration).strftime('%Y-%m-%d %H:%M:%S'))
 
         # If you want it to automatically when it's close to exp.
         global extend_key
@@ -273,33 +254,49 @@ def sub_group():
                             sublets_secret_key)
 
     # Log in, try to get posts
-    graph = facepy.GraphAPI(sublets_oauth_access_token)
-
-    # Make our first request, get the group posts
-    group_posts = graph.fql(query=group_query)
-
-    # Load the pickled cache of valid posts
-    valid_posts = []
-    log("Checking valid cache.", Color.BOLD)
-    valid_posts = load_cache(valid_db, valid_posts)
-    log('--Valid cache size: ' + str(len(valid_posts)), Color.BOLD)
-    invalid_count = 0
+    graph = graph_client(sublets_oauth_access_token)
+
+    # Admin roster, only re-read from the API once it's stale
+    roster = load_admin_roster(group_id, sublets_oauth_access_token, graph)
+    saved_props['admin_ids'] = sorted(roster.admin_ids)
+
+    # Get every post created or edited since the last run
+    cursor = FeedCursor(now_time - u.feed_lookback)
+    cursor = u.load_cache(cursor_db, cursor)
+    group_posts = list(iter_group_posts(graph, group_id, cursor))
+
+    # Posts whose deletes failed last run are read back in by ID
+    retry_ids = u.load_cache(retry_db, [])
+    fetched_ids = set(post['post_id'] for post in group_posts)
+    group_posts.extend(fetch_posts(graph, [post_id for post_id in retry_ids
+                                           if post_id not in fetched_ids]))
+
+    # Load the cache of valid posts
+    valid_posts = PostCache(u.valid_cache_size, u.valid_cache_ttl)
+    u.log("Checking valid cache.", u.Color.BOLD)
+    valid_posts = u.load_cache(valid_db, valid_posts)
+    u.log('--Valid cache size: ' + str(len(valid_posts)), u.Color.BOLD)
+
+    # Deletes are queued up and sent together after the loop
+    deletes = DeleteExecutor(graph, u.delete_workers, u.delete_retries)
+    invalid_posts = []
+
+    # Skip mod posts, then validate the rest in one batch
+    pending_posts = []
+    for post in group_posts:
+        if roster.is_admin(post['actor_id']):
+            u.log('\n--Ignored post: ' + post['post_id'], u.Color.BLUE)
+            continue
+        pending_posts.append(post)
+    verdicts = validate_batch(pending_posts, u.validate_workers)
 
     # Loop over retrieved posts
-    for post in group_posts["data"]:
+    for post, verdict in zip(pending_posts, verdicts):
 
         # Important data received
         post_message = post['message']  # Content of the post
         post_id = post['post_id']  # Unique ID of the post
 
-        # Unique ID of the person that posted it
-        actor_id = post['actor_id']
-
-        # Ignore mods and certain posts
-        if int(actor_id) in admin_ids:
-            log('\n--Ignored post: ' + post_id, Color.BLUE)
-            continue
-
         # Boolean for tracking if the post is valid
         valid_post = True
 
@@ -307,54 +304,59 @@ def sub_group():
         # log("\n" + post_message[0:75].replace('\n', "") + "...\n--POST ID: " +
         # str(post_id) + "\n--ACTOR ID: " + str(actor_id))
 
-        # Check for pricing
-        if not check_price_validity(post_message):
-            valid_post = False
-            log('----$', Color.RED)
-            invalid_count += 1
-
-        # Check for tag validity, including tags that say rooming and offering
-        tags = get_tags(post_message)
-        if not validate_tags(tags):
+        # Expand the batch verdict into the broken rules
+        for rule in rules_for(verdict):
             valid_post = False
-            log('----Tag', Color.RED)
-            invalid_count += 1
-
-        # Check post length.
-        # Allow short ones if there's a craigslist link or parking
-        if len(post_message) < 200 \
-                and "craigslist" not in post_message.lower() \
-                and not check_for_parking_tag(post_message):
-            valid_post = False
-            log('----Length', Color.RED)
-            invalid_count += 1
+            u.log(rule.label, u.Color.RED)
 
         # Not a valid post
         if not valid_post:
             if dry_run:
-                log("Dry - invalid deletion", Color.RED)
-                log("--ID: " + post_id, Color.RED)
-                log("--Message: " + post_message, Color.RED)
-                log("\n")
+                u.log("Dry - invalid deletion", u.Color.RED)
+                u.log("--ID: " + post_id, u.Color.RED)
+                u.log("--Message: " + post_message, u.Color.RED)
+                u.log("\n")
             else:
-                graph.delete(post_id)
+                deletes.submit(post_id)
+                invalid_posts.append(post_id)
         else:
-            valid_posts.append(post_id)
-
-    if not dry_run:
-        log("Deleted " + str(invalid_count) + " invalid posts", Color.RED)
+            valid_posts.add(post_id)
 
     # # Delete posts older than 30 days
-    delete_old_posts(graph, group_id, admin_ids)
+    delete_old_posts(graph, group_id, roster.admin_ids, deletes)
+
+    # Send every queued delete
+    report = deletes.run()
+    for object_id, e in report.failed.items():
+        u.log("Failed to delete " + object_id + " - " + str(e), u.Color.RED)
+
+    if not dry_run:
+        deleted_count = len([post_id for post_id in invalid_posts
+                             if report.ok(post_id)])
+        u.log("Deleted " + str(deleted_count) + " invalid posts", u.Color.RED)
 
     # Save the updated caches
-    log('Saving valid cache', Color.BOLD)
-    save_cache(valid_db, valid_posts)
+    u.log('Saving valid cache', u.Color.BOLD)
+    u.save_cache(valid_db, valid_posts)
 
-    save_properties(saved_props)
+    # Deletes that may work next time get retried then, the cursor
+    # moves on either way
+    retry_ids = [object_id for object_id, e in report.failed.items()
+                 if is_transient(e) or is_throttled(e)]
+    if retry_ids:
+        u.log('Retrying ' + str(len(retry_ids)) + ' failed deletes next run',
+              u.Color.RED)
+    u.save_cache(retry_db, retry_ids)
+    u.log('Saving feed cursor', u.Color.BOLD)
+    u.save_cache(cursor_db, cursor)
+
+    u.save_properties(saved_props)
+
+    # Check the run reused its Graph connections
+    log_connection_stats()
 
     # Done
-    notify_mac()
+    u.notify()
 
 
 # Main method
@@ -365,23 +367,21 @@ if __name__ == "__main__":
                                    ["flushvalid", "dry", "printprops", "extend", "setprops", "token=", "propname=",
                                     "propvalue=", "propname="])
     except getopt.GetoptError:
-        print 'check_and_delete.py -f -d -p -e -s -u <token> -n <propname> -v <propvalue> -g <propname>'
+        print('post_cleanup.py -f -d -p -e -s -u <token> -n <propname> '
+              '-v <propvalue> -g <propname>')
         sys.exit(2)
 
     # Check to see if we're running on Heroku
     if os.environ.get('MEMCACHEDCLOUD_SERVERS', None):
-        import bmemcached
-
-        log('Running on heroku, using memcached', Color.BOLD)
+        u.log('Running on heroku, using memcached', u.Color.BOLD)
 
-        # Authenticate Memcached
+        # Memcached is authenticated when the store is opened
         running_on_heroku = True
-        mc = bmemcached.Client(os.environ.get('MEMCACHEDCLOUD_SERVERS').split(','),
-                               os.environ.get('MEMCACHEDCLOUD_USERNAME'), os.environ.get('MEMCACHEDCLOUD_PASSWORD'))
+        u.is_heroku = True
 
     propname = None
     propval = None
-    log("Args - " + str(opts), Color.BOLD)
+    u.log("Args - " + str(opts), u.Color.BOLD)
     if len(opts) != 0:
         for o, a in opts:
             if o in ("-e", "--extend"):
@@ -389,7 +389,7 @@ if __name__ == "__main__":
             elif o in ("-d", "--dry"):
                 dry_run = True
             elif o in ("-s", "--setprops"):
-                set_new_props()
+                u.init_properties()
                 sys.exit()
             elif o in ("-u", "--update"):
                 update_token(a)
@@ -399,30 +399,31 @@ if __name__ == "__main__":
             elif o in ("-v", "--propvalue"):
                 propval = a
             elif o in ("-p", "--printprops"):
-                log("Printing props", Color.BLUE)
-                props = load_properties()
-                print props.keys()
+                u.log("Printing props", u.Color.BLUE)
+                props = u.load_properties()
+                print(list(props.keys()))
                 sys.exit()
             elif o in ("-g", "--getprop"):
-                log("Getting value for " + a, Color.BLUE)
-                props = load_properties()
+                u.log("Getting value for " + a, u.Color.BLUE)
+                props = u.load_properties()
                 if a not in props.keys():
                     sys.exit(a + " doesn't exist in props")
-                print props[a]
+                print(props[a])
                 sys.exit()
             elif o in ("-f", "--flushvalid"):
-                response = raw_input("Are you sure? Y/N")
+                response = input("Are you sure? Y/N")
                 if response.lower() == 'y':
-                    log("Flushing cache for valid", Color.BLUE)
-                    save_cache(valid_db, [])
-                    log("Flushed cache", Color.BLUE)
+                    u.log("Flushing cache for valid", u.Color.BLUE)
+                    u.save_cache(valid_db, PostCache(u.valid_cache_size,
+                                                     u.valid_cache_ttl))
+                    u.log("Flushed cache", u.Color.BLUE)
                 sys.exit()
             else:
                 sys.exit('No valid args specified')
 
     if propname or propval:
         if propname and propval:
-            log(propname + propval)
+            u.log(propname + propval)
             update_prop(propname, propval)
         else:
             sys.exit('Must specify a prop name and value')
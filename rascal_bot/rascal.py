@@ -1,23 +1,30 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import cPickle as pickle
-import csv
+import asyncio
+import copy
 import datetime
-import getopt
-import json
 import os
-import re
-import subprocess
 import sys
 import time
 
-import facepy
-
 import facebook
 import util as u
-from fbxmpp import SendMsgBot
+from actors import ActorStats, DELETIONS, DUPLICATES, WARNINGS
+from cache import PostCache, VerdictCache
+from clients import graph_client, log_connection_stats
+from digest import NotificationDigest
+from feed import FeedCursor, fetch_posts, iter_group_posts
+from flood import FloodDetector
+from graph import CommentBatch, DeleteExecutor, VerificationQueue
+from journal import ModerationJournal
+from moderator import AsyncModerator
 from raven import Client
+from roster import AdminRoster
+from spam import NearDuplicateIndex
+from state import BotState
+from webhook import WebhookServer
+from rules import PostRuleSet, rules_for, warning_comment
 
 '''----------------------------------------------------------------------------
 Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
@@ -30,56 +37,87 @@ RASCAL functional codebase for administrative tasks in Facebook Groups
 ----------------------------------------------------------------------------'''
 __author__ = 'Whitney King'
 
+# Post validation rules, compiled once at load time. The group has
+# always allowed rooming and offering on one post, unlike post_cleanup
+post_rules = PostRuleSet(exclusive_tags=())
+
+# Admin roster, held in memory for the run and cached between runs
+admin_roster = None
+
+# Chat session for messaging, opened on the first message
+message_session = None
+
+# Admin notifications, coalesced into digests
+admin_digest = NotificationDigest(u.digest_interval)
+
+
+# Loads the admin roster once per process, refreshing it only when stale
+def load_admin_roster(group_id, bot_id, auth_token, graph=None):
+    global admin_roster
+    if admin_roster is None:
+        admin_roster = AdminRoster(u.roster_ttl, u.member_ttl)
+        admin_roster = u.load_cache(u.roster_db, admin_roster)
+
+    if admin_roster.is_stale():
+        # Retrieve the uids via FQL query
+        if graph is None:
+            graph = graph_client(auth_token, facebook)
+
+        # Update the admin_ids in our properties, only if they changed
+        if admin_roster.refresh(graph, group_id, bot_id):
+            saved_props = u.load_properties()
+            saved_props['admin_ids'] = sorted(admin_roster.admin_ids)
+            u.save_properties(saved_props)
+        u.save_cache(u.roster_db, admin_roster)
+
+    return admin_roster
+
 
 # Method for retrieving user ID's of admins in group, ignoring bot ID
 def retrieve_admin_ids(group_id, bot_id, auth_token):
-    # Retrieve the uids via FQL query
-    graph = facebook.GraphAPI(auth_token)
-    admins_query = \
-        "SELECT uid FROM group_member WHERE gid=" + group_id + " AND" + \
-        " administrator AND NOT (uid = " + str(bot_id) + ")"
-    admins = graph.fql(query=admins_query)
+    return sorted(load_admin_roster(group_id, bot_id, auth_token).admin_ids)
 
-    # Parse out the uids from the response
-    admins_list = [admin['uid'] for admin in admins]
 
-    # Update the admin_ids in our properties
-    saved_props = load_properties()
-    saved_props['admin_ids'] = admins_list
-    save_properties(saved_props)
+# Opens the messaging session on first use, it's reused for the whole run
+def get_message_session():
+    global message_session
+    if message_session is None:
+        saved_props = u.load_properties()
 
-    return admins_list
+        # Access token
+        access_token = saved_props['sublets_oauth_access_token']
 
+        # API App ID
+        api_key = saved_props['sublets_api_id']
 
-# Method for sending messages, adapted from here: http://goo.gl/oV5KtZ
-def send_message(recipient, message):
-    saved_props = u.load_properties()
+        # User ID of the bot
+        botid = str(saved_props['bot_id'])
 
-    # Access token
-    access_token = saved_props['sublets_oauth_access_token']
+        # Chat is only set up when there's something to send
+        from fbxmpp import MessageSession
+        message_session = MessageSession(botid, api_key, access_token)
+    return message_session
 
-    # API App ID
-    api_key = saved_props['sublets_api_id']
 
-    # User ID of the bot
-    botid = str(saved_props['bot_id'])
+# Logs out of the messaging session once everything queued has been sent.
+# A session that couldn't send is kept, with its messages, for the next run
+def close_message_session():
+    global message_session
+    if message_session is not None and message_session.close():
+        message_session = None
 
-    # The "From" Facebook ID
-    jid = botid + '@chat.facebook.com'
 
+# Method for sending messages, adapted from here: http://goo.gl/oV5KtZ
+# Messages are queued on one long-lived session instead of logging in for
+# each one, and go out in the background
+def send_message(recipient, message):
     # The "Recipient" Facebook ID, with a hyphen for some reason
     to = '-' + str(recipient) + '@chat.facebook.com'
 
-    xmpp = SendMsgBot(jid, to, unicode(message))
-
-    xmpp.credentials['api_key'] = api_key
-    xmpp.credentials['access_token'] = access_token
-
-    if xmpp.connect(('chat.facebook.com', 5222)):
-        xmpp.process(block=True)
-        log('----Message sent', Color.GREEN)
+    if get_message_session().send(to, str(message)):
+        u.log('----Message queued', u.Color.GREEN)
     else:
-        log("----Unable to connect, message sending fail", Color.RED)
+        u.log("----Unable to connect, message sending fail", u.Color.RED)
 
 
 # Extracted logic for messaging admins a message
@@ -88,56 +126,56 @@ def message_admins(message, auth_token, app_id, bot_id, group_id):
         send_message(str(admin), message)
 
 
+# Queues a notification about a post for the admin digest. Digests go out
+# at the end of the run, or every util.digest_interval seconds
+def notify_admins(message, url, auth_token, app_id, bot_id, group_id):
+    admin_digest.add(message, url)
+    if admin_digest.is_due():
+        send_admin_digest(auth_token, app_id, bot_id, group_id)
+
+
+# Sends everything queued for the admins as one digest per admin
+def send_admin_digest(auth_token, app_id, bot_id, group_id):
+    digest = admin_digest.drain()
+    if digest:
+        message_admins(digest, auth_token, app_id, bot_id, group_id)
+
+
 # Method for checking tag validity
 def check_tag_validity(message_text):
-    p = re.compile(
-        "^(-|\*| )*([\(\[\{])((looking)|(rooming)|(offering)|(parking))([\)\]\}])(:)?(\s|$)",
-        re.IGNORECASE)
-
-    if re.match(p, message_text):
-        return True
-    else:
-        return False
+    return post_rules.validate_tags(post_rules.get_tags(message_text))
 
 
 # Method for checking if pricing reference is there
 def check_price_validity(message_text):
-    p = re.compile(
-        "(\$)|((\d)+( )?((per)|(/)|(a))( )?(/)?((month)|(mon)|(mo))(\s)?)",
-        re.IGNORECASE)
-
-    if re.search(p, message_text) is not None:
-        return True
-    else:
-        return False
+    return post_rules.has_price(message_text)
 
 
 # Checking if there's a parking tag
 def check_for_parking_tag(message_text):
-    p = re.compile(
-        "^(-|\*| )*([\(\[\{])(parking)([\)\]\}])(:)?(\s|$)",
-        re.IGNORECASE)
+    return post_rules.has_exempt_tag(message_text)
 
-    if re.search(p, message_text):
-        return True
-    else:
-        return False
+
+# Validate a batch of post dicts, returns one verdict bitmask per post.
+# Posts whose text is unchanged in <memo> reuse their last verdict
+def validate_batch(posts, workers=1, memo=None):
+    return post_rules.validate_batch(posts, workers, memo)
 
 
 # Delete posts older than 30 days old
-def delete_old_posts(graph, group_id, admins):
+def delete_old_posts(graph, group_id, admins, deletes):
     old_date = int(time.time()) - 2592000  # 30 days in seconds
     old_query = "SELECT post_id, message, actor_id FROM stream WHERE " + \
                 "source_id=" + group_id + " AND created_time<" + str(old_date) + \
                 " LIMIT 300"
-    log("Getting posts older than:")
-    log("\t" + datetime.datetime.fromtimestamp(old_date)
-        .strftime('%Y-%m-%d %H:%M:%S'))
-    posts = graph.fql(query=old_query)
-    log("Deleting " + str(len(posts)) + " posts", Color.RED)
+    u.log("Getting posts older than:")
+    u.log("\t" + datetime.datetime.fromtimestamp(old_date)
+          .strftime('%Y-%m-%d %H:%M:%S'))
+    posts = u.fql_rows(graph.fql(query=old_query))
+    u.log("Deleting " + str(len(posts)) + " posts", u.Color.RED)
     for post in posts:
         post_id = post['post_id']
-        graph.delete_object(id=post_id)
+        deletes.submit(post_id)
 
         ## Old stuff messaging users their post
         # post_message = post['message']
@@ -150,17 +188,237 @@ def delete_old_posts(graph, group_id, admins):
         #               post_message
         #
         #     send_message(str(actor_id), message)
-        #     log("\tDeleting " + post_id, Color.RED)
+        #     u.log("\tDeleting " + post_id, u.Color.RED)
         #     graph.delete_object(id=post_id)
         #     time.sleep(2)
         # else:
-        #     log("\tSkipping admin post: " + post_id, Color.BLUE)
+        #     u.log("\tSkipping admin post: " + post_id, u.Color.BLUE)
+
+
+# Sync moderation pass: validates the posts new to <cursor>, or just
+# <post_ids> when given, plus warned posts: the ones in <due_ids>, or all of
+# them. Warns, un-warns and queues deletes. Posts unchanged since their last
+# verdict in <memo> aren't revalidated. Non-admin posts are run through
+# <spam_index>, which keeps any duplicates it flags. Posts and warnings
+# are counted in <actors>, and high risk actors' posts aren't cached
+# as valid. Posts over their actor's limit in <flood> are held until their
+# window has passed, or deleted if util.flood_delete is set. Returns
+# (processed_posts, to_remove), to_remove mapping each post submitted for
+# deletion to who posted it
+def moderate_posts(graph, group_id, cursor, roster, bot_id, already_warned,
+                   valid_posts, deletes, now_time, ignored_post_ids,
+                   ignore_source_ids, post_ids=None, due_ids=None, memo=None,
+                   spam_index=None, actors=None, flood=None):
+    if post_ids is None:
+        group_posts = list(iter_group_posts(graph, group_id, cursor))
+    else:
+        group_posts = fetch_posts(graph, post_ids)
+    u.log('--New or edited posts: ' + str(len(group_posts)), u.Color.BOLD)
+
+    # Warned posts that didn't change still need their grace period checked,
+    # and held flood posts are read back in once their window has passed
+    if due_ids is None:
+        due_ids = list(already_warned)
+    held_ids = flood.due(now_time) if flood is not None else []
+    fetched_ids = set(post['post_id'] for post in group_posts)
+    group_posts.extend(fetch_posts(graph, [
+        post_id for post_id in set(due_ids).union(held_ids)
+        if post_id not in fetched_ids]))
+
+    # Held posts that didn't come back are gone
+    fetched_ids = set(post['post_id'] for post in group_posts)
+    for post_id in held_ids:
+        if post_id not in fetched_ids:
+            flood.release(post_id)
+
+    # Sort out the posts that still need validating
+    processed_posts = []
+    screened_posts = []
+    to_remove = {}
+    for post in group_posts:
+        post_id = post['post_id']  # Unique ID of the post
+        processed_posts.append(post_id)
+
+        # Unique ID of the person that posted it
+        actor_id = post['actor_id']
+
+        # Ignore mods and certain posts
+        if post_id in ignored_post_ids or actor_id in ignore_source_ids or \
+                        roster.is_admin(actor_id):
+            # u.log('\n--Ignored post: ' + post_id, u.Color.BLUE)
+            continue
+        screened_posts.append(post)
+
+    # Flooders' extra posts are held back before anything else looks at
+    # them, they're validated once their window has passed
+    if flood is not None:
+        screened_posts, flooded_posts = flood.screen(screened_posts, now_time)
+        for post in flooded_posts:
+            u.log('--Flood: ' + post['post_id'], u.Color.RED)
+            if u.flood_delete:
+                flood.release(post['post_id'])
+                deletes.submit(post['post_id'])
+                to_remove[post['post_id']] = post['actor_id']
+
+    # Valid or not, check for reposts and spam blasts
+    if spam_index is not None:
+        spam_index.check(screened_posts, now_time)
+    pending_posts = [post for post in screened_posts
+                     if post['post_id'] not in valid_posts]
+
+    # Validate them all in one batch, edited posts miss in the memo
+    verdicts = validate_batch(pending_posts, u.validate_workers, memo)
+    if actors is not None:
+        actors.observe(pending_posts, verdicts)
+
+    # Comment lookups are batched up for the whole run
+    comment_batch = CommentBatch(graph)
+    to_warn = []
+    to_unwarn = []
+
+    # Loop over posts that need validating
+    for post, verdict in zip(pending_posts, verdicts):
+
+        # Important data received
+        post_message = post['message']  # Content of the post
+        post_id = post['post_id']  # Unique ID of the post
+        actor_id = post['actor_id']  # Unique ID of the person that posted it
+
+        # Log the message details
+        u.log("\n" + post_message[0:75].replace('\n', "") +
+              "...\n--POST ID: " + str(post_id) + "\n--ACTOR ID: " +
+              str(actor_id))
+
+        # Expand the batch verdict into the broken rules
+        violations = rules_for(verdict)
+        for rule in violations:
+            u.log(rule.label, u.Color.BLUE)
+
+        # Not a valid post
+        if violations:
 
+            # If already warned, delete if it's been more than 24 hours, ignore
+            # if it's been less
+            if post_id in already_warned:
+
+                # Invalid, past 24 hour grace period
+                if u.time_limit < now_time - already_warned[post_id]:
+                    u.log('--Delete: ' + post_id, u.Color.RED)
+
+                    # Queue the delete, outcomes are handled after the run
+                    deletes.submit(post_id)
+                    to_remove[post_id] = actor_id
+
+                # Invalid but they still have time
+                else:
+                    time_delta = u.time_limit - (now_time -
+                                                 already_warned[post_id])
+                    m, s = divmod(time_delta, 60)
+                    h, m = divmod(m, 60)
+                    log_message = '--Invalid, but still have '
+                    if h > 0:
+                        log_message += '%d hours and ' % h
+                    log_message += '%02d minutes' % m
+                    u.log(log_message, u.Color.RED)
+                continue
+
+            # Queue up a warning, comments get looked up after the loop
+            else:
+                comment_batch.add(post_id)
+                to_warn.append((post_id, actor_id,
+                                warning_comment(violations)))
+
+        # Valid post
+        else:
+            u.log('--VALID', u.Color.GREEN)
+
+            # Add to valid posts cache, high risk actors get rechecked
+            if actors is None or not actors.is_high_risk(actor_id):
+                valid_posts.add(post_id)
+                u.log('----caching', u.Color.GREEN)
+
+            # Queue up warning removal if it's valid now
+            if post_id in already_warned:
+                comment_batch.add(post_id)
+                to_unwarn.append(post_id)
+
+    # Look up comments on every post being warned or un-warned in one go
+    comments_by_post = comment_batch.fetch()
+
+    # Comment with a warning and cache the post
+    for post_id, actor_id, post_comment in to_warn:
+        u.log('\n--Warning: ' + str(post_id))
+
+        # First check to make sure we haven't warned them before
+        # by searching comments for bot comment
+        previously_commented = False
+        for comment in comments_by_post[post_id]:
+
+            # Found a comment from the bot
+            if comment['fromid'] == bot_id:
+                u.log('--Previously warned')
+                u.log('----caching')
+                previously_commented = True
+                already_warned[post_id] = comment['time']
+                break
+
+        # Comment if no previous comment
+        if not previously_commented:
+            # Comment to post for warning
+            graph.put_object(post_id, "comments", message=post_comment)
+            # Save
+            already_warned[post_id] = now_time
+            u.log('--WARNED', u.Color.RED)
+            if actors is not None:
+                actors.record(actor_id, WARNINGS, now_time)
+
+    # Remove warning comments from posts that are valid now
+    for post_id in to_unwarn:
+        u.log('\n--Removing any warnings: ' + str(post_id))
+        for comment in comments_by_post[post_id]:
+            if comment['fromid'] == int(bot_id):
+                # Delete warning comment
+                deletes.submit(comment['id'])
+                u.log('--Warning queued for deletion')
+
+                # Message the user notifying them the comment is deleted
+                # and thank them for fixing their post. Disabled for now
+                # u.log('--Thanking user')
+                # send_message(str(actor_id),
+                #              "Thanks for fixing your post," +
+                #              " I removed the warning comment.")
+
+        # Remove post from list of warned people
+        u.log('--Removing from cache')
+        del already_warned[post_id]
+
+    return processed_posts, to_remove
+
+
+# Opens the moderation journal. The first time, it starts from the old warned
+# and valid caches
+def open_journal():
+    journal = ModerationJournal(u.journal_path, u.journal_db,
+                                u.journal_compact_every, u.valid_cache_size,
+                                u.valid_cache_ttl, u.time_limit)
+    return journal.load(lambda: (
+        u.load_cache(u.warned_db, dict()),
+        u.load_cache(u.valid_db, PostCache(u.valid_cache_size,
+                                           u.valid_cache_ttl))))
+
+
+# Main runner method, <run_async> runs the moderation pass on one event loop
+# with up to util.max_in_flight Graph calls at once. With a <state> from the
+# daemon, properties, caches and the graph client are kept in memory and the
+# caller flushes them. <post_ids> limits the run to those posts, eg. from
+# webhook notifications, instead of reading the feed
+def sub_group(run_async=False, state=None, post_ids=None):
+    one_shot = state is None
+    if one_shot:
+        state = BotState()
 
-# Main runner method
-def sub_group():
     # Load the properties
-    saved_props = load_properties()
+    saved_props = state.properties()
 
     # Access token
     sublets_oauth_access_token = saved_props['sublets_oauth_access_token']
@@ -186,22 +444,12 @@ def sub_group():
     # User ID of the bot
     bot_id = saved_props['bot_id']
 
-    # IDs of admins (unused right now, might remove later)
-    admin_ids = saved_props['admin_ids']
-
-    # Keeping track of the posts we look at here
-    processed_posts = []
-
-    # FQL query for the group
-    group_query = "SELECT post_id, message, actor_id FROM stream WHERE " + \
-                  "source_id=" + group_id + " LIMIT 50"
-
     # Get current time
     now_time = time.time()
 
     # For logging purposes
-    log("CURRENT CST TIMESTAMP: " + datetime.datetime.fromtimestamp(
-        now_time - 21600).strftime('%Y-%m-%d %H:%M:%S'), Color.UNDERLINE)
+    u.log("CURRENT CST TIMESTAMP: " + datetime.datetime.fromtimestamp(
+          now_time - 21600).strftime('%Y-%m-%d %H:%M:%S'), u.Color.UNDERLINE)
 
     # Make sure the access token is still valid
     if access_token_expiration < now_time:
@@ -209,247 +457,274 @@ def sub_group():
 
     # Warn if the token's expiring soon
     if access_token_expiration - now_time < 604800:
-        log("Warning - access token expires in less than a week", Color.RED)
-        log("-- Expires on " + datetime.datetime.fromtimestamp(
-            access_token_expiration).strftime('%Y-%m-%d %H:%M:%S'))
+        u.log("Warning - access token expires in less than a week",
+              u.Color.RED)
+        u.log("-- Expires on " + datetime.datetime.fromtimestamp(
+              access_token_expiration).strftime('%Y-%m-%d %H:%M:%S'))
 
         # If you want it to automatically when it's close to exp.
-        global extend_key
-        extend_key = True
+        u.extend_key = True
 
-    # Log in, try to get posts
-    graph = facebook.GraphAPI(sublets_oauth_access_token)
+    # Log in, try to get posts. The client is kept while the token holds
+    if state.graph is None or \
+            state.graph_token != sublets_oauth_access_token:
+        state.graph = graph_client(sublets_oauth_access_token, facebook)
+        state.graph_token = sublets_oauth_access_token
+    graph = state.graph
 
     # Extend the access token, default is ~2 months from current date
-    if extend_key:
-        extend_access_token(graph, now_time, saved_props, sublets_api_id,
-                            sublets_secret_key)
-
-    # Make our first request, get the group posts
-    group_posts = graph.fql(query=group_query)
-
-    # Load the pickled cache of previously warned posts
-    already_warned = dict()
-    log("Loading warned cache", Color.BOLD)
-    already_warned = load_cache(warned_db, already_warned)
-    log('--Loading cache size: ' + str(len(already_warned)), Color.BOLD)
-
-    # Load the pickled cache of valid posts
-    valid_posts = []
-    log("Checking valid cache.", Color.BOLD)
-    valid_posts = load_cache(valid_db, valid_posts)
-    log('--Valid cache size: ' + str(len(valid_posts)), Color.BOLD)
-
-    # Loop over retrieved posts
-    for post in group_posts:
-
-        # Important data received
-        post_message = post['message']  # Content of the post
-        post_id = post['post_id']  # Unique ID of the post
-        processed_posts.append(post_id)
-
-        # Unique ID of the person that posted it
-        actor_id = post['actor_id']
-
-        # Ignore mods and certain posts
-        if post_id in ignored_post_ids or actor_id in ignore_source_ids or \
-                        post_id in valid_posts or int(actor_id) in admin_ids:
-            # log('\n--Ignored post: ' + post_id, Color.BLUE)
-            continue
-
-        # Data to use
-        post_comment = ""
-
-        # Boolean for tracking if the post is valid
-        valid_post = True
-
-        # Counter for multiple items
-        invalid_count = 0
-
-        # Log the message details
-        log("\n" + post_message[0:75].replace('\n', "") + "...\n--POST ID: " +
-            str(post_id) + "\n--ACTOR ID: " + str(actor_id))
-
-        # Check for pricing
-        if not check_price_validity(post_message):
-            valid_post = False
-            invalid_count += 1
-            post_comment += "- Please give some sort of pricing (use dollar signs!)\n"
-            log('----$', Color.BLUE)
-
-        # Check for tag validity
-        if not check_tag_validity(post_message):
-            valid_post = False
-            invalid_count += 1
-            post_comment += \
-                "- You didn't include a proper tag\n"
-            log('----Tag', Color.BLUE)
-
-        # Check post length.
-        # Allow short ones if there's a craigslist link or parking
-        if len(post_message) < 200 and \
-                        "craigslist" not in post_message.lower() \
-                and not check_for_parking_tag(post_message):
-            valid_post = False
-            invalid_count += 1
-            post_comment += \
-                "- Not enough details, please give some more info\n"
-            log('----Length', Color.BLUE)
-
-        # Not a valid post
-        if not valid_post:
-
-            if invalid_count > 1:
-                post_comment = "Hey buddy, your post has some issues:\n" + post_comment
-            else:
-                post_comment = "Hey buddy, your post has an issue:\n" + post_comment
-
-            # If already warned, delete if it's been more than 24 hours, ignore
-            # if it's been less
-            if post_id in already_warned:
-
-                # Invalid, past 24 hour grace period
-                if time_limit < now_time - already_warned[post_id]:
-                    log('--Delete: ' + post_id, Color.RED)
-                    url = "http://www.facebook.com/" + post_id
-
-                    # Try and delete the post with graph. If it fails, message
-                    # the admins and prompt them to delete the post
-                    try:
-                        graph.delete_object(id=post_id)
-
-                        log("--Confirming deletion...")
-                        try:
-                            # Give it a sec to propagate
-                            time.sleep(3)
-                            graph.get_object(id=post_id)
-
-                            # If it got here something went wrong
-                            message_admins(
-                                "Please make sure this is gone: " + url,
-                                sublets_oauth_access_token,
-                                sublets_api_id, bot_id, group_id)
-                        except:
-                            log("Deletion confirmed ✓", Color.GREEN)
-                            del already_warned[post_id]
-
-                    # Something went wrong, have the admins delete it
-                    except Exception as e:
-                        message_admins(
-                            "Delete this post: " + url,
-                            sublets_oauth_access_token,
-                            sublets_api_id, bot_id, group_id)
-                        log(e.message + " - " + str(type(e)), Color.RED)
-
-                # Invalid but they still have time
-                else:
-                    time_delta = time_limit - (now_time -
-                                               already_warned[post_id])
-                    m, s = divmod(time_delta, 60)
-                    h, m = divmod(m, 60)
-                    log_message = '--Invalid, but still have '
-                    if h > 0:
-                        log_message += '%d hours and ' % h
-                    log_message += '%02d minutes' % m
-                    log(log_message, Color.RED)
-                continue
-
-            # Comment with a warning and cache the post
-            else:
-
-                # First check to make sure we haven't warned them before
-                # by searching comments for bot comment
-                previously_commented = False
-                comments_query = "SELECT fromid, id, time FROM comment" + \
-                                 " WHERE post_id=\"" + str(post_id) + "\""
-                comments = graph.fql(comments_query)
-                for comment in comments:
-
-                    # Found a comment from the bot
-                    if comment['fromid'] == bot_id:
-                        log('--Previously warned')
-                        log('----caching')
-                        previously_commented = True
-                        already_warned[post_id] = comment['time']
-                        break
-
-                # Comment if no previous comment
-                if not previously_commented:
-                    # Comment to post for warning
-                    post_comment += \
-                        "\nEdit your post and fix the above within 24" + \
-                        " hours, or else your post will be deleted per the" + \
-                        " group rules. Thanks!"
-
-                    graph.put_object(
-                        post['post_id'], "comments", message=post_comment)
-                    # Save
-                    already_warned[post_id] = now_time
-                    log('--WARNED', Color.RED)
-
-        # Valid post
+    if u.extend_key:
+        u.extend_access_token(graph, now_time, saved_props, sublets_api_id,
+                              sublets_secret_key)
+        state.mark_dirty(u.prop_file)
+
+    # Admin roster, only re-read from the API once it's stale
+    roster = load_admin_roster(group_id, bot_id, sublets_oauth_access_token,
+                               graph)
+    if saved_props.get('admin_ids') != sorted(roster.admin_ids):
+        saved_props['admin_ids'] = sorted(roster.admin_ids)
+        state.mark_dirty(u.prop_file)
+
+    # Warned and valid posts come from the moderation journal
+    if state.journal is None:
+        u.log("Loading moderation journal", u.Color.BOLD)
+        state.journal = open_journal()
+    journal = state.journal
+    already_warned = journal.warned
+    valid_posts = journal.valid
+    u.log('--Warned posts: ' + str(len(already_warned)) + ', valid posts: ' +
+          str(len(valid_posts)), u.Color.BOLD)
+
+    # Get every post created or edited since the last run. The run reads
+    # from a copy, the saved cursor only moves once the run has finished
+    cursor = copy.deepcopy(state.cache(
+        u.cursor_db, FeedCursor(now_time - u.feed_lookback)))
+
+    # Only warned posts past their grace period need looking up
+    due_ids = journal.deadlines.due(now_time)
+    u.log('--Warned posts due: ' + str(len(due_ids)), u.Color.BOLD)
+
+    # Deletes are batched up for the whole run
+    deletes = DeleteExecutor(graph, u.delete_workers, u.delete_retries)
+    verify_queue = state.cache(u.verify_db, VerificationQueue())
+
+    # Last verdicts, so unchanged posts aren't revalidated
+    memo = state.cache(u.verdict_db, VerdictCache(u.verdict_cache_size,
+                                                  u.valid_cache_ttl))
+    memo.hits = memo.misses = 0
+
+    # Recent post texts, to catch reposts and spam blasts
+    spam_index = state.cache(u.spam_db, NearDuplicateIndex(
+        u.spam_threshold, u.spam_window, u.valid_cache_size))
+
+    # Per-actor history, for spotting fake and spam accounts
+    actors = state.cache(u.actors_db, ActorStats(u.actor_risk_threshold,
+                                                 u.actor_min_events))
+
+    # Recent post times per actor, to cut floods short
+    flood = state.cache(u.flood_db, FloodDetector(u.flood_limit,
+                                                  u.flood_window))
+
+    if run_async:
+        moderator = AsyncModerator(graph, post_rules, roster, bot_id,
+                                   already_warned, valid_posts, deletes,
+                                   u.max_in_flight, u.validate_workers,
+                                   now_time, ignored_post_ids,
+                                   ignore_source_ids, memo, spam_index,
+                                   actors, flood)
+        processed_posts, to_remove = asyncio.run(
+            moderator.run(group_id, cursor, post_ids, due_ids))
+    else:
+        processed_posts, to_remove = moderate_posts(
+            graph, group_id, cursor, roster, bot_id, already_warned,
+            valid_posts, deletes, now_time, ignored_post_ids,
+            ignore_source_ids, post_ids, due_ids, memo, spam_index, actors,
+            flood)
+    u.log('--Verdicts reused: ' + str(memo.hits) + ', validated: ' +
+          str(memo.misses), u.Color.BOLD)
+
+    # Have the admins look over near-duplicate posts
+    for dup in spam_index.drain():
+        if dup.actor_id == dup.match_actor_id:
+            message = "Possible repost"
         else:
-            log('--VALID', Color.GREEN)
-
-            # Add to valid posts cache
-            valid_posts.append(post_id)
-            log('----caching', Color.GREEN)
-
-            # Remove warning comment if it's valid now
-            if post_id in already_warned:
-                log('--Removing any warnings')
-                comments_query = "SELECT fromid, id FROM comment" + \
-                                 " WHERE post_id=\"" + str(post_id) + "\""
-                comments = graph.fql(comments_query)
-                for comment in comments:
-                    if comment['fromid'] == int(bot_id):
-                        # Delete warning comment
-                        graph.delete_object(comment['id'])
-                        log('--Warning deleted')
-
-                        # Message the user notifying them the comment is deleted
-                        # and thank them for fixing their post. Disabled for now
-                        # log('--Thanking user')
-                        # send_message(str(actor_id),
-                        #              "Thanks for fixing your post," +
-                        #              " I removed the warning comment.")
-
-                # Remove post from list of warned people
-                log('--Removing from cache')
-                del already_warned[post_id]
-
-    # Delete posts older than 30 days
-    delete_old_posts(graph, group_id, admin_ids)
-
-    # Keep our warned cache clean
-    log('Cleaning warned posts', Color.BOLD)
-    already_warned = dict((key, value) for (key, value) in
-                          already_warned.items() if key in processed_posts)
-
-    # Save the updated caches
-    log('Saving warned cache', Color.BOLD)
-    save_cache(warned_db, already_warned)
-
-    log('Saving valid cache', Color.BOLD)
-    save_cache(valid_db, valid_posts)
-
-    save_properties(saved_props)
+            message = "Possible spam, another account posted the same"
+        u.log('--' + message + ': ' + dup.post_id + ' ~ ' + dup.match_id +
+              ' (%d%%)' % (dup.similarity * 100), u.Color.RED)
+        actors.record(dup.actor_id, DUPLICATES, now_time)
+        notify_admins(message, "http://www.facebook.com/" + dup.post_id,
+                      sublets_oauth_access_token,
+                      sublets_api_id, bot_id, group_id)
+
+    # And over anyone flooding the group
+    for actor_id in flood.drain():
+        notify_admins("Posting too fast, " + str(u.flood_limit) +
+                      "+ posts in " + str(u.flood_window // 60) + " minutes",
+                      "http://www.facebook.com/" + str(actor_id),
+                      sublets_oauth_access_token,
+                      sublets_api_id, bot_id, group_id)
+
+    # And over accounts that keep breaking the rules
+    for actor_id in actors.drain():
+        u.log('--High risk account: ' + str(actor_id) + ' ' +
+              str(actors.get(actor_id)), u.Color.RED)
+        notify_admins("Possible fake or spam account",
+                      "http://www.facebook.com/" + str(actor_id),
+                      sublets_oauth_access_token,
+                      sublets_api_id, bot_id, group_id)
+
+    # Delete posts older than 30 days, skipped on runs for notified posts
+    if not post_ids:
+        delete_old_posts(graph, group_id, roster.admin_ids, deletes)
+
+    # Send every queued delete
+    u.log('Running ' + str(len(deletes)) + ' deletes', u.Color.BOLD)
+    report = deletes.run()
+    u.log('--Deleted ' + str(len(report.deleted)) + ', failed ' +
+          str(len(report.failed)), u.Color.BOLD)
+
+    # If a delete failed, message the admins and prompt them to delete the
+    # post. Otherwise queue the post up to confirm it's gone, and count it
+    # against whoever posted it
+    for post_id, actor_id in to_remove.items():
+        url = "http://www.facebook.com/" + post_id
+
+        # Something went wrong, have the admins delete it
+        if not report.ok(post_id):
+            e = report.failed[post_id]
+            notify_admins(
+                "Delete this post", url,
+                sublets_oauth_access_token,
+                sublets_api_id, bot_id, group_id)
+            u.log(str(e) + " - " + str(type(e)), u.Color.RED)
+        else:
+            verify_queue.add(post_id)
+            actors.record(actor_id, DELETIONS, now_time)
+
+    # Confirm deletions that have had time to propagate, this run's or
+    # ones carried over from the last run. A one-shot run waits a little
+    # for its own, anything still not due goes to the next run with the
+    # queue
+    u.log("Confirming deletions...", u.Color.BOLD)
+    due_by = verify_queue.due_by()
+    if one_shot and due_by is not None and \
+            due_by - time.time() <= u.verify_wait:
+        time.sleep(max(0, due_by - time.time()))
+    confirmed, unconfirmed = verify_queue.check(graph)
+    for post_id in confirmed:
+        u.log("Deletion confirmed ✓ " + post_id, u.Color.GREEN)
+        journal.deleted(post_id)
+        memo.discard(post_id)
+    for post_id in unconfirmed:
+        notify_admins(
+            "Please make sure this is gone",
+            "http://www.facebook.com/" + post_id,
+            sublets_oauth_access_token,
+            sublets_api_id, bot_id, group_id)
+    u.log('--Still waiting on ' + str(len(verify_queue)), u.Color.BOLD)
+
+    # Due posts that didn't come back are gone
+    u.log('Cleaning warned posts', u.Color.BOLD)
+    for post_id in set(due_ids).difference(processed_posts):
+        journal.deleted(post_id)
+        memo.discard(post_id)
+
+    # Everything read this run has been dealt with
+    state.replace(u.cursor_db, cursor)
+
+    # Save the caches that changed. Where the journal file doesn't outlive
+    # the run, eg. on a dyno, it's compacted into the store too
+    if one_shot:
+        written = state.flush(compact=not u.journal_durable)
+        u.log('Saving ' + (', '.join(written) or 'nothing'), u.Color.BOLD)
+        journal.close()
+
+    # Send anything still queued for the admins
+    send_admin_digest(sublets_oauth_access_token, sublets_api_id, bot_id,
+                      group_id)
+    close_message_session()
+
+    # Check the run reused its Graph connections
+    log_connection_stats()
 
     # Done
-    notify_mac()
+    u.notify()
+
+
+# Long-running mode: polls every util.poll_interval seconds, keeping state in
+# memory between polls and flushing it when it changes, at checkpoints and on
+# the way out
+def daemon(run_async=False):
+    state = BotState(u.checkpoint_interval)
+    u.log('Starting daemon, polling every ' + str(u.poll_interval) + 's',
+          u.Color.BOLD)
+    try:
+        while True:
+            started = time.time()
+            try:
+                sub_group(run_async, state)
+            except Exception as e:
+                u.log('Run failed - ' + str(e) + ' - ' + str(type(e)),
+                      u.Color.RED)
+                if os.environ.get('RAVEN'):
+                    Client(os.environ.get('RAVEN')).captureException()
+
+            written = state.flush()
+            if written:
+                u.log('Saved ' + ', '.join(written), u.Color.BOLD)
+            time.sleep(max(0, u.poll_interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        u.log('Stopping daemon', u.Color.BOLD)
+    finally:
+        state.flush(force=True)
+
+
+# Webhook mode: validates posts as Graph notifies us they changed. Runs
+# every util.poll_interval seconds when it's quiet, or sooner when a grace
+# period runs out, to enforce grace periods and delete old posts
+def listen(run_async=False):
+    saved_props = u.load_properties()
+    server = WebhookServer((u.webhook_host, u.webhook_port),
+                           saved_props['sublets_secret_key'],
+                           saved_props.get('webhook_verify_token'),
+                           saved_props['group_id'], u.webhook_path)
+    server.start()
+    u.log('Listening for webhooks on ' + server.url, u.Color.BOLD)
+
+    state = BotState(u.checkpoint_interval)
+    try:
+        while True:
+            # Wake up early for the next grace period that runs out
+            timeout = u.poll_interval
+            if state.journal is not None:
+                deadline = state.journal.deadlines.next_deadline()
+                if deadline is not None:
+                    timeout = max(0, min(timeout, deadline - time.time()))
+            post_ids = server.queue.wait(timeout)
+            try:
+                sub_group(run_async, state, post_ids)
+            except Exception as e:
+                u.log('Run failed - ' + str(e) + ' - ' + str(type(e)),
+                      u.Color.RED)
+                if os.environ.get('RAVEN'):
+                    Client(os.environ.get('RAVEN')).captureException()
+            state.flush()
+    except KeyboardInterrupt:
+        u.log('Stopping webhook listener', u.Color.BOLD)
+    finally:
+        server.shutdown()
+        state.flush(force=True)
 
 
 # Main method
 if __name__ == "__main__":
     # Check to see if we're running on Heroku
     if os.environ.get('MEMCACHEDCLOUD_SERVERS', None):
-        import bmemcached
-
-        log('Running on heroku, using memcached', Color.BOLD)
+        u.log('Running on heroku, using memcached', u.Color.BOLD)
 
-        # Authenticate Memcached
+        # Memcached is authenticated when the store is opened
         running_on_heroku = True
-        mc = bmemcached.Client(os.environ.get('MEMCACHEDCLOUD_SERVERS').split(','),os.environ.get('MEMCACHEDCLOUD_USERNAME'),os.environ.get('MEMCACHEDCLOUD_PASSWORD'))
+        u.is_heroku = True
 
     args = sys.argv
     # parser = argparse.ArgumentParser()
@@ -459,23 +734,31 @@ if __name__ == "__main__":
     # parser.add_argument("-p", help="set some property values")
     # args = parser.parse_args()
 
+    # Run the moderation pass on an event loop
+    run_async = "--async" in args
+    if run_async:
+        args.remove("--async")
+
     # Arg parsing. I know, there's better ways to do this
     if len(args) > 1:
         if "--extend" in args:
-            extend_key = True
-        elif "setprops" in args:
-            set_new_props()
-            sys.exit()
-        elif "init" in args:
-            init_props()
+            u.extend_key = True
+        elif "setprops" in args or "init" in args:
+            u.init_properties()
             sys.exit()
         elif "test" in args:
-            test()
+            u.test()
             sys.exit("Done testing")
+        elif "daemon" in args:
+            daemon(run_async)
+            sys.exit()
+        elif "webhook" in args:
+            listen(run_async)
+            sys.exit()
         else:
             sys.exit('No valid args specified')
 
-    sub_group()
+    sub_group(run_async)
     # try:
     #     sub_group()
     # except Exception:
@@ -0,0 +1,369 @@
+import json
+import random
+import threading
+import time
+import types
+
+import util as u
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       ratelimit.py
+Author:     @WhitneyOnTheWeb
+
+Shared, adaptive rate limiting for Graph API calls
+
+- Every call takes a token from one bucket per process, so parallel
+  workers share one budget instead of each hammering the API
+- The rate creeps up while calls succeed and the usage headers Graph
+  sends back stay under the target, and drops when they don't
+- Throttled calls back off exponentially with full jitter and are
+  retried, instead of crashing the run
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+# Graph error codes for app, user, page, feed and business throttling
+throttle_codes = (4, 17, 32, 341, 613, 80001, 80002, 80003, 80004, 80005,
+                  80006, 80008, 80009, 80014)
+
+# Headers Graph reports usage in, as percentages of the limit
+usage_headers = ('x-app-usage', 'x-page-usage', 'x-ad-account-usage',
+                 'x-business-use-case-usage')
+
+rate_step = 0.5                     # calls/s added after each clean call
+rate_cut = 0.5                      # rate multiplier when throttled
+
+shared_limiter = None               # limiter shared by every graph client
+
+
+'''-------------------------------------
+Method: is_throttled
+
+Checks if a failed Graph call was a
+throttling error
+
+Input:
+    <error>:    exception from a Graph call
+Return:
+    <bool>:     True if the API throttled it
+'''
+def is_throttled(error):
+    code = getattr(error, 'code', None)
+    if code is None:
+        # facebook SDK errors keep the code in the parsed result
+        result = getattr(error, 'result', None)
+        if isinstance(result, dict):
+            code = result.get('error', {}).get('code')
+    try:
+        return int(code) in throttle_codes
+    except (TypeError, ValueError):
+        return False
+
+
+'''-------------------------------------
+Method: read_usage
+
+Pulls the highest usage percentage and the
+longest wait out of Graph's usage headers
+
+Input:
+    <headers>:  response headers, any case
+Return:
+    <tuple>:    (usage %, seconds until access
+                is back), 0s if not reported
+'''
+def read_usage(headers):
+    usage, wait = 0, 0
+    if not headers:
+        return usage, wait
+
+    lowered = dict((str(k).lower(), v) for k, v in headers.items())
+    for name in usage_headers:
+        raw = lowered.get(name)
+        if not raw:
+            continue
+        try:
+            data = json.loads(raw)
+        except (TypeError, ValueError):
+            continue
+
+        # Business use case usage is keyed by ID, with a list per ID
+        if name == 'x-business-use-case-usage':
+            reports = [report for reports in data.values()
+                       for report in reports]
+        else:
+            reports = [data]
+
+        for report in reports:
+            for key in ('call_count', 'total_time', 'total_cputime',
+                        'acc_id_util_pct'):
+                usage = max(usage, float(report.get(key) or 0))
+            wait = max(wait, 60 * float(
+                report.get('estimated_time_to_regain_access') or 0))
+    return usage, wait
+
+
+'''-------------------------------------
+Class: TokenBucket
+
+Thread-safe token bucket
+
+- Refills at <rate> tokens a second, up
+  to <burst> tokens
+- hold() stops handing out tokens for a
+  while, eg. after a throttling error
+
+Input:
+    <rate>:     tokens added per second
+    <burst>:    most tokens held at once
+'''
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.held_until = 0
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    '''-------------------------------------
+    Method: acquire
+
+    Takes <cost> tokens, sleeping until
+    there are enough
+
+    Return:
+        <float>:    seconds spent waiting
+    '''
+    def acquire(self, cost=1):
+        cost = min(float(cost), self.burst)
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now < self.held_until:
+                    delay = self.held_until - now
+                elif self.tokens >= cost:
+                    self.tokens -= cost
+                    return waited
+                else:
+                    delay = (cost - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.time())
+            self.rate = float(rate)
+
+    def hold(self, seconds):
+        with self._lock:
+            self.held_until = max(self.held_until, time.time() + seconds)
+            self.tokens = 0
+
+
+'''-------------------------------------
+Class: AdaptiveRateLimiter
+
+Runs Graph calls through a TokenBucket,
+tuning its rate to what the API allows
+
+- Clean calls under <target_usage> raise
+  the rate by rate_step, up to <max_rate>
+- Usage over the target, or a throttling
+  error, cuts it, down to <min_rate>
+- Throttled calls are retried up to
+  <retries> times, after a random wait
+  of up to <backoff> * 2^attempt seconds
+  (capped at <max_backoff>)
+
+Input:
+    <rate>:         starting calls per second
+    <burst>:        calls allowed back to back
+    <min_rate>:     slowest rate to drop to
+    <max_rate>:     fastest rate to climb to
+    <target_usage>: usage % to stay under
+    <retries>:      retries for throttled calls
+    <backoff>:      base backoff in seconds
+    <max_backoff>:  longest single backoff
+'''
+class AdaptiveRateLimiter(object):
+    def __init__(self, rate=5, burst=10, min_rate=0.2, max_rate=50,
+                 target_usage=75, retries=4, backoff=1, max_backoff=300):
+        self.bucket = TokenBucket(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_usage = target_usage
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.usage = 0
+        self.throttles = 0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    '''-------------------------------------
+    Method: call
+
+    Runs <func> once a token is free,
+    retrying it if it's throttled. Lazy
+    results (eg. facepy batches) are read
+    inside the call, so they're limited too
+
+    Input:
+        <func>:     Graph client method
+        <cost>:     tokens it uses, eg. the
+                    number of batched requests
+    Return:
+        result of <func>
+    '''
+    def call(self, func, *args, **kwargs):
+        cost = kwargs.pop('_cost', 1)
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            try:
+                result = func(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+            except Exception as e:
+                if not is_throttled(e) or attempt >= self.retries:
+                    raise
+                self.throttled(attempt)
+                attempt += 1
+                continue
+
+            self.observe(result)
+            return result
+
+    '''-------------------------------------
+    Method: observe
+
+    Adjusts the rate to one call's result.
+    Throttling errors inside a batch cut it,
+    otherwise it climbs while the last usage
+    Graph reported is under the target
+    '''
+    def observe(self, result):
+        if isinstance(result, list) and \
+                any(isinstance(r, Exception) and is_throttled(r)
+                    for r in result):
+            self.throttled(0)
+            return
+
+        with self._lock:
+            if self.usage <= self.target_usage:
+                self.bucket.set_rate(min(self.max_rate,
+                                         self.rate + rate_step))
+
+    '''-------------------------------------
+    Method: observe_usage
+
+    Adjusts the rate to the usage headers on
+    one HTTP response. The Graph clients
+    don't hand headers back, so these come
+    from a hook on the shared session
+
+    Input:
+        <headers>:  response headers
+    '''
+    def observe_usage(self, headers):
+        usage, wait = read_usage(headers)
+        with self._lock:
+            self.usage = usage
+            if wait:
+                self.bucket.hold(wait)
+            if usage > self.target_usage:
+                self.bucket.set_rate(max(self.min_rate,
+                                         self.rate * self.target_usage / usage))
+
+    '''-------------------------------------
+    Method: throttled
+
+    Cuts the rate and holds every caller
+    for a jittered, exponential backoff
+    '''
+    def throttled(self, attempt):
+        with self._lock:
+            self.throttles += 1
+            self.bucket.set_rate(max(self.min_rate, self.rate * rate_cut))
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2 ** attempt))
+            self.bucket.hold(delay)
+        u.log('--Throttled, backing off ' + '%.1f' % delay + 's', u.Color.RED)
+
+
+'''-------------------------------------
+Class: RateLimitedGraph
+
+Wraps a Graph API client, facebook SDK or
+facepy, so every method call goes through
+a limiter. Everything else is passed
+straight through
+
+Input:
+    <graph>:    Graph API client
+    <limiter>:  AdaptiveRateLimiter to use
+'''
+class RateLimitedGraph(object):
+    def __init__(self, graph, limiter):
+        self.graph = graph
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.graph, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def limited(*args, **kwargs):
+            if name == 'batch' and args:
+                args = (list(args[0]),) + args[1:]
+                kwargs['_cost'] = max(1, len(args[0]))
+            return self.limiter.call(attr, *args, **kwargs)
+        return limited
+
+
+'''-------------------------------------
+Method: get_limiter
+
+Returns the process-wide limiter, set up
+from the util.graph_* settings on first use
+'''
+def get_limiter():
+    global shared_limiter
+    if shared_limiter is None:
+        shared_limiter = AdaptiveRateLimiter(
+            u.graph_rate, u.graph_burst, u.graph_min_rate, u.graph_max_rate,
+            u.graph_target_usage, u.graph_retries)
+    return shared_limiter
+
+
+'''-------------------------------------
+Method: limit_graph
+
+Wraps a Graph API client in the shared
+limiter, once
+
+Input:
+    <graph>:    Graph API client
+Return:
+    <RateLimitedGraph>
+'''
+def limit_graph(graph):
+    if isinstance(graph, RateLimitedGraph):
+        return graph
+    return RateLimitedGraph(graph, get_limiter())
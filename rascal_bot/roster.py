@@ -0,0 +1,141 @@
+import time
+
+import util as u
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       roster.py
+Author:     @WhitneyOnTheWeb
+
+Cached roster of group admins and members
+
+- Held in memory for a run and pickled between runs
+- Only goes back to the Graph API once its copy is stale
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+members_page = 500                  # member rows per FQL page
+
+
+'''-------------------------------------
+Class: AdminRoster
+
+Admin and member IDs for a group, with
+O(1) lookups for the moderation loop
+
+- Admins are re-read every <ttl> seconds
+- Members are re-read every <member_ttl>
+  seconds, or never if it's None
+- Refreshes apply the difference to the
+  cached sets and report if anything
+  changed, so callers only save on change
+
+Input:
+    <ttl>:          seconds admins stay fresh
+    <member_ttl>:   seconds members stay fresh
+'''
+class AdminRoster(object):
+    def __init__(self, ttl=86400, member_ttl=None):
+        self.ttl = ttl
+        self.member_ttl = member_ttl
+        self.admin_ids = set()
+        self.member_ids = set()
+        self.admins_refreshed = None
+        self.members_refreshed = None
+
+    def is_admin(self, actor_id):
+        return int(actor_id) in self.admin_ids
+
+    def is_member(self, actor_id):
+        return int(actor_id) in self.member_ids
+
+    '''-------------------------------------
+    Method: is_stale
+
+    Checks if any part of the roster is due
+    for a refresh
+    '''
+    def is_stale(self, now=None):
+        if now is None:
+            now = time.time()
+        return self._admins_due(now) or self._members_due(now)
+
+    '''-------------------------------------
+    Method: refresh
+
+    Re-reads the stale parts of the roster
+
+    Input:
+        <graph>:    Graph API client
+        <group_id>: ID of the FB group
+        <bot_id>:   bot's user ID, left out of
+                    the admins when given
+        <now>:      defaults to current time
+    Return:
+        <bool>:     True if any IDs changed
+    '''
+    def refresh(self, graph, group_id, bot_id=None, now=None):
+        if now is None:
+            now = time.time()
+        changed = False
+
+        if self._admins_due(now):
+            query = "SELECT uid FROM group_member WHERE gid=" + \
+                    str(group_id) + " AND administrator"
+            if bot_id is not None:
+                query += " AND NOT (uid = " + str(bot_id) + ")"
+            admins = set(int(row['uid'])
+                         for row in u.fql_rows(graph.fql(query=query)))
+            changed |= self._apply(self.admin_ids, admins)
+            self.admins_refreshed = now
+
+        if self._members_due(now):
+            changed |= self._apply(self.member_ids,
+                                   self._fetch_members(graph, group_id))
+            self.members_refreshed = now
+
+        return changed
+
+    def _admins_due(self, now):
+        return self.admins_refreshed is None or \
+            now - self.admins_refreshed >= self.ttl
+
+    def _members_due(self, now):
+        if self.member_ttl is None:
+            return False
+        return self.members_refreshed is None or \
+            now - self.members_refreshed >= self.member_ttl
+
+    def _fetch_members(self, graph, group_id):
+        members = set()
+        offset = 0
+        while True:
+            query = "SELECT uid FROM group_member WHERE gid=" + \
+                    str(group_id) + " LIMIT " + str(members_page) + \
+                    " OFFSET " + str(offset)
+            rows = u.fql_rows(graph.fql(query=query))
+            members.update(int(row['uid']) for row in rows)
+            if len(rows) < members_page:
+                return members
+            offset += members_page
+
+    '''-------------------------------------
+    Method: _apply
+
+    Updates <ids> in place to match <fresh>
+
+    Return:
+        <bool>: True if anything was added
+                or removed
+    '''
+    def _apply(self, ids, fresh):
+        added = fresh - ids
+        removed = ids - fresh
+        ids.difference_update(removed)
+        ids.update(added)
+        return bool(added or removed)
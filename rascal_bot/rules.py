@@ -0,0 +1,331 @@
+import hashlib
+import re
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import util as u
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       rules.py
+Author:     @WhitneyOnTheWeb
+
+Declarative post rule engine shared by the group runners
+
+- Every rule pattern is compiled once, when the rule set is built
+- A post's violations are collected from a single scan of its text
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Rule Definitions
+================
+'''
+Rule = namedtuple('Rule', ['name', 'flag', 'comment', 'label'])
+
+PRICE = Rule('price', 0x1,
+             '- Please give some sort of pricing (use dollar signs!)\n',
+             '----$')
+TAG = Rule('tag', 0x2,
+           "- You didn't include a proper tag\n",
+           '----Tag')
+LENGTH = Rule('length', 0x4,
+              '- Not enough details, please give some more info\n',
+              '----Length')
+
+RULES = (PRICE, TAG, LENGTH)        # order violations are reported in
+VALID = 0                           # verdict for a post with no violations
+
+# Tags the housing group posts under, the rule set's default
+group_tags = ('looking', 'rooming', 'offering', 'parking')
+
+batch_threshold = 2000              # posts before batches use processes
+batch_chunk_size = 500              # posts per process pool task
+
+# Pricing reference: a dollar sign, or "<number> per/a// month/mon/mo"
+price_pattern = r'\$|\d+ ?(?:per|/|a) ?/?mo(?:nth|n)?'
+
+# One tag token on the first line, eg. "-[found]:" or "*(made)"
+tag_pattern = r'^[-* ]*(?:[\(\[\{](.+)[\)\]\}])+:?(?:\s|$)'
+
+# Closing bracket directly followed by an opening one, eg. "[found](made)"
+joined_tags_pattern = r'([\)\]\}])([\(\[\{])'
+
+warning_footer = "\nEdit your post and fix the above within 24" + \
+                 " hours, or else your post will be deleted per the" + \
+                 " group rules. Thanks!"
+
+
+'''-------------------------------------
+Method: rules_for
+
+Expands a verdict bitmask back into Rules
+
+Input:
+    <verdict>:  bitmask from PostRuleSet.verdict
+Return:
+    <tuple>:    broken Rules, in RULES order
+'''
+def rules_for(verdict):
+    return tuple(rule for rule in RULES if verdict & rule.flag)
+
+
+'''-------------------------------------
+Method: warning_comment
+
+Builds the warning comment for a post
+
+Input:
+    <violations>:   broken Rules for the post
+Return:
+    <str>:          comment listing each issue
+'''
+def warning_comment(violations):
+    if len(violations) > 1:
+        comment = "Hey buddy, your post has some issues:\n"
+    else:
+        comment = "Hey buddy, your post has an issue:\n"
+    for rule in violations:
+        comment += rule.comment
+    return comment + warning_footer
+
+
+'''-------------------------------------
+Class: PostRuleSet
+
+Compiled set of post validation rules
+
+Input:
+    <tags>:             allowed post tags, defaults
+                        to group_tags
+    <exclusive_tags>:   pairs of tags that can't be
+                        used on the same post
+    <exempt_tags>:      tags that allow short posts
+    <exempt_keywords>:  words that allow short posts
+    <min_length>:       shortest non-exempt post
+    <leading>:          symbols allowed ahead of the
+                        first tag
+'''
+class PostRuleSet(object):
+    def __init__(self, tags=None,
+                 exclusive_tags=(('rooming', 'offering'),),
+                 exempt_tags=('parking',),
+                 exempt_keywords=('craigslist',),
+                 min_length=200, leading=u.tag_delimiters):
+        if tags is None:
+            tags = group_tags
+        self.tags = frozenset(t.lower() for t in tags)
+        self.exclusive_tags = tuple(frozenset(t.lower() for t in pair)
+                                    for pair in exclusive_tags)
+        self.exempt_tags = frozenset(t.lower() for t in exempt_tags)
+        self.min_length = min_length
+        self.leading = frozenset(leading)
+
+        # Identifies these rules to a VerdictCache
+        self.fingerprint = hashlib.sha1(repr((
+            sorted(self.tags), sorted(sorted(p) for p in self.exclusive_tags),
+            sorted(self.exempt_tags), list(exempt_keywords or ()),
+            min_length, sorted(self.leading), price_pattern,
+            tag_pattern)).encode('utf-8')).hexdigest()
+
+        self._tag = re.compile(tag_pattern, re.IGNORECASE)
+        self._joined_tags = re.compile(joined_tags_pattern)
+        self._price = re.compile(price_pattern, re.IGNORECASE)
+
+        # Price and exemption keywords share one pass over the text
+        scan = '(?P<price>{})'.format(price_pattern)
+        if exempt_keywords:
+            scan += '|(?P<exempt>{})'.format(
+                '|'.join(re.escape(k) for k in exempt_keywords))
+        self._scan = re.compile(scan, re.IGNORECASE)
+
+    '''-------------------------------------
+    Method: get_tags
+
+    Parses the tags off the first line of a post
+
+    Input:
+        <message_text>: post message
+    Return:
+        <list>:         lowercase tags, or None if
+                        the first line has no tags
+    '''
+    def get_tags(self, message_text):
+        first_line = message_text.lstrip().split('\n', 1)[0]
+        first_line = self._joined_tags.sub(r'\1 \2', first_line)
+        tokens = first_line.split()
+        if not tokens:
+            return None
+
+        # Tags have to lead the post
+        if not self._tag.match(tokens[0]) and tokens[0] not in self.leading:
+            return None
+
+        tags = [m.group(1).lower() for m in map(self._tag.match, tokens)
+                if m]
+        return tags or None
+
+    '''-------------------------------------
+    Method: validate_tags
+
+    Checks parsed tags against the vocabulary
+    and the mutually exclusive pairs
+
+    Input:
+        <tags>:     tags from get_tags
+    Return:
+        <bool>:     True if the tags are usable
+    '''
+    def validate_tags(self, tags):
+        if not tags:
+            return False
+        tag_set = set(tags)
+        if not tag_set.issubset(self.tags):
+            return False
+        return not any(pair.issubset(tag_set) for pair in self.exclusive_tags)
+
+    '''-------------------------------------
+    Method: has_price
+
+    Checks a post for any pricing reference
+    '''
+    def has_price(self, message_text):
+        return self._price.search(message_text) is not None
+
+    '''-------------------------------------
+    Method: has_exempt_tag
+
+    Checks a post for a tag that allows it
+    to skip the length rule
+    '''
+    def has_exempt_tag(self, message_text):
+        tags = self.get_tags(message_text)
+        return bool(tags) and not self.exempt_tags.isdisjoint(tags)
+
+    '''-------------------------------------
+    Method: violations
+
+    Runs every rule against a post
+
+    Input:
+        <message_text>: post message
+    Return:
+        <tuple>:        broken Rules, in RULES order;
+                        empty when the post is valid
+    '''
+    def violations(self, message_text):
+        short = len(message_text) < self.min_length
+        priced = exempt = False
+
+        # Single pass for pricing and length exemption keywords
+        for match in self._scan.finditer(message_text):
+            if match.lastgroup == 'price':
+                priced = True
+            else:
+                exempt = True
+            if priced and (exempt or not short):
+                break
+
+        tags = self.get_tags(message_text)
+
+        broken = []
+        if not priced:
+            broken.append(PRICE)
+        if not self.validate_tags(tags):
+            broken.append(TAG)
+        if short and not exempt and \
+                not (tags and not self.exempt_tags.isdisjoint(tags)):
+            broken.append(LENGTH)
+        return tuple(broken)
+
+    '''-------------------------------------
+    Method: verdict
+
+    Compact form of violations, used by batches
+
+    Input:
+        <message_text>: post message
+    Return:
+        <int>:          bitmask of broken Rule flags,
+                        VALID when the post is valid
+    '''
+    def verdict(self, message_text):
+        mask = VALID
+        for rule in self.violations(message_text):
+            mask |= rule.flag
+        return mask
+
+    '''-------------------------------------
+    Method: validate_batch
+
+    Validates many posts at once. Batches over
+    batch_threshold are split into chunks and
+    spread across a process pool
+
+    Input:
+        <posts>:    iterable of post dicts with
+                    post_id, message, actor_id
+        <workers>:  processes to use for large
+                    batches, 1 stays in-process
+        <memo>:     VerdictCache, only posts that
+                    miss in it are validated
+    Return:
+        <array>:    one verdict byte per post, in
+                    the same order as <posts>
+    '''
+    def validate_batch(self, posts, workers=1, memo=None):
+        posts = list(posts)
+        if memo is None:
+            return self._validate_messages(
+                [post['message'] or '' for post in posts], workers)
+
+        memo.check_rules(self.fingerprint)
+        verdicts = array('B', [VALID] * len(posts))
+        missed = []
+        for i, post in enumerate(posts):
+            verdict = memo.get(post['post_id'], post['message'])
+            if verdict is None:
+                missed.append(i)
+            else:
+                verdicts[i] = verdict
+
+        fresh = self._validate_messages(
+            [posts[i]['message'] or '' for i in missed], workers)
+        for i, verdict in zip(missed, fresh):
+            verdicts[i] = verdict
+            memo.put(posts[i]['post_id'], posts[i]['message'], verdict)
+        return verdicts
+
+    def _validate_messages(self, messages, workers):
+        if workers <= 1 or len(messages) < batch_threshold:
+            return array('B', map(self.verdict, messages))
+
+        chunks = [messages[i:i + batch_chunk_size]
+                  for i in range(0, len(messages), batch_chunk_size)]
+        verdicts = array('B')
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as pool:
+            for chunk_verdicts in pool.map(_validate_chunk, chunks):
+                verdicts.extend(chunk_verdicts)
+        return verdicts
+
+
+'''-------------------------------------
+Process Pool Workers
+====================
+Each worker process receives its own copy
+of the rule set once, then validates chunks
+'''
+_worker_rules = None
+
+
+def _init_worker(rule_set):
+    global _worker_rules
+    _worker_rules = rule_set
+
+
+def _validate_chunk(messages):
+    return array('B', map(_worker_rules.verdict, messages))
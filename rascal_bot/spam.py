@@ -0,0 +1,312 @@
+import random
+import re
+import time
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+
+from cache import message_digest
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       spam.py
+Author:     @WhitneyOnTheWeb
+
+Near-duplicate post detection for repost and spam blast clean-up
+
+- Each post's normalized text is reduced to a MinHash signature, and
+  the signatures are banded into an LSH table, so finding posts with
+  close to the same text only looks at the posts sharing a bucket
+  instead of comparing against every recent post
+- The index is kept up to date as posts are read, and forgets posts
+  once they're older than its window
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+num_perm = 64                       # bins (minimums) per signature
+num_bands = 16                      # LSH bands, num_perm / bands rows each
+shingle_size = 5                    # characters per shingle
+min_text = 40                       # shortest normalized text indexed
+hash_seed = 0x5ca1                  # fixed, saved signatures must line up
+
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 32) - 1
+empty_bin = 1 << 32                 # bin no shingle hashed into
+rotation = 0x9e3779b1               # offset per bin an empty one borrows across
+
+url_pattern = re.compile(r'https?://\S+|www\.\S+')
+non_word_pattern = re.compile(r'[\W_]+', re.UNICODE)
+
+# A post that reads like an earlier one, <match_id> by <match_actor_id>
+Duplicate = namedtuple('Duplicate', ['post_id', 'actor_id', 'match_id',
+                                     'match_actor_id', 'similarity'])
+
+
+'''-------------------------------------
+Method: normalize
+
+Reduces a post to the text that matters
+for comparing it: lowercase words, without
+links, punctuation or extra whitespace
+'''
+def normalize(text):
+    text = url_pattern.sub(' ', (text or '').lower())
+    return ' '.join(non_word_pattern.sub(' ', text).split())
+
+
+'''-------------------------------------
+Method: shingles
+
+Hashes every <size> character run of a
+normalized text
+
+Return:
+    <set>:  32 bit shingle hashes
+'''
+def shingles(text, size=shingle_size):
+    data = text.encode('utf-8')
+    if len(data) <= size:
+        return {zlib.crc32(data)}
+    return set(zlib.crc32(data[i:i + size])
+               for i in range(len(data) - size + 1))
+
+
+'''-------------------------------------
+Class: NearDuplicateIndex
+
+MinHash / LSH index of recent post texts
+
+- Two posts land in the same bucket for a
+  band when that slice of their signatures
+  matches, so posts that are alike share
+  a bucket with high probability
+- Bucket hits are checked against the
+  <threshold> by estimated Jaccard
+  similarity of the full signatures
+- Posts are dropped <window> seconds after
+  they were indexed, least recent first
+  past <max_size>
+- Only the signatures are pickled, the LSH
+  table is rebuilt on load
+
+Input:
+    <threshold>:    similarity to flag, 0 - 1
+    <window>:       seconds a post is kept
+    <max_size>:     most posts to hold
+'''
+class NearDuplicateIndex(object):
+    version = 0                         # bumped on every change, for BotState
+
+    def __init__(self, threshold=0.8, window=604800, max_size=20000):
+        self.threshold = threshold
+        self.window = window
+        self.max_size = max_size
+        self.flagged = []               # Duplicates not yet drained
+        self._entries = OrderedDict()   # post_id -> (digest, sig, actor, time)
+        self._buckets = {}              # (band, band bytes) -> post IDs
+        self._rows = num_perm // num_bands
+
+        rng = random.Random(hash_seed)
+        self._mix = (rng.randint(1, mersenne_prime - 1),
+                     rng.randint(0, mersenne_prime - 1))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, post_id):
+        return post_id in self._entries
+
+    '''-------------------------------------
+    Method: signature
+
+    One permutation MinHash signature of a
+    text's shingles: each shingle is hashed
+    once, into one of num_perm bins, and
+    each bin keeps its least value. A bin
+    nothing landed in borrows from the next
+    filled bin, so short texts still line up
+
+    Input:
+        <text>: normalized post text
+    Return:
+        <array>:    num_perm 32 bit minimums
+    '''
+    def signature(self, text):
+        a, b = self._mix
+        bins = [empty_bin] * num_perm
+        for h in shingles(text):
+            h = (a * h + b) % mersenne_prime
+            i = h % num_perm
+            value = (h // num_perm) & max_hash
+            if value < bins[i]:
+                bins[i] = value
+
+        if empty_bin in bins:
+            filled = [i for i in range(num_perm) if bins[i] != empty_bin]
+            for i in range(num_perm):
+                if bins[i] == empty_bin:
+                    j = next((f for f in filled if f > i), filled[0])
+                    distance = (j - i) % num_perm
+                    bins[i] = (bins[j] + distance * rotation) & max_hash
+        return array('I', bins)
+
+    def _bands(self, sig):
+        rows = self._rows
+        return [(band, sig[band * rows:(band + 1) * rows].tobytes())
+                for band in range(num_bands)]
+
+    '''-------------------------------------
+    Method: query
+
+    Finds indexed posts whose text is close
+    to <text>
+
+    Input:
+        <text>:     post message
+        <exclude>:  post ID to leave out, eg.
+                    the post itself
+    Return:
+        <list>:     (post_id, actor_id, similarity),
+                    most similar first
+    '''
+    def query(self, text, exclude=None, now=None):
+        text = normalize(text)
+        if len(text) < min_text:
+            return []
+        return self._matches(self.signature(text), exclude, now)
+
+    def _matches(self, sig, exclude, now):
+        if now is None:
+            now = time.time()
+        candidates = set()
+        for key in self._bands(sig):
+            candidates.update(self._buckets.get(key, ()))
+        candidates.discard(exclude)
+
+        matches = []
+        for post_id in candidates:
+            _, other, actor_id, seen = self._entries[post_id]
+            if now - seen > self.window:
+                continue
+            similarity = sum(1 for x, y in zip(sig, other) if x == y) / \
+                float(num_perm)
+            if similarity >= self.threshold:
+                matches.append((post_id, actor_id, similarity))
+        matches.sort(key=lambda match: -match[2])
+        return matches
+
+    '''-------------------------------------
+    Method: add
+
+    Indexes a post, replacing the signature
+    of an older version of it
+
+    Return:
+        <array>:    its signature, None if the
+                    text is too short to index
+    '''
+    def add(self, post_id, actor_id, text, now=None):
+        if now is None:
+            now = time.time()
+        self.discard(post_id)
+        text = normalize(text)
+        if len(text) < min_text:
+            return None
+        sig = self.signature(text)
+        self._insert(post_id, (message_digest(text), sig, actor_id, now))
+        return sig
+
+    def _insert(self, post_id, entry):
+        self._entries[post_id] = entry
+        self.version += 1
+        for key in self._bands(entry[1]):
+            self._buckets.setdefault(key, set()).add(post_id)
+        while len(self._entries) > self.max_size:
+            self.discard(next(iter(self._entries)))
+
+    def discard(self, post_id):
+        entry = self._entries.pop(post_id, None)
+        if entry is None:
+            return
+        self.version += 1
+        for key in self._bands(entry[1]):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(post_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    '''-------------------------------------
+    Method: check
+
+    Looks each post up before indexing it.
+    Posts indexed with the same text already
+    are skipped, so a post is only flagged
+    when it's new or edited
+
+    Input:
+        <posts>:    post dicts with post_id,
+                    actor_id and message
+    Return:
+        <list>:     Duplicates found, also kept
+                    in <flagged> until drained
+    '''
+    def check(self, posts, now=None):
+        if now is None:
+            now = time.time()
+        found = []
+        for post in posts:
+            post_id = post['post_id']
+            text = normalize(post['message'])
+            entry = self._entries.get(post_id)
+            if len(text) < min_text or \
+                    (entry is not None and entry[0] == message_digest(text)):
+                continue
+
+            self.discard(post_id)
+            sig = self.signature(text)
+            for match_id, match_actor_id, similarity in \
+                    self._matches(sig, post_id, now):
+                found.append(Duplicate(post_id, post['actor_id'], match_id,
+                                       match_actor_id, similarity))
+                break               # the closest match is enough
+            self._insert(post_id, (message_digest(text), sig,
+                                   post['actor_id'], now))
+        self.flagged.extend(found)
+        return found
+
+    def drain(self):
+        flagged, self.flagged = self.flagged, []
+        return flagged
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+        dropped = 0
+        while self._entries:
+            post_id, entry = next(iter(self._entries.items()))
+            if now - entry[3] <= self.window:
+                break
+            self.discard(post_id)
+            dropped += 1
+        return dropped
+
+    def __getstate__(self):
+        self.prune()
+        return {'threshold': self.threshold,
+                'window': self.window,
+                'max_size': self.max_size,
+                'entries': [(post_id, digest, sig.tobytes(), actor_id, seen)
+                            for post_id, (digest, sig, actor_id, seen)
+                            in self._entries.items()]}
+
+    def __setstate__(self, state):
+        self.__init__(state['threshold'], state['window'], state['max_size'])
+        for post_id, digest, sig, actor_id, seen in state['entries']:
+            self._insert(post_id, (digest, array('I', sig), actor_id, seen))
+        self.prune()
@@ -0,0 +1,150 @@
+import time
+
+import util as u
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       state.py
+Author:     @WhitneyOnTheWeb
+
+In-memory bot state shared across runs in one process
+
+- Properties and caches are loaded from the store once, then kept in
+  memory between polls
+- Flushes only write the entries that changed since they were last
+  loaded or saved, with a full write at every checkpoint
+- Changes are tracked as they're made, nothing is re-serialized just
+  to tell whether it changed
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Class: BotState
+
+Properties, caches and the graph client
+for a long-running process
+
+- Caches with a <version> attribute bump
+  it on every change. Each entry keeps the
+  version of its last load or save, so a
+  flush can tell what's dirty
+- Anything else, eg. the properties, is
+  only dirty once it's replaced or marked
+  with mark_dirty()
+- Flushes write every entry once
+  <checkpoint> seconds have passed since
+  the last full write
+
+Input:
+    <checkpoint>:   seconds between full
+                    writes, None for never
+'''
+class BotState(object):
+    def __init__(self, checkpoint=None):
+        self.checkpoint = checkpoint
+        self.last_checkpoint = time.time()
+        self.graph = None
+        self.graph_token = None
+        self.journal = None     # ModerationJournal, compacted on flush
+        self._entries = {}      # name -> [obj, save, version, marked]
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    '''-------------------------------------
+    Method: track
+
+    Returns the in-memory copy of an entry,
+    loading it on first use
+
+    Input:
+        <name>: entry name
+        <load>: function returning the stored
+                value
+        <save>: function writing a value back
+    '''
+    def track(self, name, load, save):
+        if name not in self._entries:
+            obj = load()
+            self._entries[name] = [obj, save, version(obj), False]
+        return self._entries[name][0]
+
+    def cache(self, name, default):
+        return self.track(name, lambda: u.load_cache(name, default),
+                          lambda data: u.save_cache(name, data))
+
+    def properties(self):
+        return self.track(u.prop_file, u.load_properties, u.save_properties)
+
+    '''-------------------------------------
+    Method: replace
+
+    Swaps in a new object for an entry, eg.
+    a cache rebuilt during the run
+    '''
+    def replace(self, name, obj):
+        self._entries[name][0] = obj
+        self._entries[name][3] = True
+
+    def mark_dirty(self, name):
+        self._entries[name][3] = True
+
+    def dirty(self):
+        return [name for name, (obj, _, seen, marked) in self._entries.items()
+                if marked or version(obj) != seen]
+
+    def checkpoint_due(self, now=None):
+        if self.checkpoint is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.last_checkpoint >= self.checkpoint
+
+    '''-------------------------------------
+    Method: flush
+
+    Writes dirty entries back to the store,
+    or every entry at a checkpoint. The
+    journal is compacted at checkpoints or
+    once it's long enough
+
+    Input:
+        <force>:    write everything
+        <compact>:  compact the journal, even
+                    if it's short
+    Return:
+        <list>:     names of entries written
+    '''
+    def flush(self, force=False, now=None, compact=False):
+        if now is None:
+            now = time.time()
+        force = force or self.checkpoint_due(now)
+
+        written = []
+        for name, entry in self._entries.items():
+            obj, save, seen, marked = entry
+            if force or marked or version(obj) != seen:
+                save(obj)
+                # Saving can prune, so the version is read after
+                entry[2], entry[3] = version(obj), False
+                written.append(name)
+
+        if self.journal is not None and \
+                (force or compact or self.journal.should_compact()):
+            self.journal.compact()
+            written.append(self.journal.snapshot_name)
+
+        if force:
+            self.last_checkpoint = now
+        return written
+
+
+'''-------------------------------------
+Method: version
+
+Change counter of a tracked object, None
+for objects that don't keep one
+'''
+def version(obj):
+    return getattr(obj, 'version', None)
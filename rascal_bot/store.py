@@ -0,0 +1,388 @@
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+
+from cache import PostCache
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       store.py
+Author:     @WhitneyOnTheWeb
+
+Storage backends for RASCAL's properties and caches
+
+- Every backend has the same interface, util.load_cache / save_cache and
+  load_properties / save_properties go through whichever is configured
+- SQLiteStore keeps warned posts, valid posts and properties in indexed
+  tables, upserting only the rows that changed, one transaction per save
+- MemcachedStore keeps the Heroku setup working
+- PickleStore is the old one-file-per-cache layout, written atomically.
+  SQLiteStore reads from it when a cache hasn't been migrated yet
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+properties_key = 'properties'       # name properties are stored under
+manifest_tag = '_rascal_manifest'   # marks a memcached manifest value
+chunk_size = 900 * 1024             # bytes per memcached value, limit is 1 MB
+compress_level = 6                  # zlib level for memcached values
+
+schema = """
+CREATE TABLE IF NOT EXISTS warned_posts (
+    cache       TEXT NOT NULL,
+    post_id     TEXT NOT NULL,
+    warned_at   REAL NOT NULL,
+    PRIMARY KEY (cache, post_id)
+);
+CREATE INDEX IF NOT EXISTS warned_posts_time ON warned_posts (cache, warned_at);
+CREATE TABLE IF NOT EXISTS valid_posts (
+    cache       TEXT NOT NULL,
+    post_id     TEXT NOT NULL,
+    seen_at     REAL NOT NULL,
+    PRIMARY KEY (cache, post_id)
+);
+CREATE INDEX IF NOT EXISTS valid_posts_time ON valid_posts (cache, seen_at);
+CREATE TABLE IF NOT EXISTS properties (
+    key         TEXT PRIMARY KEY,
+    value       BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    name        TEXT PRIMARY KEY,
+    data        BLOB NOT NULL
+);
+"""
+
+
+'''-------------------------------------
+Class: Store
+
+Interface every backend implements
+
+- load() returns None when nothing is
+  stored under the name
+- <default> tells a backend what shape
+  the data takes, it's never returned
+'''
+class Store(object):
+    def load(self, name, default=None):
+        raise NotImplementedError
+
+    def save(self, name, data):
+        raise NotImplementedError
+
+    def load_properties(self):
+        return self.load(properties_key, {})
+
+    def save_properties(self, data):
+        self.save(properties_key, data)
+
+    def close(self):
+        pass
+
+
+'''-------------------------------------
+Class: PickleStore
+
+One pickle file per cache, in binary mode.
+Writes go to a temp file that replaces the
+old one, so a crash can't leave half a file
+
+Input:
+    <directory>:    where the files live
+'''
+class PickleStore(Store):
+    def __init__(self, directory='.'):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self, name, default=None):
+        path = self.path(name)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as f:
+            try:
+                return pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                return None
+
+    def save(self, name, data):
+        path = self.path(name)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                   prefix='.' + os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+'''-------------------------------------
+Class: SQLiteStore
+
+Properties and caches in one SQLite file
+
+- dicts of post ID -> time (the warned
+  cache) go in warned_posts
+- PostCaches go in valid_posts
+- Properties get a row per key
+- Anything else is pickled into objects
+- Caches missing from the database are
+  read from <legacy> pickles, if any
+
+Input:
+    <path>:     database file
+    <legacy>:   PickleStore to migrate from
+'''
+class SQLiteStore(Store):
+    def __init__(self, path='rascal.db', legacy=None):
+        self.path = path
+        self.legacy = legacy
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.close()
+
+    '''-------------------------------------
+    Method: transaction
+
+    Runs <func> with a cursor inside one
+    transaction, rolled back if it raises
+    '''
+    def transaction(self, func, *args):
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(cursor, *args)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return result
+
+    def load(self, name, default=None):
+        if name == properties_key:
+            obj = self._load_properties()
+        elif isinstance(default, PostCache):
+            obj = self._load_valid(name, default)
+        elif isinstance(default, dict):
+            obj = self._load_warned(name)
+        else:
+            row = self.conn.execute('SELECT data FROM objects WHERE name=?',
+                                    (name,)).fetchone()
+            obj = pickle.loads(bytes(row[0])) if row else None
+
+        if obj is None and self.legacy is not None:
+            obj = self.legacy.load(name, default)
+        return obj
+
+    def save(self, name, data):
+        if name == properties_key:
+            self.transaction(self._save_properties, data)
+        elif isinstance(data, PostCache):
+            self.transaction(self._save_rows, 'valid_posts', 'seen_at', name,
+                             data.items())
+        elif isinstance(data, dict):
+            self.transaction(self._save_rows, 'warned_posts', 'warned_at',
+                             name, data.items())
+        else:
+            blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            self.transaction(lambda c: c.execute(
+                'INSERT INTO objects (name, data) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET data=excluded.data',
+                (name, sqlite3.Binary(blob))))
+
+    def _load_warned(self, name):
+        rows = self.conn.execute(
+            'SELECT post_id, warned_at FROM warned_posts WHERE cache=? '
+            'ORDER BY warned_at', (name,)).fetchall()
+        if not rows and not self._has_cache('warned_posts', name):
+            return None
+        return dict(rows)
+
+    def _load_valid(self, name, default):
+        rows = self.conn.execute(
+            'SELECT post_id, seen_at FROM valid_posts WHERE cache=? '
+            'ORDER BY seen_at', (name,)).fetchall()
+        if not rows and not self._has_cache('valid_posts', name):
+            return None
+        cache = PostCache(default.max_size, default.ttl)
+        for post_id, seen in rows:
+            cache.add(post_id, seen)
+        return cache
+
+    def _load_properties(self):
+        rows = self.conn.execute('SELECT key, value FROM properties').fetchall()
+        if not rows:
+            return None
+        return dict((key, pickle.loads(bytes(value))) for key, value in rows)
+
+    '''-------------------------------------
+    Method: _has_cache
+
+    Checks if an empty cache was saved, as
+    opposed to never saved. Saving a cache
+    leaves a marker row in objects
+    '''
+    def _has_cache(self, table, name):
+        return self.conn.execute(
+            'SELECT 1 FROM objects WHERE name=?',
+            (table + ':' + name,)).fetchone() is not None
+
+    '''-------------------------------------
+    Method: _save_rows
+
+    Brings a cache's rows in line with
+    <items>: upserts new and changed rows,
+    deletes the ones that are gone
+    '''
+    def _save_rows(self, cursor, table, column, name, items):
+        stored = dict(cursor.execute(
+            'SELECT post_id, ' + column + ' FROM ' + table + ' WHERE cache=?',
+            (name,)).fetchall())
+        items = dict(items)
+
+        cursor.executemany(
+            'INSERT INTO ' + table + ' (cache, post_id, ' + column + ') '
+            'VALUES (?, ?, ?) ON CONFLICT (cache, post_id) '
+            'DO UPDATE SET ' + column + '=excluded.' + column,
+            [(name, post_id, seen) for post_id, seen in items.items()
+             if post_id not in stored or stored[post_id] != seen])
+        cursor.executemany(
+            'DELETE FROM ' + table + ' WHERE cache=? AND post_id=?',
+            [(name, post_id) for post_id in stored if post_id not in items])
+        cursor.execute('INSERT OR IGNORE INTO objects (name, data) '
+                       'VALUES (?, ?)', (table + ':' + name, b''))
+
+    def _save_properties(self, cursor, data):
+        stored = dict(cursor.execute(
+            'SELECT key, value FROM properties').fetchall())
+        rows = []
+        for key, value in data.items():
+            blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if stored.get(key) != blob:
+                rows.append((key, sqlite3.Binary(blob)))
+        cursor.executemany(
+            'INSERT INTO properties (key, value) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value=excluded.value', rows)
+        cursor.executemany('DELETE FROM properties WHERE key=?',
+                           [(key,) for key in stored if key not in data])
+
+
+'''-------------------------------------
+Method: is_manifest
+
+Checks if a memcached value is a manifest
+rather than a value saved before them
+'''
+def is_manifest(obj):
+    return isinstance(obj, dict) and obj.get(manifest_tag) == 1
+
+
+'''-------------------------------------
+Class: MemcachedStore
+
+Properties and caches as memcached values
+
+- Values are pickled and zlib compressed
+- Small values sit inline in the cache's
+  manifest key. Larger ones are split into
+  chunk_size pieces under keys tagged with
+  the manifest's version, so a reader never
+  mixes pieces of two saves
+- Loads are one get_multi when the chunk
+  count is known from the last load / save,
+  saves are one set_multi plus the manifest
+- Values saved before manifests existed
+  are still read as they are
+
+Input:
+    <client>:   memcached client, eg. from
+                bmemcached
+'''
+class MemcachedStore(Store):
+    def __init__(self, client):
+        self.client = client
+        self.known = {}         # name -> (version, chunks) last seen
+
+    def chunk_keys(self, name, version, chunks):
+        return ['%s:%d:%d' % (name, version, i) for i in range(chunks)]
+
+    def load(self, name, default=None):
+        version, chunks = self.known.get(name, (0, 0))
+        keys = [name] + self.chunk_keys(name, version, chunks)
+        values = self.client.get_multi(keys) or {}
+
+        manifest = values.get(name)
+        if not manifest:
+            return None
+        if not is_manifest(manifest):
+            return manifest         # saved before manifests
+
+        if manifest['inline'] is not None:
+            blob = manifest['inline']
+        else:
+            keys = self.chunk_keys(name, manifest['version'],
+                                   manifest['chunks'])
+            if manifest['version'] != version or \
+                    manifest['chunks'] != chunks:
+                values = self.client.get_multi(keys) or {}
+            if any(key not in values for key in keys):
+                return None         # evicted, or a save that didn't finish
+            blob = b''.join(values[key] for key in keys)
+
+        if zlib.crc32(blob) != manifest['crc']:
+            return None
+        self.known[name] = (manifest['version'], manifest['chunks'])
+        return pickle.loads(zlib.decompress(blob))
+
+    def save(self, name, data):
+        blob = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+                             compress_level)
+        old_version, old_chunks = self.known.get(name, (0, 0))
+        # Versions are timestamps, so other processes' saves don't collide
+        version = max(old_version + 1, int(time.time() * 1000))
+        manifest = {manifest_tag: 1, 'version': version,
+                    'chunks': 0, 'crc': zlib.crc32(blob), 'inline': None}
+
+        if len(blob) <= chunk_size:
+            manifest['inline'] = blob
+        else:
+            pieces = [blob[i:i + chunk_size]
+                      for i in range(0, len(blob), chunk_size)]
+            manifest['chunks'] = len(pieces)
+            keys = self.chunk_keys(name, manifest['version'], len(pieces))
+            self._check(self.client.set_multi(dict(zip(keys, pieces))), name)
+
+        # The manifest goes last, it points at pieces that are all there
+        self._check(self.client.set(name, manifest), name)
+        self.known[name] = (manifest['version'], manifest['chunks'])
+
+        # Old pieces aren't reachable anymore
+        if old_chunks and hasattr(self.client, 'delete_multi'):
+            self.client.delete_multi(self.chunk_keys(name, old_version,
+                                                     old_chunks))
+
+    def _check(self, result, name):
+        # bmemcached returns a bool, pylibmc the keys that failed
+        if result is False or (isinstance(result, (list, set)) and result):
+            raise IOError('Could not save "%s" to memcached' % name)
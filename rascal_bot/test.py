@@ -1,6 +1,6 @@
 import os
 import sys
-from util import notify_mac
+from util import notify
 import unittest
 
 __author__ = 'Henri Sweers'
@@ -211,6 +211,1757 @@ class TestPriceValidity(unittest.TestCase):
         self.assertTrue(check_price_validity("Blah blah 300amo"))
 
 
+class TestPostRuleSet(unittest.TestCase):
+    def setUp(self):
+        from rules import PostRuleSet
+        self.rules = PostRuleSet(["found", "made", "parking"])
+        self.junk = """here's some other text because yeah more text to
+            to illustrate lots more text here in the rest of the post""" * 3
+
+    def test_valid(self):
+        self.assertEqual(self.rules.violations(
+            "[found] $20 " + self.junk), ())
+
+    def test_all_violations(self):
+        from rules import PRICE, TAG, LENGTH
+        self.assertEqual(self.rules.violations("short"),
+                         (PRICE, TAG, LENGTH))
+        self.assertEqual(self.rules.violations("[blah] 300/mo"),
+                         (TAG, LENGTH))
+
+    def test_tags(self):
+        self.assertEqual(self.rules.get_tags("-[Found](made): x"),
+                         ["found", "made"])
+        self.assertEqual(self.rules.get_tags("* (found)"), ["found"])
+        self.assertIsNone(self.rules.get_tags("dsflkj {found)"))
+        self.assertFalse(self.rules.validate_tags(["found", "blah"]))
+
+    def test_exclusive_tags(self):
+        from rules import PostRuleSet
+        rules = PostRuleSet(["rooming", "offering", "looking"])
+        self.assertFalse(rules.validate_tags(["rooming", "offering"]))
+        self.assertTrue(rules.validate_tags(["rooming", "looking"]))
+
+    def test_default_tags(self):
+        from rules import PostRuleSet
+        from TestPosts import bad_posts, good_posts
+        rules = PostRuleSet()
+        self.assertEqual([rules.violations(post) for post in good_posts],
+                         [()] * len(good_posts))
+        self.assertTrue(all(rules.violations(post) for post in bad_posts))
+
+    def test_runner_tag_rules(self):
+        import post_cleanup
+        import rascal
+        self.assertTrue(
+            rascal.post_rules.validate_tags(["rooming", "offering"]))
+        self.assertFalse(rascal.post_rules.validate_tags(["found"]))
+        self.assertEqual(post_cleanup.post_rules.tags,
+                         frozenset(["found", "made", "gifted", "question",
+                                    "random"]))
+        self.assertFalse(post_cleanup.post_rules.validate_tags(["rooming"]))
+
+    def test_length_exemptions(self):
+        from rules import LENGTH
+        self.assertNotIn(LENGTH, self.rules.violations("[parking] $5"))
+        self.assertNotIn(LENGTH, self.rules.violations(
+            "[found] $5 see CraigsList"))
+        self.assertIn(LENGTH, self.rules.violations("[found] $5"))
+
+    def test_verdict(self):
+        from rules import VALID, PRICE, LENGTH, rules_for
+        self.assertEqual(self.rules.verdict("[found] $1 " + self.junk), VALID)
+        verdict = self.rules.verdict("[found] short")
+        self.assertEqual(verdict, PRICE.flag | LENGTH.flag)
+        self.assertEqual(rules_for(verdict), (PRICE, LENGTH))
+
+    def test_validate_batch(self):
+        import rules
+        posts = [{'post_id': str(i), 'actor_id': '1',
+                  'message': "[found] $%d " % i + (self.junk if i % 2 else "")}
+                 for i in range(40)]
+        serial = self.rules.validate_batch(posts)
+        _threshold, _chunk = rules.batch_threshold, rules.batch_chunk_size
+        rules.batch_threshold, rules.batch_chunk_size = 10, 7
+        try:
+            pooled = self.rules.validate_batch(posts, workers=2)
+        finally:
+            rules.batch_threshold, rules.batch_chunk_size = _threshold, _chunk
+        self.assertEqual(list(serial), list(pooled))
+        self.assertEqual(list(serial[:2]), [rules.LENGTH.flag, rules.VALID])
+
+
+class TestPostCache(unittest.TestCase):
+
+    def test_lookup_and_ttl(self):
+        import time
+        from cache import PostCache
+        cache = PostCache(ttl=60)
+        cache.add("1")
+        cache.add("2", now=time.time() - 120)
+        self.assertIn("1", cache)
+        self.assertNotIn("2", cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_prune_out_of_order(self):
+        from cache import PostCache
+        cache = PostCache(ttl=150)
+        cache.add("new", now=100)
+        cache.add("old", now=10)
+        self.assertEqual(cache.prune(now=200), 1)
+        self.assertEqual(list(cache), ["new"])
+
+    def test_size_cap(self):
+        from cache import PostCache
+        cache = PostCache(max_size=2)
+        cache.update(["1", "2"])
+        self.assertIn("1", cache)  # refreshes "1", so "2" is evicted next
+        cache.add("3")
+        self.assertEqual(sorted(cache), ["1", "3"])
+
+    def test_pickle_live_only(self):
+        import pickle
+        import time
+        from cache import PostCache
+        cache = PostCache(ttl=60)
+        cache.add("old", now=time.time() - 120)
+        cache.add("new")
+        restored = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(list(restored), ["new"])
+
+    def test_upgrade_legacy_list(self):
+        from cache import PostCache
+        from util import upgrade_cache
+        cache = upgrade_cache(["1", "2"], PostCache(max_size=5))
+        self.assertIsInstance(cache, PostCache)
+        self.assertIn("2", cache)
+
+
+class TestFeedCursor(unittest.TestCase):
+
+    class StreamGraph(object):
+        """Answers stream FQL queries from an in-memory feed"""
+        def __init__(self, posts):
+            self.posts = posts
+            self.queries = 0
+
+        def fql(self, query):
+            import re
+            self.queries += 1
+            since = int(re.search(r"updated_time>=(\d+)", query).group(1))
+            limit, offset = map(int, re.search(
+                r"LIMIT (\d+) OFFSET (\d+)", query).groups())
+            rows = sorted((p for p in self.posts if p['updated_time'] >= since),
+                          key=lambda p: p['updated_time'])
+            return {'data': rows[offset:offset + limit]}
+
+    def feed(self, count, start=100):
+        return [{'post_id': str(i), 'message': '', 'actor_id': '1',
+                 'created_time': start + i, 'updated_time': start + i}
+                for i in range(count)]
+
+    def test_pages_past_window(self):
+        from feed import FeedCursor, iter_group_posts
+        graph = self.StreamGraph(self.feed(120))
+        cursor = FeedCursor(0)
+        posts = list(iter_group_posts(graph, "1", cursor))
+        self.assertEqual(len(posts), 120)
+        self.assertEqual(cursor.since, 219)
+
+    def test_only_delta(self):
+        from feed import FeedCursor, iter_group_posts
+        posts = self.feed(10)
+        graph = self.StreamGraph(posts)
+        cursor = FeedCursor(0)
+        list(iter_group_posts(graph, "1", cursor))
+        posts[3]['updated_time'] = 500  # edited
+        posts.append({'post_id': 'new', 'message': '', 'actor_id': '1',
+                      'created_time': 501, 'updated_time': 501})
+        delta = [p['post_id'] for p in iter_group_posts(graph, "1", cursor)]
+        self.assertEqual(delta, ["3", "new"])
+        self.assertEqual(list(iter_group_posts(graph, "1", cursor)), [])
+
+    def test_shared_timestamps(self):
+        from feed import FeedCursor, iter_group_posts
+        posts = self.feed(130)
+        for post in posts[:120]:
+            post['updated_time'] = 100
+        cursor = FeedCursor(0)
+        ids = [p['post_id'] for p in
+               iter_group_posts(self.StreamGraph(posts), "1", cursor)]
+        self.assertEqual(sorted(ids), sorted(p['post_id'] for p in posts))
+
+
+class TestCommentBatch(unittest.TestCase):
+
+    class CommentGraph(object):
+        """Answers comment FQL queries and multi-queries"""
+        def __init__(self):
+            self.requests = 0
+
+        def rows(self, query):
+            import re
+            ids = re.findall(r'"([^"]+)"', query)
+            return [{'post_id': i, 'fromid': 1, 'id': i + '_c', 'time': 0}
+                    for i in ids if i.startswith("commented")]
+
+        def fql(self, query):
+            self.requests += 1
+            if isinstance(query, dict):
+                return {'data': [{'name': name,
+                                  'fql_result_set': self.rows(q)}
+                                 for name, q in query.items()]}
+            return {'data': self.rows(query)}
+
+    def test_single_request(self):
+        from graph import CommentBatch
+        graph = self.CommentGraph()
+        batch = CommentBatch(graph)
+        for post_id in ["commented1", "plain", "commented2", "plain"]:
+            batch.add(post_id)
+        comments = batch.fetch()
+        self.assertEqual(graph.requests, 1)
+        self.assertEqual(comments["plain"], [])
+        self.assertEqual(comments["commented2"][0]['id'], "commented2_c")
+        self.assertEqual(len(batch), 0)
+
+    def test_multi_query(self):
+        from graph import CommentBatch
+        graph = self.CommentGraph()
+        batch = CommentBatch(graph)
+        for i in range(120):
+            batch.add("commented%d" % i)
+        comments = batch.fetch()
+        self.assertEqual(graph.requests, 1)
+        self.assertEqual(len(comments), 120)
+        self.assertTrue(all(len(c) == 1 for c in comments.values()))
+
+
+class TestDeleteExecutor(unittest.TestCase):
+
+    class BatchGraph(object):
+        """Deletes in batches, "flaky" IDs fail once, "slow" IDs are
+        throttled and "bad" IDs fail"""
+        def __init__(self):
+            self.batches = []
+            self.flaked = set()
+
+        def batch(self, requests):
+            from facepy.exceptions import FacebookError
+            self.batches.append(len(requests))
+            for request in requests:
+                object_id = request['relative_url']
+                if object_id.startswith("bad"):
+                    yield FacebookError("Unsupported delete", 100)
+                elif object_id.startswith("slow"):
+                    yield FacebookError("Too many calls", 4)
+                elif object_id.startswith("flaky") and \
+                        object_id not in self.flaked:
+                    self.flaked.add(object_id)
+                    yield FacebookError("Service unavailable", 2)
+                else:
+                    yield True
+
+    def test_batches_and_retries(self):
+        from graph import DeleteExecutor
+        graph = self.BatchGraph()
+        deletes = DeleteExecutor(graph, workers=2, backoff=0)
+        for i in range(120):
+            deletes.submit(str(i))
+        deletes.submit("flaky1")
+        deletes.submit("bad1")
+        deletes.submit("slow1")
+        deletes.submit("1")
+        report = deletes.run()
+        self.assertEqual(graph.batches, [50, 50, 23, 1])
+        self.assertEqual(len(report.deleted), 121)
+
+        # Throttling is the rate limiter's to retry, not the executor's
+        self.assertEqual(sorted(report.failed), ["bad1", "slow1"])
+        self.assertTrue(report.ok("flaky1"))
+        self.assertEqual(len(deletes), 0)
+
+
+class TestVerificationQueue(unittest.TestCase):
+
+    class LookupGraph(object):
+        """Posts in <live> still exist, "flaky" IDs time out"""
+        def __init__(self, live):
+            self.live = live
+
+        def get(self, post_id):
+            from facepy.exceptions import FacebookError, HTTPError
+            if post_id.startswith("flaky"):
+                raise HTTPError("timed out")
+            if post_id in self.live:
+                return {'id': post_id}
+            raise FacebookError("Unsupported get request", 100)
+
+    def test_check(self):
+        from graph import VerificationQueue
+        queue = VerificationQueue(delay=3, max_checks=2)
+        for post_id in ["gone", "stuck", "flaky"]:
+            queue.add(post_id, now=100)
+        queue.add("recent", now=200)
+        graph = self.LookupGraph(live={"stuck", "recent"})
+
+        self.assertEqual(queue.due_by(), 203)
+        self.assertEqual(queue.check(graph, now=101), ([], []))
+        self.assertEqual(queue.check(graph, now=200), (["gone"], []))
+
+        # Lookups that time out count too
+        self.assertEqual(queue.check(graph, now=210),
+                         ([], ["stuck", "flaky"]))
+        self.assertEqual(sorted(queue.pending), ["recent"])
+        self.assertEqual(queue.pending["recent"][1], 1)
+        self.assertIsNone(VerificationQueue().due_by())
+
+    def test_carries_over(self):
+        import pickle
+        from graph import VerificationQueue
+        queue = VerificationQueue()
+        queue.add("1")
+        restored = pickle.loads(pickle.dumps(queue))
+        self.assertEqual(list(restored.pending), ["1"])
+
+
+class TestAdminRoster(unittest.TestCase):
+
+    class MemberGraph(object):
+        """Answers group_member FQL queries"""
+        def __init__(self, admins, members=()):
+            self.admins = admins
+            self.members = list(members)
+            self.queries = 0
+
+        def fql(self, query):
+            import re
+            self.queries += 1
+            if "administrator" in query:
+                return [{'uid': uid} for uid in self.admins]
+            limit, offset = map(int, re.search(
+                r"LIMIT (\d+) OFFSET (\d+)", query).groups())
+            return [{'uid': uid} for uid in self.members[offset:offset + limit]]
+
+    def test_refresh_only_when_stale(self):
+        from roster import AdminRoster
+        graph = self.MemberGraph(admins=["1", "2"])
+        roster = AdminRoster(ttl=100)
+        self.assertTrue(roster.is_stale(now=1000))
+        self.assertTrue(roster.refresh(graph, "g", now=1000))
+        self.assertTrue(roster.is_admin("2"))
+        self.assertFalse(roster.is_admin(3))
+        self.assertFalse(roster.is_stale(now=1050))
+        self.assertFalse(roster.refresh(graph, "g", now=1050))
+        self.assertEqual(graph.queries, 1)
+
+        graph.admins = ["1", "3"]
+        self.assertTrue(roster.refresh(graph, "g", now=1100))
+        self.assertEqual(roster.admin_ids, set([1, 3]))
+        self.assertFalse(roster.refresh(graph, "g", now=1200))
+
+    def test_members(self):
+        import roster as r
+        graph = self.MemberGraph(admins=[], members=range(1200))
+        roster = r.AdminRoster(ttl=100, member_ttl=1000)
+        roster.refresh(graph, "g", now=0)
+        self.assertTrue(roster.is_member("1199"))
+        self.assertEqual(graph.queries, 4)
+
+
+class TestNotificationDigest(unittest.TestCase):
+
+    def test_coalesce(self):
+        from digest import NotificationDigest
+        digest = NotificationDigest()
+        digest.add("Delete this post", "http://www.facebook.com/1")
+        digest.add("Delete this post", "http://www.facebook.com/2")
+        digest.add("Please make sure this is gone", "http://www.facebook.com/1")
+        self.assertEqual(len(digest), 2)
+        self.assertEqual(digest.drain().split("\n"), [
+            "RASCAL needs a hand with 2 posts:",
+            "- Delete this post: http://www.facebook.com/2",
+            "- Please make sure this is gone: http://www.facebook.com/1"])
+        self.assertIsNone(digest.drain())
+
+    def test_interval(self):
+        from digest import NotificationDigest
+        digest = NotificationDigest(interval=60)
+        digest.drain(now=0)
+        self.assertFalse(digest.is_due(now=100))
+        digest.add("Delete this post", "http://www.facebook.com/1")
+        self.assertFalse(digest.is_due(now=30))
+        self.assertTrue(digest.is_due(now=100))
+        self.assertFalse(NotificationDigest().is_due())
+
+
+class TestAsyncModerator(unittest.TestCase):
+
+    class FeedGraph(object):
+        """Serves a feed and comments, tracks calls in flight"""
+        def __init__(self, posts, comments):
+            import threading
+            self.posts = posts
+            self.comments = comments
+            self.posted = []
+            self.queries = []
+            self.in_flight = 0
+            self.most_in_flight = 0
+            self.lock = threading.Lock()
+
+        def fql(self, query):
+            import re
+            import time
+            with self.lock:
+                self.queries.append(query)
+                self.in_flight += 1
+                self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            time.sleep(0.01)
+            with self.lock:
+                self.in_flight -= 1
+            ids = re.findall(r'"([^"]+)"', query)
+            if "FROM comment" in query:
+                return [c for c in self.comments if c['post_id'] in ids]
+            if "post_id IN" in query:
+                return [p for p in self.posts if p['post_id'] in ids]
+            if "OFFSET 0" in query:
+                return [p for p in self.posts if p['updated_time'] > 0]
+            return []
+
+        def put_object(self, post_id, connection, message):
+            self.posted.append(post_id)
+
+    def post(self, post_id, message, updated_time=1):
+        return {'post_id': post_id, 'message': message, 'actor_id': '5',
+                'created_time': 1, 'updated_time': updated_time}
+
+    def test_run(self):
+        import asyncio
+        from cache import PostCache
+        from feed import FeedCursor
+        from graph import DeleteExecutor
+        from moderator import AsyncModerator
+        from roster import AdminRoster
+        from rules import PostRuleSet
+
+        valid = "[found] $20 " + "x" * 200
+        posts = [self.post("new%d" % i, "no tags") for i in range(10)]
+        posts += [self.post("fixed", valid), self.post("commented", "no tags"),
+                  self.post("late", "no tags", updated_time=0)]
+        comments = [{'post_id': "fixed", 'fromid': 99, 'id': "fixed_c",
+                     'time': 0},
+                    {'post_id': "commented", 'fromid': 99, 'id': "com_c",
+                     'time': 50}]
+        graph = self.FeedGraph(posts, comments)
+        already_warned = {"fixed": 0, "late": 0}
+        deletes = DeleteExecutor(graph)
+        moderator = AsyncModerator(graph, PostRuleSet(["found"]),
+                                   AdminRoster(), 99,
+                                   already_warned, PostCache(), deletes,
+                                   max_in_flight=3, now=100000)
+
+        processed, to_remove = asyncio.run(moderator.run("g", FeedCursor(0)))
+        self.assertEqual(len(processed), 13)
+        self.assertEqual(list(to_remove), ["late"])
+        self.assertEqual(sorted(graph.posted), ["new%d" % i for i in range(10)])
+        self.assertEqual(sorted(deletes.queue), ["fixed_c", "late"])
+        self.assertNotIn("fixed", already_warned)
+        self.assertEqual(already_warned["commented"], 50)
+        self.assertEqual(already_warned["new0"], 100000)
+        self.assertEqual(len([q for q in graph.queries
+                              if "FROM comment" in q]), 1)
+        self.assertLessEqual(graph.most_in_flight, 3)
+        self.assertGreater(graph.most_in_flight, 1)
+
+    def test_failed_post(self):
+        import asyncio
+        import contextlib
+        import io
+        from cache import PostCache
+        from feed import FeedCursor
+        from graph import DeleteExecutor
+        from moderator import AsyncModerator
+        from roster import AdminRoster
+        from rules import PostRuleSet
+
+        graph = self.FeedGraph([self.post("p%d" % i, "no tags")
+                                for i in range(4)], [])
+        put_object = graph.put_object
+
+        def failing_put(post_id, connection, message):
+            if post_id == "p1":
+                raise RuntimeError("Graph went away")
+            put_object(post_id, connection, message)
+        graph.put_object = failing_put
+
+        already_warned = {}
+        moderator = AsyncModerator(graph, PostRuleSet(["found"]),
+                                   AdminRoster(), 99, already_warned,
+                                   PostCache(), DeleteExecutor(graph),
+                                   now=100000)
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            asyncio.run(moderator.run("g", FeedCursor(0)))
+        self.assertEqual(sorted(graph.posted), ["p0", "p2", "p3"])
+        self.assertEqual(sorted(already_warned), ["p0", "p2", "p3"])
+        self.assertIn("Graph went away", log.getvalue())
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    class ThrottledGraph(object):
+        """Throttles the first <throttles> calls"""
+        def __init__(self, throttles=0):
+            self.throttles = throttles
+            self.calls = 0
+
+        def get(self, path):
+            from facepy.exceptions import FacebookError
+            self.calls += 1
+            if self.calls <= self.throttles:
+                raise FacebookError("Application request limit reached", 4)
+            return {'id': path}
+
+        def delete(self, path):
+            from facepy.exceptions import FacebookError
+            raise FacebookError("Unsupported delete request", 100)
+
+    def test_token_bucket(self):
+        import time
+        from ratelimit import TokenBucket
+        bucket = TokenBucket(rate=100, burst=2)
+        start = time.time()
+        waits = [bucket.acquire() for _ in range(4)]
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertGreater(time.time() - start, 0.015)
+
+    def test_retries_throttled(self):
+        from ratelimit import AdaptiveRateLimiter, RateLimitedGraph
+        limiter = AdaptiveRateLimiter(rate=100, burst=10, backoff=0)
+        graph = RateLimitedGraph(self.ThrottledGraph(throttles=2), limiter)
+        self.assertEqual(graph.get("1")['id'], "1")
+        self.assertEqual(limiter.throttles, 2)
+        self.assertEqual(graph.graph.calls, 3)
+        self.assertLess(limiter.rate, 100)
+
+    def test_gives_up(self):
+        from facepy.exceptions import FacebookError
+        from ratelimit import AdaptiveRateLimiter, RateLimitedGraph
+        limiter = AdaptiveRateLimiter(rate=100, retries=1, backoff=0)
+        graph = RateLimitedGraph(self.ThrottledGraph(throttles=5), limiter)
+        self.assertRaises(FacebookError, graph.get, "1")
+        self.assertRaises(FacebookError, graph.delete, "1")
+        self.assertEqual(limiter.throttles, 1)
+
+    def usage_adapter(self, usage):
+        """Transport adapter answering every request with <usage>"""
+        import json
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        class UsageAdapter(HTTPAdapter):
+            def send(self, request, **kwargs):
+                response = requests.Response()
+                response.status_code = 200
+                response.headers['Content-Type'] = 'application/json'
+                response.headers['X-App-Usage'] = json.dumps(
+                    {'call_count': adapter.usage, 'total_time': 1,
+                     'total_cputime': 1})
+                response._content = b'{"id": "1"}'
+                response.request, response.url = request, request.url
+                return response
+
+        adapter = UsageAdapter()
+        adapter.usage = usage
+        return adapter
+
+    def test_usage_headers(self):
+        import facebook
+        import clients
+        import ratelimit
+        limiter = ratelimit.AdaptiveRateLimiter(rate=10, target_usage=75)
+        ratelimit.shared_limiter, clients.shared_session = limiter, None
+        try:
+            adapter = self.usage_adapter(20)
+            clients.get_session().mount('https://', adapter)
+            graph = clients.graph_client("token", sdk=facebook)
+            self.assertEqual(graph.get_object("1")['id'], "1")
+            self.assertEqual(limiter.rate, 10.5)
+
+            adapter.usage = 90
+            graph.get_object("1")
+            self.assertAlmostEqual(limiter.rate, 10.5 * 75 / 90)
+            self.assertEqual(limiter.usage, 90)
+
+            # facepy reads usage the same way, and doesn't climb over it
+            clients.graph_client("token").get("1")
+            self.assertAlmostEqual(limiter.rate, 10.5 * (75. / 90) ** 2)
+        finally:
+            ratelimit.shared_limiter, clients.shared_session = None, None
+
+    def test_read_usage(self):
+        import json
+        from ratelimit import read_usage
+        headers = {'x-business-use-case-usage': json.dumps(
+            {'123': [{'call_count': 40, 'total_time': 96,
+                      'estimated_time_to_regain_access': 2}]})}
+        self.assertEqual(read_usage(headers), (96, 120))
+        self.assertEqual(read_usage(None), (0, 0))
+
+
+class TestGraphClients(unittest.TestCase):
+
+    def setUp(self):
+        import threading
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = b'{"id": "1"}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_shared_session(self):
+        import clients
+        clients.shared_session = None
+        url = 'http://127.0.0.1:%d' % self.server.server_port
+        graphs = [clients.graph_client("token") for _ in range(3)]
+        self.assertIs(graphs[0].graph.session, graphs[2].graph.session)
+        for graph in graphs:
+            graph.graph.url = url
+            self.assertEqual(graph.get("1")['id'], "1")
+            graph.get("2")
+
+        stats = clients.connection_stats()
+        self.assertEqual(stats['requests'], 6)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 5)
+        clients.shared_session.close()
+        clients.shared_session = None
+
+
+class TestBotState(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {'warned': {'1': 0}, 'valid': ['2']}
+        self.writes = []
+
+    def track(self, state, name):
+        def save(data):
+            self.writes.append(name)
+            self.store[name] = data
+        return state.track(name, lambda: self.store[name], save)
+
+    def test_flush_dirty(self):
+        from state import BotState
+        state = BotState()
+        warned = self.track(state, 'warned')
+        self.track(state, 'valid')
+        self.assertEqual(state.flush(), [])
+
+        # Plain objects are only dirty once they're marked
+        warned['3'] = 10
+        self.assertEqual(state.dirty(), [])
+        state.mark_dirty('warned')
+        self.assertEqual(state.dirty(), ['warned'])
+        self.assertEqual(state.flush(), ['warned'])
+        self.assertEqual(state.flush(), [])
+        self.assertIs(self.track(state, 'warned'), warned)
+
+        state.replace('valid', ['2', '4'])
+        self.assertEqual(state.flush(), ['valid'])
+        self.assertEqual(self.writes, ['warned', 'valid'])
+
+    def test_versioned(self):
+        from cache import VerdictCache
+        from flood import FloodDetector
+        from state import BotState
+        state = BotState()
+        self.store['verdicts'] = VerdictCache()
+        self.store['flood'] = FloodDetector(limit=1, window=60)
+        memo = self.track(state, 'verdicts')
+        flood = self.track(state, 'flood')
+
+        memo.put("1", "text", 0)
+        self.assertEqual(state.dirty(), ['verdicts'])
+        self.assertEqual(state.flush(), ['verdicts'])
+        memo.get("2", "text")
+        memo.discard("2")
+        self.assertEqual(state.dirty(), [])
+
+        flood.screen([{'post_id': "1", 'actor_id': "a",
+                       'created_time': 100}], now=100)
+        self.assertEqual(state.flush(), ['flood'])
+        flood.release("1")
+        self.assertEqual(state.flush(), [])
+
+    def test_checkpoint(self):
+        from state import BotState
+        state = BotState(checkpoint=60)
+        state.last_checkpoint = 0
+        self.track(state, 'warned')
+        self.assertFalse(state.checkpoint_due(now=30))
+        self.assertEqual(state.flush(now=30), [])
+        self.assertEqual(state.flush(now=61), ['warned'])
+        self.assertEqual(state.last_checkpoint, 61)
+        self.assertEqual(state.flush(force=True), ['warned'])
+
+
+class TestWebhook(unittest.TestCase):
+
+    def setUp(self):
+        from webhook import WebhookServer
+        self.server = WebhookServer(('127.0.0.1', 0), "secret", "token",
+                                    group_id="g")
+        self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_signature(self):
+        from webhook import sign, verify_signature
+        body = b'{"entry": []}'
+        self.assertTrue(verify_signature(body, sign(body, "secret"), "secret"))
+        self.assertFalse(verify_signature(body, sign(body, "other"), "secret"))
+        self.assertFalse(verify_signature(body, None, "secret"))
+        self.assertFalse(verify_signature(body, "md5=abc", "secret"))
+
+    def test_changed_post_ids(self):
+        from webhook import changed_post_ids, sample_payload
+        payload = sample_payload("g", ["g_1", "g_2", "g_1"])
+        payload['entry'][0]['changes'] += [
+            {'field': 'feed', 'value': {'item': 'comment', 'verb': 'add',
+                                        'post_id': "g_3"}},
+            {'field': 'feed', 'value': {'item': 'status', 'verb': 'remove',
+                                        'post_id': "g_4"}}]
+        payload['entry'].append(sample_payload("other", ["o_1"])['entry'][0])
+        self.assertEqual(changed_post_ids(payload, "g"), ["g_1", "g_2"])
+
+    def test_receiver(self):
+        from webhook import post_sample, sample_payload
+        url = self.server.url
+        self.assertEqual(post_sample(url, sample_payload("g", ["g_1"]),
+                                     "secret"), 200)
+        self.assertEqual(post_sample(url, sample_payload("g", ["g_2"]),
+                                     "wrong"), 403)
+        self.assertEqual(post_sample(url, sample_payload("g", ["g_1", "g_3"]),
+                                     "secret"), 200)
+        self.assertEqual(self.server.queue.wait(0), ["g_1", "g_3"])
+        self.assertEqual(self.server.queue.wait(0), [])
+
+    def test_subscribe(self):
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
+        reply = urlopen(self.server.url + "?hub.mode=subscribe" +
+                        "&hub.verify_token=token&hub.challenge=42")
+        self.assertEqual(reply.read(), b"42")
+
+    def test_subscribe_rejected(self):
+        from webhook import WebhookServer
+        try:
+            from urllib.error import HTTPError
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import HTTPError, urlopen
+
+        def status(url):
+            try:
+                return urlopen(url).getcode()
+            except HTTPError as e:
+                return e.code
+
+        query = "?hub.mode=subscribe&hub.challenge=42"
+        self.assertEqual(status(self.server.url + query +
+                                "&hub.verify_token=wrong"), 403)
+        self.assertEqual(status(self.server.url + query), 403)
+        self.assertEqual(status(self.server.url.replace("/webhook", "/other") +
+                                query + "&hub.verify_token=token"), 404)
+
+        # No token set, no token passes
+        server = WebhookServer(('127.0.0.1', 0), "secret")
+        server.start()
+        try:
+            self.assertEqual(status(server.url + query), 403)
+            self.assertEqual(status(server.url + query +
+                                    "&hub.verify_token="), 403)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def sqlite(self, legacy=None):
+        import os
+        from store import SQLiteStore
+        return SQLiteStore(os.path.join(self.dir, "test.db"), legacy)
+
+    def test_pickle_store(self):
+        import os
+        from store import PickleStore
+        store = PickleStore(self.dir)
+        self.assertIsNone(store.load("missing", {}))
+        open(os.path.join(self.dir, "empty"), "w").close()
+        self.assertIsNone(store.load("empty", {}))
+        store.save("warned", {"1": 10})
+        self.assertEqual(store.load("warned", {}), {"1": 10})
+        self.assertEqual(sorted(os.listdir(self.dir)), ["empty", "warned"])
+
+    def test_warned_rows(self):
+        store = self.sqlite()
+        self.assertIsNone(store.load("warned", {}))
+        store.save("warned", {"1": 10, "2": 20})
+        store.save("warned", {"2": 25, "3": 30})
+        self.assertEqual(store.load("warned", {}), {"2": 25, "3": 30})
+        store.save("warned", {})
+        self.assertEqual(store.load("warned", {}), {})
+        store.close()
+
+    def test_valid_rows(self):
+        import time
+        from cache import PostCache
+        store = self.sqlite()
+        cache = PostCache(max_size=10, ttl=60)
+        cache.add("old", now=time.time() - 30)
+        cache.add("new")
+        store.save("valid", cache)
+        loaded = store.load("valid", PostCache(max_size=10, ttl=60))
+        self.assertEqual(list(loaded), ["old", "new"])
+        self.assertEqual(loaded.items(), cache.items())
+
+    def test_properties_and_objects(self):
+        from feed import FeedCursor
+        store = self.sqlite()
+        store.save_properties({'group_id': "1", 'admin_ids': [1, 2]})
+        store.save_properties({'group_id': "2"})
+        self.assertEqual(store.load_properties(), {'group_id': "2"})
+        store.save("cursor", FeedCursor(50))
+        self.assertEqual(store.load("cursor", FeedCursor(0)).since, 50)
+
+    def test_rollback(self):
+        store = self.sqlite()
+        store.save("warned", {"1": 10})
+        self.assertRaises(Exception, store.save, "warned", {"2": None})
+        self.assertEqual(store.load("warned", {}), {"1": 10})
+
+    def test_migrates_legacy(self):
+        from store import PickleStore
+        legacy = PickleStore(self.dir)
+        legacy.save("warned", {"1": 10})
+        legacy.save("properties", {'group_id': "1"})
+        store = self.sqlite(legacy)
+        self.assertEqual(store.load("warned", {}), {"1": 10})
+        self.assertEqual(store.load_properties(), {'group_id': "1"})
+        store.save("warned", {})
+        self.assertEqual(store.load("warned", {}), {})
+
+
+class TestMemcachedStore(unittest.TestCase):
+
+    class FakeMemcached(object):
+        """dict-backed client that counts round trips"""
+        def __init__(self):
+            self.values = {}
+            self.trips = 0
+
+        def get(self, key):
+            self.trips += 1
+            return self.values.get(key)
+
+        def get_multi(self, keys):
+            self.trips += 1
+            return dict((k, self.values[k]) for k in keys if k in self.values)
+
+        def set(self, key, value):
+            self.trips += 1
+            self.values[key] = value
+            return True
+
+        def set_multi(self, mapping):
+            self.trips += 1
+            self.values.update(mapping)
+            return True
+
+        def delete_multi(self, keys):
+            for key in keys:
+                self.values.pop(key, None)
+
+    def test_chunks(self):
+        import os
+        import store as s
+        client = self.FakeMemcached()
+        store = s.MemcachedStore(client)
+        data = dict((str(i), os.urandom(64)) for i in range(40000))
+        store.save("valid", data)
+        manifest = client.values["valid"]
+        self.assertGreater(manifest['chunks'], 1)
+        self.assertTrue(all(len(v) <= s.chunk_size for k, v in
+                            client.values.items() if k != "valid"))
+        self.assertEqual(client.trips, 2)
+
+        client.trips = 0
+        self.assertEqual(store.load("valid", {}), data)
+        self.assertEqual(client.trips, 1)
+
+        fresh = s.MemcachedStore(client)
+        self.assertEqual(fresh.load("valid", {}), data)
+        self.assertEqual(client.trips, 3)
+
+        store.save("valid", {"1": 1})
+        self.assertEqual(list(client.values), ["valid"])
+        self.assertEqual(fresh.load("valid", {}), {"1": 1})
+
+    def test_missing_and_legacy(self):
+        import os
+        import store as s
+        client = self.FakeMemcached()
+        store = s.MemcachedStore(client)
+        self.assertIsNone(store.load("warned", {}))
+        client.values["warned"] = {"1": 10}
+        self.assertEqual(store.load("warned", {}), {"1": 10})
+
+        store.save("big", os.urandom(3 * s.chunk_size))
+        del client.values[[k for k in client.values if k.startswith("big:")][0]]
+        self.assertIsNone(s.MemcachedStore(client).load("big"))
+
+
+class TestModerationJournal(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        import util
+        from store import PickleStore
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "journal")
+        self.old_store, util.store = util.store, PickleStore(self.dir)
+
+    def tearDown(self):
+        import shutil
+        import util
+        util.store = self.old_store
+        shutil.rmtree(self.dir)
+
+    def journal(self, **kwargs):
+        from journal import ModerationJournal
+        return ModerationJournal(self.path, "snapshot", **kwargs).load()
+
+    def test_replay(self):
+        journal = self.journal()
+        journal.warned["1"] = 10
+        journal.warned["2"] = 20
+        journal.valid.add("3", 30)
+        del journal.warned["1"]
+        journal.deleted("2")
+        journal.warned["4"] = 40
+        journal.close()
+
+        with open(self.path) as f:
+            events = [line.split('"event": "')[1].split('"')[0] for line in f]
+        self.assertEqual(events, ["warned", "warned", "validated",
+                                  "unwarned", "deleted", "warned"])
+
+        with open(self.path, "a") as f:
+            f.write('{"seq": 7, "event": "war')     # torn write
+        restored = self.journal()
+        self.assertEqual(dict(restored.warned), {"4": 40})
+        self.assertEqual(restored.valid.items(), [("3", 30)])
+        self.assertEqual(restored.seq, 6)
+
+    def test_compact(self):
+        import os
+        journal = self.journal(compact_every=3)
+        journal.warned["1"] = 10
+        journal.valid.add("2", 20)
+        self.assertFalse(journal.should_compact())
+        journal.warned["3"] = 30
+        self.assertTrue(journal.should_compact())
+        journal.compact()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        journal.warned["4"] = 40
+        journal.close()
+
+        restored = self.journal()
+        self.assertEqual(dict(restored.warned), {"1": 10, "3": 30, "4": 40})
+        self.assertEqual(restored.pending, 1)
+
+    def test_compact_to_rows(self):
+        import os
+        import time
+        import util
+        from store import SQLiteStore
+        util.store = SQLiteStore(os.path.join(self.dir, "rascal.db"))
+        now = int(time.time())
+        journal = self.journal()
+        journal.warned["1"] = now
+        journal.valid.add("2", now)
+        journal.compact()
+        journal.close()
+
+        conn = util.store.conn
+        self.assertEqual(conn.execute(
+            'SELECT post_id, warned_at FROM warned_posts').fetchall(),
+            [("1", now)])
+        self.assertEqual(conn.execute(
+            'SELECT post_id, seen_at FROM valid_posts').fetchall(),
+            [("2", now)])
+        restored = self.journal()
+        self.assertEqual(dict(restored.warned), {"1": now})
+        self.assertIn("2", restored.valid)
+        restored.close()
+        util.store.close()
+
+    def test_snapshot_without_truncate(self):
+        import shutil
+        journal = self.journal()
+        journal.warned["1"] = 10
+        journal.close()
+        shutil.copy(self.path, self.path + ".bak")
+        journal = self.journal()
+        journal.compact()
+        journal.close()
+        shutil.copy(self.path + ".bak", self.path)  # crash before truncating
+
+        restored = self.journal()
+        del restored.warned["1"]
+        self.assertEqual(restored.seq, 2)
+        restored.close()
+        self.assertEqual(dict(self.journal().warned), {})
+
+    def test_legacy(self):
+        from cache import PostCache
+        from journal import ModerationJournal
+        journal = ModerationJournal(self.path, "snapshot").load(
+            lambda: ({"1": 10}, PostCache.from_list(["2"])))
+        self.assertEqual(dict(journal.warned), {"1": 10})
+        self.assertIn("2", journal.valid)
+        self.assertEqual(journal.seq, 0)
+
+
+class TestDeadlineQueue(unittest.TestCase):
+
+    def test_due(self):
+        from deadline import DeadlineQueue
+        queue = DeadlineQueue.from_warned(
+            dict((str(i), i * 10) for i in range(100)), grace=100)
+        self.assertEqual(queue.due(now=99), [])
+        self.assertEqual(queue.due(now=130), ["0", "1", "2", "3"])
+        self.assertEqual(queue.due(now=130), ["0", "1", "2", "3"])
+        queue.discard("1")
+        queue.push("2", 500)
+        self.assertEqual(queue.due(now=130), ["0", "3"])
+        self.assertEqual(queue.deadline("2"), 600)
+        self.assertEqual(queue.next_deadline(), 100)
+        for i in range(100):
+            queue.discard(str(i))
+        self.assertEqual(len(queue), 0)
+        self.assertIsNone(queue.next_deadline())
+
+    def test_follows_journal(self):
+        import os
+        import shutil
+        import tempfile
+        import util
+        from journal import ModerationJournal
+        from store import PickleStore
+        tmp = tempfile.mkdtemp()
+        old_store, util.store = util.store, PickleStore(tmp)
+        try:
+            journal = ModerationJournal(os.path.join(tmp, "j"), "snap",
+                                        grace=50).load()
+            journal.warned["1"] = 0
+            journal.warned["2"] = 100
+            journal.warned["3"] = 10
+            del journal.warned["3"]
+            self.assertEqual(journal.deadlines.due(now=60), ["1"])
+            journal.deleted("1")
+            self.assertEqual(journal.deadlines.due(now=200), ["2"])
+            journal.close()
+
+            restored = ModerationJournal(os.path.join(tmp, "j"), "snap",
+                                         grace=50).load()
+            self.assertEqual(restored.deadlines.due(now=200), ["2"])
+        finally:
+            util.store = old_store
+            shutil.rmtree(tmp)
+
+
+class TestVerdictCache(unittest.TestCase):
+
+    def test_unchanged_post_reuses_verdict(self):
+        from cache import VerdictCache
+        from rules import PostRuleSet
+        rule_set = PostRuleSet(["found"])
+        memo = VerdictCache()
+        posts = [{'post_id': "1", 'message': "no tag"},
+                 {'post_id': "2", 'message': "[found] $20 " + "x" * 200}]
+        first = rule_set.validate_batch(posts, memo=memo)
+        rule_set.verdict = None     # any revalidation would fail
+        self.assertEqual(rule_set.validate_batch(posts, memo=memo), first)
+        self.assertEqual((memo.hits, memo.misses), (2, 2))
+
+        # Any iterable of posts will do
+        rule_set = PostRuleSet(["found"])
+        self.assertEqual(rule_set.validate_batch(iter(posts),
+                                                 memo=VerdictCache()), first)
+        self.assertEqual(rule_set.validate_batch(post for post in posts),
+                         first)
+
+    def test_edited_post_is_revalidated(self):
+        from cache import VerdictCache
+        from rules import PostRuleSet, VALID
+        rule_set = PostRuleSet(["found"])
+        memo = VerdictCache()
+        post = {'post_id': "1", 'message': "no tag"}
+        self.assertNotEqual(rule_set.validate_batch([post], memo=memo)[0],
+                            VALID)
+        post['message'] = "[found] $20 " + "x" * 200
+        self.assertEqual(rule_set.validate_batch([post], memo=memo)[0], VALID)
+        self.assertEqual(memo.misses, 2)
+
+    def test_rule_change_clears(self):
+        from cache import VerdictCache
+        from rules import PostRuleSet, VALID
+        memo = VerdictCache()
+        post = {'post_id': "1", 'message': "[found] $20 " + "x" * 200}
+        PostRuleSet(["made"]).validate_batch([post], memo=memo)
+        verdicts = PostRuleSet(["found"]).validate_batch([post], memo=memo)
+        self.assertEqual(verdicts[0], VALID)
+
+    def test_pickle_and_ttl(self):
+        import pickle
+        import time
+        from cache import VerdictCache
+        memo = VerdictCache(ttl=60)
+        memo.put("old", "a", 1, now=time.time() - 120)
+        memo.put("new", "b", 2)
+        restored = pickle.loads(pickle.dumps(memo))
+        self.assertIsNone(restored.get("old", "a"))
+        self.assertEqual(restored.get("new", "b"), 2)
+        self.assertIsNone(restored.get("new", "b edited"))
+
+    def test_warned_post_edited_valid_is_unwarned(self):
+        import asyncio
+        from cache import PostCache, VerdictCache
+        from feed import FeedCursor
+        from graph import DeleteExecutor
+        from moderator import AsyncModerator
+        from roster import AdminRoster
+        from rules import PostRuleSet
+        post = TestAsyncModerator.post(None, "waiting", "no tags")
+        graph = TestAsyncModerator.FeedGraph([post], [])
+        rule_set = PostRuleSet(["found"])
+        memo = VerdictCache()
+        already_warned = {"waiting": 99000}
+
+        def run():
+            moderator = AsyncModerator(graph, rule_set, AdminRoster(), 99,
+                                       already_warned, PostCache(),
+                                       DeleteExecutor(graph), now=100000,
+                                       memo=memo)
+            asyncio.run(moderator.run("g", FeedCursor(0), due_ids=[]))
+
+        run()
+        run()
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+        self.assertIn("waiting", already_warned)
+
+        post['message'] = "[found] $20 " + "x" * 200
+        run()
+        self.assertEqual(memo.misses, 2)
+        self.assertNotIn("waiting", already_warned)
+
+
+class TestNearDuplicateIndex(unittest.TestCase):
+
+    text = ("[offering] Sunny room in a 3 bed apartment near campus, "
+            "$650 per month with utilities included, available June 1st. "
+            "Message me for pictures and a tour!")
+
+    def post(self, post_id, actor_id, message):
+        return {'post_id': post_id, 'actor_id': actor_id, 'message': message}
+
+    def test_flags_repost_and_blast(self):
+        from spam import NearDuplicateIndex
+        index = NearDuplicateIndex(threshold=0.7)
+        edited = self.text.replace("June 1st", "June 2nd") + \
+            " http://spam.example/x"
+        found = index.check([self.post("1", "a", self.text),
+                             self.post("2", "a", self.text.upper()),
+                             self.post("3", "b", edited),
+                             self.post("4", "c", "[found] Looking for a "
+                                       "quiet roommate who likes cats, "
+                                       "budget is $500 a month")])
+        self.assertEqual([(d.post_id, d.actor_id, d.match_actor_id)
+                          for d in found],
+                         [("2", "a", "a"), ("3", "b", "a")])
+        self.assertEqual(index.drain(), found)
+        self.assertEqual(index.flagged, [])
+
+    def test_unchanged_post_not_reflagged(self):
+        from spam import NearDuplicateIndex
+        index = NearDuplicateIndex()
+        index.check([self.post("1", "a", self.text)])
+        self.assertEqual(len(index.check([self.post("2", "b", self.text)])),
+                         1)
+        self.assertEqual(index.check([self.post("2", "b", self.text)]), [])
+        self.assertEqual(len(index), 2)
+
+    def test_short_and_expired(self):
+        import time
+        from spam import NearDuplicateIndex
+        index = NearDuplicateIndex(window=60)
+        index.add("old", "a", self.text, now=time.time() - 120)
+        self.assertEqual(index.query(self.text), [])
+        self.assertEqual(index.check([self.post("1", "a", "$5 bike"),
+                                      self.post("2", "b", "$5 bike")]), [])
+        self.assertEqual(index.prune(), 1)
+
+    def test_pickle_rebuilds_buckets(self):
+        import pickle
+        from spam import NearDuplicateIndex
+        index = NearDuplicateIndex()
+        index.add("1", "a", self.text)
+        restored = pickle.loads(pickle.dumps(index))
+        matches = restored.query(self.text + " Thanks")
+        self.assertEqual([m[0] for m in matches], ["1"])
+        restored.discard("1")
+        self.assertEqual(restored._buckets, {})
+
+
+class TestActorStats(unittest.TestCase):
+
+    def post(self, actor_id, created_time):
+        return {'actor_id': actor_id, 'created_time': created_time}
+
+    def test_counts_each_post_once(self):
+        from actors import ActorStats
+        from rules import PRICE, TAG, VALID
+        stats = ActorStats()
+        stats.observe([self.post("a", 20), self.post("a", 10),
+                       self.post("b", 5)],
+                      [VALID, PRICE.flag | TAG.flag, TAG.flag])
+        stats.observe([self.post("a", 10)], [TAG.flag])    # edit, re-read
+        a = stats.get("a")
+        self.assertEqual((a['posts'], a['price'], a['tag'], a['length']),
+                         (2, 1, 1, 0))
+        self.assertEqual((a['first_seen'], a['last_seen']), (10, 20))
+        self.assertEqual(stats.get("b")['tag'], 1)
+        self.assertIsNone(stats.get("c"))
+
+    def test_high_risk_flagged_once(self):
+        from actors import ActorStats, DELETIONS, WARNINGS
+        from rules import TAG
+        stats = ActorStats(threshold=0.5, min_events=3)
+        stats.observe([self.post("a", 1), self.post("a", 2)],
+                      [TAG.flag, TAG.flag])
+        stats.record("a", WARNINGS)
+        stats.record("a", WARNINGS)
+        self.assertFalse(stats.is_high_risk("a"))
+        stats.record("a", DELETIONS)
+        stats.record("a", DELETIONS)
+        self.assertTrue(stats.is_high_risk("a"))
+        self.assertEqual(stats.drain(), ["a"])
+        self.assertEqual(stats.drain(), [])
+
+    def test_pickle(self):
+        import pickle
+        from actors import ActorStats, DUPLICATES
+        from rules import VALID
+        stats = ActorStats()
+        stats.observe([self.post("a", 1), self.post("b", 2)], [VALID, VALID])
+        stats.record("b", DUPLICATES)
+        restored = pickle.loads(pickle.dumps(stats))
+        self.assertEqual(restored.get("b"), stats.get("b"))
+        self.assertEqual(restored.get("a"), stats.get("a"))
+        restored.record("c", DUPLICATES)
+        self.assertEqual(restored.get("c")['duplicates'], 1)
+
+
+class TestFloodDetector(unittest.TestCase):
+
+    def post(self, post_id, actor_id, created_time):
+        return {'post_id': post_id, 'actor_id': actor_id,
+                'created_time': created_time}
+
+    def test_limit_per_window(self):
+        from flood import FloodDetector
+        flood = FloodDetector(limit=3, window=60)
+        posts = [self.post(str(i), "a", 1000 + i) for i in range(5)]
+        posts.append(self.post("b", "b", 1000))
+        kept, flooded = flood.screen(posts, now=1010)
+        self.assertEqual([p['post_id'] for p in kept], ["0", "1", "2", "b"])
+        self.assertEqual([p['post_id'] for p in flooded], ["3", "4"])
+        self.assertEqual(flood.drain(), ["a"])
+
+        # Re-reads are let through, the window slides past flooded posts too
+        kept, flooded = flood.screen(posts[:2] + [self.post("5", "a", 1063)],
+                                     now=1070)
+        self.assertEqual(flooded, [])
+
+    def test_old_posts_and_pickle(self):
+        import pickle
+        import time
+        from flood import FloodDetector
+        flood = FloodDetector(limit=1, window=60)
+        posts = [self.post("1", "a", 0), self.post("2", "a", 1)]
+        self.assertEqual(flood.screen(posts, now=1000)[1], [])
+        self.assertEqual(len(flood), 0)
+
+        now = time.time()
+        flood.screen([self.post("3", "a", now - 10)], now=now)
+        flood.screen([self.post("4", "b", now - 100)], now=now)
+        restored = pickle.loads(pickle.dumps(flood))
+        self.assertEqual(len(restored), 1)
+        self.assertTrue(restored.hit("a", now))
+
+    def test_moderator_skips_flood(self):
+        import asyncio
+        from cache import PostCache
+        from feed import FeedCursor
+        from flood import FloodDetector
+        from graph import DeleteExecutor
+        from moderator import AsyncModerator
+        from roster import AdminRoster
+        from rules import PostRuleSet
+        posts = [TestAsyncModerator.post(None, "p%d" % i, "no tags")
+                 for i in range(4)]
+        for i, post in enumerate(posts):
+            post['created_time'] = 99990 + i
+        graph = TestAsyncModerator.FeedGraph(posts, [])
+        flood = FloodDetector(limit=2, window=60)
+        cursor = FeedCursor(0)
+        warned = {}
+        for now in (100000, 100030, 100060):
+            moderator = AsyncModerator(graph, PostRuleSet(["found"]),
+                                       AdminRoster(), 99, warned, PostCache(),
+                                       DeleteExecutor(graph), now=now,
+                                       flood=flood)
+            processed, _ = asyncio.run(moderator.run("g", cursor))
+            if now == 100000:
+                self.assertEqual(len(processed), 4)
+            if now < 100060:
+                self.assertEqual(sorted(graph.posted), ["p0", "p1"])
+
+        # Held posts are read back in and warned once the window is up
+        self.assertEqual(sorted(graph.posted), ["p0", "p1", "p2", "p3"])
+        self.assertEqual(flood.held, {})
+
+    def test_sync_holds_flood(self):
+        import contextlib
+        import io
+        import rascal
+        from cache import PostCache
+        from fakegraph import FakeGraph
+        from feed import FeedCursor
+        from flood import FloodDetector
+        from graph import DeleteExecutor
+        from roster import AdminRoster
+        posts = [{'post_id': "g_%d" % i, 'message': "no tags",
+                  'actor_id': "5", 'created_time': 99990 + i,
+                  'updated_time': 99990 + i} for i in range(4)]
+        graph = FakeGraph(posts, bot_id=99)
+        flood = FloodDetector(limit=2, window=60)
+        cursor = FeedCursor(0)
+        warned = {}
+        for now in (100000, 100060):
+            with contextlib.redirect_stdout(io.StringIO()):
+                rascal.moderate_posts(
+                    graph, "g", cursor, AdminRoster(), 99, warned,
+                    PostCache(), DeleteExecutor(graph), now, [], [],
+                    flood=flood)
+            if now == 100000:
+                self.assertEqual(sorted(warned), ["g_0", "g_1"])
+                self.assertEqual(sorted(flood.held), ["g_2", "g_3"])
+        self.assertEqual(sorted(warned), ["g_0", "g_1", "g_2", "g_3"])
+
+        # A held post deleted in the meantime is let go
+        flood.held["gone"] = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            rascal.moderate_posts(graph, "g", cursor, AdminRoster(), 99,
+                                  warned, PostCache(), DeleteExecutor(graph),
+                                  100100, [], [], flood=flood)
+        self.assertEqual(flood.held, {})
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run_and_compare(self):
+        import contextlib
+        import io
+        import json
+        import bench
+        sizes = {'posts': 20, 'cache': (50,)}
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = bench.run(['validators', 'moderation', 'cache',
+                                'memory'], sizes=sizes)
+        report = json.loads(json.dumps(report))
+        names = set(entry['name'] for entry in report['results'])
+        self.assertIn('validators.violations', names)
+        self.assertIn('moderation.async_run', names)
+        self.assertIn('cache.load.sqlite', names)
+        self.assertIn('memory.valid', names)
+        self.assertTrue(all(entry['value'] > 0
+                            for entry in report['results']))
+
+        rows = bench.compare(report, report)
+        self.assertEqual(len(rows), len(report['results']))
+        self.assertTrue(all(row[4] == 0 for row in rows))
+
+    def test_fake_graph(self):
+        from fakegraph import FakeGraph, FakeGraphError
+        from feed import FeedCursor, fetch_posts, iter_group_posts
+        from graph import post_comment
+        posts = [{'post_id': "g_%d" % i, 'message': "m", 'actor_id': "5",
+                  'created_time': i, 'updated_time': i} for i in range(3)]
+        graph = FakeGraph(posts, admin_ids=[1, 99], bot_id=99)
+        self.assertEqual(len(list(iter_group_posts(graph, "g",
+                                                   FeedCursor(1)))), 2)
+        self.assertEqual(len(fetch_posts(graph, ["g_0", "gone"])), 1)
+        self.assertEqual(graph.fql(
+            "SELECT uid FROM group_member WHERE gid=g AND administrator"),
+            [{'uid': 1}])
+        post_comment(graph, "g_0", "hi")
+        self.assertEqual(graph.calls['put_object'], 1)
+        graph.delete_object(id="g_0")
+        self.assertRaises(FakeGraphError, graph.get_object, "g_0")
+        self.assertEqual(graph.comments, {})
+
+    def test_fake_graph_server(self):
+        import contextlib
+        import io
+        import bench
+        from fakegraph import (FakeGraph, FakeGraphClient, FakeGraphError,
+                               FakeGraphServer)
+        from feed import FeedCursor, iter_group_posts
+        from graph import CommentBatch, DeleteExecutor
+        posts = [{'post_id': "g_%d" % i, 'message': "m", 'actor_id': "5",
+                  'created_time': i, 'updated_time': i} for i in range(120)]
+        graph = FakeGraph(posts, admin_ids=[1], bot_id=99)
+        server = FakeGraphServer(graph).start()
+        try:
+            client = FakeGraphClient(server.url)
+            self.assertEqual(len(list(iter_group_posts(client, "g",
+                                                       FeedCursor(0)))), 120)
+            client.put_object("g_0", "comments", message="hi")
+            comments = CommentBatch(client)
+            for i in range(60):
+                comments.add("g_%d" % i)
+            self.assertEqual(len(comments.fetch()["g_0"]), 1)
+
+            deletes = DeleteExecutor(client)
+            deletes.submit("g_0")
+            deletes.submit("gone")
+            report = deletes.run()
+            self.assertEqual(report.deleted, ["g_0"])
+            self.assertEqual(list(report.failed), ["gone"])
+            self.assertRaises(FakeGraphError, client.get_object, "g_0")
+
+            # An empty bucket answers with Graph's throttling error
+            server.rate, server.burst, server._tokens = 0.001, 1, 1
+            client.get_object("g_1")
+            with self.assertRaises(FakeGraphError) as caught:
+                client.get_object("g_1")
+            self.assertEqual(caught.exception.code, 4)
+            self.assertEqual(server.throttled, 1)
+        finally:
+            server.stop()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = bench.run(['load'], sizes={'load': (60,)})
+        names = [entry['name'] for entry in report['results']]
+        self.assertIn('load.first_pass', names)
+        self.assertTrue(report['results'][0]['value'] > 0)
+
+
+class TestCorpus(unittest.TestCase):
+
+    def test_rates(self):
+        from corpus import CorpusGenerator
+        from rules import PostRuleSet
+        rules = PostRuleSet()
+        generator = CorpusGenerator(seed=3, violation_rate=0.4,
+                                    rule_mix={'price': 1, 'length': 1})
+        posts = list(generator.posts(500))
+        broken = [rules.violations(post['message']) for post in posts]
+        self.assertTrue(0.3 < sum(1 for b in broken if b) / 500.0 < 0.5)
+        self.assertTrue(all(len(b) <= 1 for b in broken))
+        self.assertFalse(any(rule.name == 'tag' for b in broken
+                             for rule in b))
+        self.assertEqual(len(set(post['post_id'] for post in posts)), 500)
+
+        again = list(CorpusGenerator(seed=3, violation_rate=0.4,
+                                     rule_mix={'price': 1, 'length': 1},
+                                     start=posts[0]['created_time'])
+                     .posts(500))
+        self.assertEqual(again, posts)
+
+        tagged = CorpusGenerator(seed=1, tag_mix={'found': 1},
+                                 violation_rate=0)
+        self.assertTrue(all(post['message'].startswith('[found]')
+                            for post in tagged.posts(50)))
+
+    def test_churn(self):
+        from corpus import CorpusGenerator
+        from fakegraph import FakeGraph
+        generator = CorpusGenerator(seed=1, start=0)
+        graph = FakeGraph(generator.posts(200))
+        edited, deleted = generator.churn(graph, 0.1, 0.05, now=10 ** 6)
+        self.assertEqual((len(edited), len(deleted)), (20, 10))
+        self.assertEqual(len(graph.posts), 190)
+        self.assertTrue(all(graph.posts[post_id]['updated_time'] == 10 ** 6
+                            for post_id in edited))
+        rows = graph.fql("SELECT post_id FROM stream WHERE source_id=1000"
+                         " AND updated_time>=1000000")
+        self.assertEqual(sorted(row['post_id'] for row in rows),
+                         sorted(edited))
+
+
+class TestSubGroup(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        import time
+        import rascal
+        import util
+        from fakegraph import FakeGraph, FakeGraphServer
+        from store import PickleStore
+        from TestPosts import bad_posts, good_posts
+        self.dir = tempfile.mkdtemp()
+        self.saved = (util.store, util.journal_path, util.journal_durable,
+                      util.graph_url, rascal.message_admins,
+                      rascal.admin_roster)
+        self.now = time.time()
+        self.posts = [{'post_id': "1000_%d" % i, 'message': message,
+                       'actor_id': str(200 + i),
+                       'created_time': int(self.now - 3600 + i),
+                       'updated_time': int(self.now - 3600 + i)}
+                      for i, message in enumerate(good_posts + bad_posts)]
+        self.bad_ids = [post['post_id']
+                        for post in self.posts[len(good_posts):]]
+        self.graph = FakeGraph(self.posts, admin_ids=[1], bot_id=99)
+        self.server = FakeGraphServer(self.graph).start()
+        self.messages = []
+
+        util.store = PickleStore(self.dir)
+        util.journal_path = os.path.join(self.dir, "journal")
+        util.journal_durable = False
+        util.graph_url = self.server.url
+        rascal.message_admins = lambda message, *args: \
+            self.messages.append(message)
+        rascal.admin_roster = None
+        util.save_properties({
+            'sublets_oauth_access_token': "token",
+            'access_token_expiration': self.now + 30 * 86400,
+            'sublets_api_id': "app", 'sublets_secret_key': "secret",
+            'ignored_post_ids': [], 'ignore_source_ids': [],
+            'group_id': "1000", 'bot_id': 99, 'admin_ids': []})
+
+    def tearDown(self):
+        import shutil
+        import rascal
+        import util
+        self.server.stop()
+        util.store, util.journal_path, util.journal_durable, \
+            util.graph_url, rascal.message_admins, \
+            rascal.admin_roster = self.saved
+        shutil.rmtree(self.dir)
+
+    def run_once(self, run_async=False):
+        import contextlib
+        import io
+        import rascal
+        with contextlib.redirect_stdout(io.StringIO()):
+            rascal.sub_group(run_async)
+
+    def warnings(self):
+        from collections import Counter
+        return Counter(comment['post_id']
+                       for comment in self.graph.comments.values())
+
+    def test_one_shot(self):
+        import util
+        from feed import FeedCursor
+        from journal import load_snapshot
+        self.run_once()
+        warnings = self.warnings()
+        self.assertEqual(sorted(warnings), sorted(self.bad_ids))
+        for post_id in self.bad_ids:
+            self.assertEqual(warnings[post_id], 1)
+        self.assertTrue(self.messages)
+
+        # The journal is in the store, not just the local file
+        os.remove(util.journal_path)
+        snapshot = load_snapshot(util.journal_db)
+        self.assertEqual(set(snapshot.warned), set(warnings))
+
+        # Later runs, either runner, don't warn anyone twice
+        self.run_once()
+        self.run_once(run_async=True)
+        self.assertEqual(self.warnings(), warnings)
+        cursor = util.load_cache(util.cursor_db, FeedCursor(0))
+        self.assertEqual(cursor.since, self.posts[-1]['updated_time'])
+
+    def test_one_shot_confirms_deletes(self):
+        import util
+        from graph import VerificationQueue
+        from journal import load_snapshot
+        self.run_once()
+        time_limit = util.time_limit
+        util.time_limit = 0
+        try:
+            self.run_once()
+        finally:
+            util.time_limit = time_limit
+        for post_id in self.bad_ids:
+            self.assertNotIn(post_id, self.graph.posts)
+
+        # Confirmed in the same run, so they're off the warned list
+        snapshot = load_snapshot(util.journal_db)
+        self.assertEqual(snapshot.warned, {})
+        self.assertEqual(len(util.load_cache(util.verify_db,
+                                             VerificationQueue())), 0)
+
+    def test_counts_removals_that_went_through(self):
+        import util
+        from actors import DELETIONS
+        from fakegraph import FakeGraphError
+        self.run_once()
+        delete_object = self.graph.delete_object
+        failing = self.bad_ids[0]
+
+        def failing_delete(id):
+            if id == failing:
+                raise FakeGraphError("Permissions error", 200)
+            return delete_object(id)
+        self.graph.delete_object = failing_delete
+        time_limit = util.time_limit
+        util.time_limit = 0
+        try:
+            self.run_once()
+        finally:
+            util.time_limit = time_limit
+
+        actors = util.load_cache(util.actors_db, None)
+        actor_ids = dict((post['post_id'], post['actor_id'])
+                         for post in self.posts)
+        self.assertEqual(actors.get(actor_ids[failing])[DELETIONS], 0)
+        for post_id in self.bad_ids[1:]:
+            self.assertEqual(actors.get(actor_ids[post_id])[DELETIONS], 1)
+
+    def test_durable_journal(self):
+        import util
+        from journal import ModerationJournal
+        util.journal_durable = True
+        self.run_once()
+
+        # A short journal that outlives the run isn't compacted
+        self.assertIsNone(util.load_cache(util.journal_db, None))
+        journal = ModerationJournal(util.journal_path, util.journal_db).load()
+        self.assertEqual(set(journal.warned), set(self.bad_ids))
+        journal.close()
+
+    def test_failed_run_keeps_cursor(self):
+        import contextlib
+        import io
+        import rascal
+        import util
+        from feed import FeedCursor
+        from state import BotState
+        state = BotState()
+        delete_old_posts = rascal.delete_old_posts
+
+        def fail(*args):
+            raise RuntimeError("Graph went away")
+        rascal.delete_old_posts = fail
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertRaises(RuntimeError, rascal.sub_group, False,
+                                  state)
+        finally:
+            rascal.delete_old_posts = delete_old_posts
+        state.flush()
+        self.assertIsNone(util.load_cache(util.cursor_db, None))
+
+        # The next run reads the same posts again, without warning twice
+        warnings = self.warnings()
+        with contextlib.redirect_stdout(io.StringIO()):
+            rascal.sub_group(False, state)
+        state.flush()
+        self.assertEqual(self.warnings(), warnings)
+        cursor = util.load_cache(util.cursor_db, FeedCursor(0))
+        self.assertEqual(cursor.since, self.posts[-1]['updated_time'])
+
+    def test_cleanup_retries_failed_deletes(self):
+        import contextlib
+        import io
+        import post_cleanup
+        import util
+        from fakegraph import FakeGraphError
+        delete_object = self.graph.delete_object
+        failing, refused = self.bad_ids[:2]
+
+        def failing_delete(id):
+            if id == failing:
+                raise FakeGraphError("Service unavailable", 2)
+            if id == refused:
+                raise FakeGraphError("Permissions error", 200)
+            return delete_object(id)
+        self.graph.delete_object = failing_delete
+        post_cleanup.admin_roster = None
+        retries, util.delete_retries = util.delete_retries, 0
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                post_cleanup.sub_group()
+            self.assertIn(failing, self.graph.posts)
+            self.assertIsNotNone(util.load_cache(post_cleanup.cursor_db, None))
+            self.assertEqual(util.load_cache(post_cleanup.retry_db, None),
+                             [failing])
+
+            # The next run reads the transient failure back in by ID
+            self.graph.delete_object = delete_object
+            with contextlib.redirect_stdout(io.StringIO()):
+                post_cleanup.sub_group()
+        finally:
+            post_cleanup.admin_roster = None
+            util.delete_retries = retries
+        self.assertNotIn(failing, self.graph.posts)
+        self.assertIn(refused, self.graph.posts)
+        self.assertEqual(util.load_cache(post_cleanup.retry_db, None), [])
+
+
 class TestDeletion(unittest.TestCase):
 
     def test_regular(self):
@@ -229,11 +1980,11 @@ class TestDeletion(unittest.TestCase):
 
 
 def main():
-    print "-----------------"
-    print "| Running tests |"
-    print "-----------------"
+    print("-----------------")
+    print("| Running tests |")
+    print("-----------------")
     unittest.main()
-    notify_mac()
+    notify()
 
 
 if __name__ == '__main__':
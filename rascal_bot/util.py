@@ -1,8 +1,11 @@
+import os
 import sys
 import csv
-import cPickle as pickle
 import subprocess
 
+from cache import PostCache
+from store import MemcachedStore, PickleStore, SQLiteStore
+
 '''----------------------------------------------------------------------------
 Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
 File:       util.py
@@ -23,12 +26,65 @@ time_limit = 86400                  # 60 * 60 * 24 (s --> h)
 prop_file = 'properties'            # properties pickle name
 warned_db = 'fb_subs_cache'         # warned posts cache
 valid_db = 'fb_subs_valid_cache'    # valid posts cache
+cursor_db = 'fb_subs_cursor'        # feed high-water mark
+verify_db = 'fb_subs_verify'        # deletes waiting on confirmation
+verdict_db = 'fb_subs_verdicts'     # last verdict per post and text digest
+spam_db = 'fb_subs_spam_index'      # near-duplicate index of recent posts
+actors_db = 'fb_subs_actors'        # per-actor post and violation history
+flood_db = 'fb_subs_flood'          # recent post times per actor
+journal_db = 'fb_subs_snapshot'     # compacted moderation journal
+journal_path = 'fb_subs_journal'    # append-only moderation journal
+journal_compact_every = 1000        # journal events between snapshots
+journal_durable = 'DYNO' not in os.environ  # journal file outlives the run,
+                                            # not on a Heroku dyno
+roster_db = 'fb_subs_roster'        # admin / member roster
+roster_ttl = 86400                  # 60 * 60 * 24 (s --> admins re-read daily)
+member_ttl = None                   # seconds members stay fresh, None = off
+digest_interval = None              # seconds between admin digests mid-run
+feed_lookback = 604800              # 60 * 60 * 24 * 7 (first run reads 7 days)
+validate_workers = 1                # processes for batch validation
+delete_workers = 4                  # delete batches sent in parallel
+delete_retries = 2                  # retries for transient delete errors
+max_in_flight = 8                   # Graph calls in flight for async runs
+graph_rate = 5                      # starting Graph calls per second
+graph_burst = 10                    # Graph calls allowed back to back
+graph_min_rate = 0.2                # slowest the limiter backs off to
+graph_max_rate = 50                 # fastest the limiter climbs to
+graph_target_usage = 75             # usage % from Graph headers to stay under
+graph_retries = 4                   # retries for throttled Graph calls
+graph_url = os.environ.get('RASCAL_GRAPH_URL')  # fake Graph, eg. load tests
+http_pool_hosts = 4                 # hosts the shared HTTP session pools for
+http_pool_size = 10                 # keep-alive connections per host
+http_connect_timeout = 5            # seconds to open a connection
+http_read_timeout = 60              # seconds to wait on a response
+http_retries = 0                    # connection-level retries
+poll_interval = 300                 # seconds between daemon polls
+checkpoint_interval = 3600          # seconds between full daemon writes
+webhook_host = '0.0.0.0'            # interface the webhook receiver binds
+webhook_port = int(os.environ.get('PORT', 8080))    # webhook receiver port
+webhook_path = '/webhook'           # path notifications are POSTed to
+valid_cache_size = 20000            # most post IDs kept in valid cache
+valid_cache_ttl = 2592000           # 60 * 60 * 24 * 30 (s --> 30 days)
+verdict_cache_size = 20000          # most posts kept in verdict cache
+spam_threshold = 0.8                # text similarity flagged as a duplicate
+spam_window = 604800                # 60 * 60 * 24 * 7 (s --> reposts in 7 days)
+actor_risk_threshold = 0.5          # bad events per post marking high risk
+actor_min_events = 3                # bad events before an actor is high risk
+flood_limit = 5                     # posts an actor can make per flood window
+flood_window = 600                  # 60 * 10 (s --> keep above poll_interval)
+flood_delete = False                # delete flood posts, or just hold them
+verify_wait = 10                    # seconds a one-shot run waits to confirm
+                                    # its own deletes
+
+files_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'files')   # bundled list / settings files
 
 tag_delimiters = ('*', '-')         # leading symbols for post tags
-post_tags = load_list('post_tags.txt')
-
 bot_delimiters = ('!', '#')         # leading symbols for bot tags
-bot_tags = load_list('bot_tags.txt')
+
+store_backend = 'sqlite'            # 'sqlite' or 'pickle', memcached on heroku
+store_path = 'rascal.db'            # SQLite database file
+store = None                        # backend, opened on first use
 
 # Booleans
 is_heroku = False                    # is bot running on heroku?
@@ -96,14 +152,19 @@ Return:
 '''
 def load_list(lfile):
     vals = []
-    with open('./files/{}'.format(lfile), 'r') as f:
+    with open(os.path.join(files_dir, lfile), 'r') as f:
         lst = csv.reader(f)     # get text from file
-        for val in lst:         # read each value
-            vals.append(val)    # add value to list
+        for val in lst:         # read each row
+            vals.extend(v.strip() for v in val if v.strip())
     f.close()                   # close file when done
     return vals
 
 
+# Tag vocabularies, loaded once load_list exists
+post_tags = load_list('post_tags.txt')
+bot_tags = load_list('bot_tags.txt')
+
+
 '''-------------------------------------
 Method: get_settings
 
@@ -120,7 +181,7 @@ Return:
 '''
 def get_settings(pfile):
     prop = {}
-    with open('./files/{}'.format(pfile), 'r') as keys:
+    with open(os.path.join(files_dir, pfile), 'r') as keys:
         for key in keys:
             k, v = key.split(': ')
             if v.endswith('\n'): v = v[:-1]
@@ -147,51 +208,36 @@ def init_properties():
 '''-------------------------------------
 Method: save_properties
 
-Save RASCAL properties to either:
+Save RASCAL properties to the store:
  - memcache (heroku)
- - pickle (local file)
- - text file
+ - SQLite or pickle (local file)
 
 Input:
     <data>: dict of property key-value pairs
 '''
 def save_properties(data):
-    if is_heroku:        # save to heroku
-        mc.set('properties', data)
-    else:               # save to .pkl
-        with open(prop_file, 'w+') as f:
-            pickle.dump(data, f)
-        f.close()
-                        # save to .txt
-    # with open('./files/properties.txt', 'w') as f:
+    get_store().save_properties(data)
 
 
 '''-------------------------------------
 Method: load_properties
 
 Loads saved property values from either:
- - memcache (heroku)
- - pickle (local file)
- - text file
+ - the store: memcache (heroku), or
+   SQLite or pickle (local file)
+ - text file, if nothing is saved yet
 
  Return:
     <dict>:  dictionary with properties
              key-value pairs
 '''
 def load_properties():
-    if is_heroku:        # load from heroku
-        obj = mc.get('properties')
-        if not obj:
-            return {}
-        else:
-            return obj
-    else:               # load from .pkl
-        if os.path.isfile(prop_file):
-            with open(prop_file, 'r+') as f:
-                data = pickle.load(f)
-                return data
-        else:           # load from .txt
-            return get_settings('properties.txt')
+    data = get_store().load_properties()
+    if data:
+        return data
+    if is_heroku:
+        return {}
+    return get_settings('properties.txt')
 
 
 '''-------------------------------------
@@ -225,22 +271,36 @@ Returns:
     <obj>:          object with cached values
 '''
 def load_cache(cachename, data):
-    if is_heroku:
-        if is_heroku:
-            obj = mc.get(cachename)
-            if not obj:
-                return data
-            else:
-                return obj
-    else:
-        if os.path.isfile(cachename):
-            with open(cachename, 'r+') as f:
-                # If the file isn't at its end or empty
-                if f.tell() != os.fstat(f.fileno()).st_size:
-                    return pickle.load(f)
-        else:
-            log("--No cache file found. Creating new cache file.", Color.BLUE)
+    obj = get_store().load(cachename, data)
+    if obj is None:
+        log("--No cache found. Creating new cache.", Color.BLUE)
+        return data
+    return upgrade_cache(obj, data)
+
+
+'''-------------------------------------
+Method: upgrade_cache
+
+Fits a loaded cache to the type of its
+default data. Legacy lists of post IDs
+become a PostCache, and saved PostCaches
+take on the configured size and TTL
+
+Input:
+    <obj>:          cached values as loaded
+    <data>:         default data for the cache
+
+Returns:
+    <obj>:          object with cached values
+'''
+def upgrade_cache(obj, data):
+    if isinstance(data, PostCache):
+        if not isinstance(obj, PostCache):
+            data.update(obj)
             return data
+        obj.max_size, obj.ttl = data.max_size, data.ttl
+        obj.prune()
+    return obj
 
 
 '''-------------------------------------
@@ -253,11 +313,53 @@ Input:
     <data>:         data to save
 '''
 def save_cache(cachename, data):
-    if is_heroku:
-        mc.set(cachename, data)
-    else:
-        with open(cachename, 'w+') as f:
-            pickle.dump(data, f)
+    get_store().save(cachename, data)
+
+
+'''-------------------------------------
+Method: get_store
+
+Opens the configured store on first use:
+ - memcache on heroku
+ - SQLite at store_path, reading caches
+   not migrated yet from the old pickles
+ - pickle files, if store_backend says so
+
+Returns:
+    <Store>:        backend for the process
+'''
+def get_store():
+    global store
+    if store is None:
+        if is_heroku or os.environ.get('MEMCACHEDCLOUD_SERVERS'):
+            import bmemcached
+            store = MemcachedStore(bmemcached.Client(
+                os.environ.get('MEMCACHEDCLOUD_SERVERS').split(','),
+                os.environ.get('MEMCACHEDCLOUD_USERNAME'),
+                os.environ.get('MEMCACHEDCLOUD_PASSWORD')))
+        elif store_backend == 'pickle':
+            store = PickleStore()
+        else:
+            store = SQLiteStore(store_path, legacy=PickleStore())
+    return store
+
+
+'''-------------------------------------
+Method: fql_rows
+
+Pulls the result rows out of an FQL
+response, which facepy wraps in a "data"
+dict and the facebook SDK returns bare
+
+Input:
+    <result>:   response from graph.fql
+Returns:
+    <list>:     result rows
+'''
+def fql_rows(result):
+    if isinstance(result, dict):
+        return result.get('data', [])
+    return result or []
 
 
 '''-------------------------------------
@@ -0,0 +1,299 @@
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+    from urllib2 import Request, urlopen
+
+import util as u
+
+'''----------------------------------------------------------------------------
+Project:    RASCAL: Robotic Autonomous Space Cadet Adminstration Lackey
+File:       webhook.py
+Author:     @WhitneyOnTheWeb
+
+Receiver for Graph webhook notifications on a group's feed
+
+- Checks each notification's X-Hub-Signature against the app secret
+- Queues only the post IDs that were added or edited, for sub_group to
+  validate, instead of polling the whole feed
+- post_sample() plays Facebook's side, POSTing signed sample payloads
+  at a local receiver for testing
+----------------------------------------------------------------------------'''
+__author__ = 'Whitney King'
+
+
+'''-------------------------------------
+Global Variables
+================
+'''
+ignored_items = ('comment', 'reaction', 'like')     # changes to skip
+ignored_verbs = ('remove', 'hide')
+
+
+'''-------------------------------------
+Method: sign
+
+Signs a request body the way Graph does
+
+Input:
+    <body>:         raw request body
+    <app_secret>:   app secret key
+Return:
+    <str>:          "sha256=<hex digest>"
+'''
+def sign(body, app_secret):
+    return 'sha256=' + hmac.new(app_secret.encode('utf-8'), body,
+                                hashlib.sha256).hexdigest()
+
+
+'''-------------------------------------
+Method: verify_signature
+
+Checks a notification's signature header,
+X-Hub-Signature-256 or the older SHA1
+X-Hub-Signature
+
+Input:
+    <body>:         raw request body
+    <signature>:    "<algorithm>=<hex digest>"
+    <app_secret>:   app secret key
+Return:
+    <bool>:         True if it matches
+'''
+def verify_signature(body, signature, app_secret):
+    if not signature or not app_secret or '=' not in signature:
+        return False
+    algorithm, digest = signature.split('=', 1)
+    if algorithm not in ('sha256', 'sha1'):
+        return False
+    expected = hmac.new(app_secret.encode('utf-8'), body,
+                        getattr(hashlib, algorithm)).hexdigest()
+    return hmac.compare_digest(expected, digest.strip().lower())
+
+
+'''-------------------------------------
+Method: changed_post_ids
+
+Pulls the IDs of posts that were added or
+edited out of a feed notification
+
+Input:
+    <payload>:  parsed notification body
+    <group_id>: only keep this group's posts
+Return:
+    <list>:     post IDs, in order, no repeats
+'''
+def changed_post_ids(payload, group_id=None):
+    post_ids = []
+    for entry in payload.get('entry', []):
+        if group_id is not None and str(entry.get('id')) != str(group_id):
+            continue
+        for change in entry.get('changes', []):
+            value = change.get('value') or {}
+            if change.get('field') != 'feed' or \
+                    value.get('item') in ignored_items or \
+                    value.get('verb') in ignored_verbs:
+                continue
+            post_id = value.get('post_id')
+            if post_id and post_id not in post_ids:
+                post_ids.append(post_id)
+    return post_ids
+
+
+'''-------------------------------------
+Class: PostQueue
+
+Thread-safe queue of post IDs waiting to
+be validated. A post notified twice before
+it's taken is only queued once
+'''
+class PostQueue(object):
+    def __init__(self):
+        self._ids = OrderedDict()
+        self._ready = threading.Condition()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def put(self, post_ids):
+        with self._ready:
+            for post_id in post_ids:
+                self._ids[post_id] = True
+            if self._ids:
+                self._ready.notify_all()
+
+    '''-------------------------------------
+    Method: wait
+
+    Waits up to <timeout> seconds for posts,
+    then takes everything queued
+
+    Return:
+        <list>: queued post IDs, may be empty
+    '''
+    def wait(self, timeout=None):
+        with self._ready:
+            if not self._ids:
+                self._ready.wait(timeout)
+            post_ids = list(self._ids)
+            self._ids.clear()
+        return post_ids
+
+
+'''-------------------------------------
+Class: WebhookHandler
+
+GET answers Graph's subscription check,
+POST takes a signed feed notification
+'''
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != self.server.path:
+            return self._reply(404, 'Not found')
+
+        # Nothing passes the check without a token set
+        query = parse_qs(url.query)
+        mode = query.get('hub.mode', [None])[0]
+        token = query.get('hub.verify_token', [''])[0]
+        expected = self.server.verify_token
+        if mode == 'subscribe' and expected and \
+                hmac.compare_digest(token.encode('utf-8'),
+                                    expected.encode('utf-8')):
+            self._reply(200, query.get('hub.challenge', [''])[0])
+        else:
+            self._reply(403, 'Bad verify token')
+
+    def do_POST(self):
+        if urlparse(self.path).path != self.server.path:
+            return self._reply(404, 'Not found')
+
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        signature = self.headers.get('X-Hub-Signature-256') or \
+            self.headers.get('X-Hub-Signature')
+        if not verify_signature(body, signature, self.server.app_secret):
+            u.log('--Webhook signature mismatch', u.Color.RED)
+            return self._reply(403, 'Bad signature')
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return self._reply(400, 'Bad payload')
+
+        post_ids = changed_post_ids(payload, self.server.group_id)
+        self.server.queue.put(post_ids)
+        self._reply(200, 'OK')
+
+    def _reply(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+'''-------------------------------------
+Class: WebhookServer
+
+HTTP server feeding a PostQueue
+
+Input:
+    <address>:      (host, port) to listen on
+    <app_secret>:   app secret for signatures
+    <verify_token>: token for the GET check
+    <group_id>:     only queue this group's
+                    posts, None for any
+    <path>:         URL path to answer on
+'''
+class WebhookServer(HTTPServer):
+    def __init__(self, address, app_secret, verify_token=None,
+                 group_id=None, path='/webhook'):
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.app_secret = app_secret
+        self.verify_token = verify_token
+        self.group_id = group_id
+        self.path = path
+        self.queue = PostQueue()
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.server_address[0],
+                                   self.server_address[1], self.path)
+
+    '''-------------------------------------
+    Method: start
+
+    Serves requests on a background thread
+    '''
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+'''-------------------------------------
+Method: sample_payload
+
+Builds a feed notification like Graph's
+
+Input:
+    <group_id>: ID of the FB group
+    <post_ids>: posts to report as edited
+    <verb>:     change verb, "add", "edited"..
+'''
+def sample_payload(group_id, post_ids, verb='edited'):
+    return {'object': 'group',
+            'entry': [{'id': str(group_id), 'time': int(time.time()),
+                       'changes': [{'field': 'feed',
+                                    'value': {'item': 'status',
+                                              'verb': verb,
+                                              'post_id': post_id}}
+                                   for post_id in post_ids]}]}
+
+
+'''-------------------------------------
+Method: post_sample
+
+Stand-in for Facebook: POSTs a signed
+payload at a receiver
+
+Input:
+    <url>:          receiver URL
+    <payload>:      notification dict
+    <app_secret>:   secret to sign with
+Return:
+    <int>:          HTTP status of the reply
+'''
+def post_sample(url, payload, app_secret):
+    body = json.dumps(payload).encode('utf-8')
+    request = Request(url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-Hub-Signature-256': sign(body, app_secret)})
+    try:
+        return urlopen(request).getcode()
+    except Exception as e:
+        return getattr(e, 'code', None)
+
+
+# Stand-in usage: python webhook.py <url> <app secret> <group id> <post id>..
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        sys.exit('Usage: webhook.py <url> <app secret> <group id> <post id>..')
+    print(post_sample(sys.argv[1], sample_payload(sys.argv[3], sys.argv[4:]),
+                      sys.argv[2]))